@@ -1,9 +1,9 @@
-import pathlib
 import os
+import sys
 from datetime import datetime
 import logging
+import threading
 import traceback
-import inspect
 
 
 DEBUG = os.getenv('DEBUG', None)
@@ -23,23 +23,42 @@ def get_logging_level():
 logger = logging.getLogger(__name__)
 logger.setLevel(get_logging_level())
 
-# create console handler and set level to debug
-#ch = logging.StreamHandler()
-log_file_name = '{}{}aws_metrics_collector.log'.format(
-    os.getcwd(),
-    os.sep
-)
-ch = logging.FileHandler(filename=log_file_name)
-ch.setLevel(get_logging_level())
-
-# create formatter
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-
-# add formatter to ch
-ch.setFormatter(formatter)
-
-# add ch to logger
-logger.addHandler(ch)
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# The log handler is only created when the first message is logged (or when
+# configure_logging() is called), so that importing the package does not
+# create a log file in the current directory
+_logging_configured = False
+_logging_lock = threading.Lock()
+
+
+def get_log_file_name()->str:
+    return '{}{}aws_metrics_collector.log'.format(
+        os.getcwd(),
+        os.sep
+    )
+
+
+def configure_logging(log_file_name: str=None, console: bool=False, level: int=None):
+    '''Add the log handler to the logger: a FileHandler writing to
+    log_file_name (by default aws_metrics_collector.log in the current
+    directory) or, with console set, a StreamHandler writing to stderr. Only
+    the first call has an effect; LogWrapper calls it with the defaults
+    before the first message is logged.'''
+    global _logging_configured
+    with _logging_lock:
+        if _logging_configured is True:
+            return
+        if level is not None:
+            logger.setLevel(level)
+        if console is True:
+            handler = logging.StreamHandler()
+        else:
+            handler = logging.FileHandler(filename=log_file_name if log_file_name is not None else get_log_file_name())
+        handler.setLevel(logger.level)
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        logger.addHandler(handler)
+        _logging_configured = True
 
 
 def get_utc_timestamp(with_decimal: bool=False):
@@ -51,26 +70,49 @@ def get_utc_timestamp(with_decimal: bool=False):
     return int(timestamp)
 
 
-def id_caller()->list:
+def id_caller(depth: int=2)->list:
+    '''Identify the caller of the function calling id_caller(). Only the
+    frame itself is inspected (inspect.stack() would build frame records,
+    including source code context, for the whole stack).'''
     result = list()
     try:
-        caller_stack = inspect.stack()[2]
-        result.append(caller_stack[1].split(os.sep)[-1]) # File name
-        result.append(caller_stack[2]) # line number
-        result.append(caller_stack[3]) # function name
+        caller_frame = sys._getframe(depth)
+        result.append(caller_frame.f_code.co_filename.split(os.sep)[-1]) # File name
+        result.append(caller_frame.f_lineno) # line number
+        result.append(caller_frame.f_code.co_name) # function name
     except: # pragma: no cover
         pass
     return result
 
 
 class LogWrapper:
-    def __init__(self, logger_impl=logger):
+    '''Formats and logs messages with the module logger.
+
+    The log_wrapper=LogWrapper() default arguments of the package are built
+    when the modules are imported. That is cheap: it only wraps the logger,
+    and the log handler (and with it the log file) is added when the first
+    message is logged (see configure_logging()).
+    '''
+
+    def __init__(self, logger_impl=logger, context: str=None):
         self.logger = logger_impl
         self.debug_flag = DEBUG
+        self.context = context
+
+    def with_context(self, context: str):
+        '''Return a LogWrapper sharing the same logger whose messages are all
+        prefixed with the given context, for example a region name, so that
+        the output of concurrent tasks can be told apart.
+        '''
+        log_wrapper = LogWrapper(logger_impl=self.logger, context=context)
+        log_wrapper.debug_flag = self.debug_flag
+        return log_wrapper
 
     def _format_msg(self, stack_data: list, message: str)->str:
         if message is not None:
             message = '{}'.format(message)
+            if self.context is not None:
+                message = '[{}] {}'.format(self.context, message)
             if len(stack_data) == 3:
                 message = '[{}:{}:{}] {}'.format(
                     stack_data[0],
@@ -81,34 +123,49 @@ class LogWrapper:
             return message
         return 'NO_INPUT_MESSAGE'
 
+    def _configure_logging(self):
+        if _logging_configured is False and self.logger is logger:
+            configure_logging()
+
     def enable_debug(self):
+        self._configure_logging()
         self.logger.setLevel(logging.DEBUG)
         for handler in self.logger.handlers:
             handler.setLevel(logging.DEBUG)
         self.debug_flag = True
 
     def disable_debug(self):
+        self._configure_logging()
         self.logger.setLevel(logging.INFO)
         for handler in self.logger.handlers:
             handler.setLevel(logging.INFO)
         self.debug_flag = False
 
+    # The caller is only identified and the message only formatted when the level is enabled
+
     def info(self, message: str, **kwargs):
-        message = self._format_msg(stack_data=id_caller(), message=message)
-        self.logger.info(message)
+        if self.logger.isEnabledFor(logging.INFO):
+            message = self._format_msg(stack_data=id_caller(), message=message)
+            self._configure_logging()
+            self.logger.info(message)
 
     def debug(self, message: str, **kwargs):
-        if self.debug_flag is True:
+        if self.debug_flag is True and self.logger.isEnabledFor(logging.DEBUG):
             message = self._format_msg(stack_data=id_caller(), message=message)
+            self._configure_logging()
             self.logger.debug(message)
 
     def warning(self, message: str, **kwargs):
-        message = self._format_msg(stack_data=id_caller(), message=message)
-        self.logger.warning(message)
+        if self.logger.isEnabledFor(logging.WARNING):
+            message = self._format_msg(stack_data=id_caller(), message=message)
+            self._configure_logging()
+            self.logger.warning(message)
     
     def error(self, message: str, **kwargs):
-        message = self._format_msg(stack_data=id_caller(), message=message)
-        self.logger.error(message)
+        if self.logger.isEnabledFor(logging.ERROR):
+            message = self._format_msg(stack_data=id_caller(), message=message)
+            self._configure_logging()
+            self.logger.error(message)
 
 
 # EOF
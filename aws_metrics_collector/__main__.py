@@ -0,0 +1,8 @@
+import sys
+from aws_metrics_collector.cli import main
+
+
+if __name__ == '__main__':     # Also guards the re-import by the spawned export worker processes
+    sys.exit(main(prog='python3 -m aws_metrics_collector'))
+
+# EOF
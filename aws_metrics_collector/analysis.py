@@ -0,0 +1,217 @@
+import csv
+import math
+import traceback
+from aws_metrics_collector import LogWrapper
+from aws_metrics_collector.columnar import metric_statistics_to_arrays
+
+
+DEFAULT_PERIOD = 300
+SORT_CHUNK_VALUES = 1 << 22     # Values sorted at a time by summarize_instances()
+PERCENTILES = (
+    ('p50', 0.50),
+    ('p95', 0.95),
+    ('p99', 0.99),
+)
+DEFAULT_UTILIZATION_THRESHOLDS = {     # Metric name: thresholds of the utilization flags, in the unit of the metric
+    'CPUUtilization': {
+        'Idle': 5.0,    # A datapoint below this value is idle; all of p99 below it flags the instance as idle
+        'Under': 20.0,  # p95 below this value flags the instance as under-utilized
+        'Over': 80.0,   # p95 at or above this value flags the instance as over-utilized
+    },
+}
+SUMMARY_LABEL_COLUMNS = (
+    'account_id',
+    'instance_class',
+    'region',
+    'instance_id',
+    'instance_type',
+    'metric_name',
+)
+SUMMARY_VALUE_COLUMNS = (
+    'datapoints',
+    'mean',
+    'p50',
+    'p95',
+    'p99',
+    'max',
+    'idle_hours',
+)
+
+
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise Exception('Analysis requires the numpy package: pip3 install numpy')
+    return numpy
+
+
+def _segment_statistics(numpy, values, raw_lengths, lengths)->dict:
+    '''Compute the percentiles and maximum of every segment of values
+    (consecutive runs of raw_lengths[i] values, of which lengths[i] are not
+    NaN).
+
+    Segments of the same length (normally all of them, as every metric is
+    collected over the same time range) are gathered in a matrix of one row
+    per segment, with NaN replaced by +inf, and sorted row by row, after which
+    every statistic is an indexed lookup. This is much faster than sorting
+    all the values at once.'''
+    segment_count = len(raw_lengths)
+    raw_starts = numpy.zeros(segment_count, dtype=numpy.int64)
+    if segment_count > 1:
+        numpy.cumsum(raw_lengths[:-1], out=raw_starts[1:])
+    result = dict()
+    for name, quantile in PERCENTILES:
+        result[name] = numpy.full(segment_count, numpy.nan)
+    result['max'] = numpy.full(segment_count, numpy.nan)
+    for width in numpy.unique(raw_lengths):
+        if width == 0:
+            continue
+        width_segments = numpy.flatnonzero((raw_lengths == width) & (lengths > 0))
+        chunk_size = max(1, SORT_CHUNK_VALUES // int(width))
+        for chunk_start in range(0, len(width_segments), chunk_size):
+            segments = width_segments[chunk_start:chunk_start + chunk_size]
+            matrix = values[raw_starts[segments][:, None] + numpy.arange(width)]
+            matrix[numpy.isnan(matrix)] = numpy.inf
+            matrix.sort(axis=1)
+            rows = numpy.arange(len(segments))
+            last_index = lengths[segments] - 1
+            for name, quantile in PERCENTILES:
+                position = last_index * quantile
+                lower = numpy.floor(position).astype(numpy.int64)
+                upper = numpy.ceil(position).astype(numpy.int64)
+                lower_values = matrix[rows, lower]
+                result[name][segments] = lower_values + (matrix[rows, upper] - lower_values) * (position - lower)
+            result['max'][segments] = matrix[rows, last_index]
+    return result
+
+
+def summarize_instances(
+    instances: list,
+    statistic: str='Average',
+    period: int=DEFAULT_PERIOD,
+    utilization_thresholds: dict=None,
+    log_wrapper: LogWrapper=LogWrapper()
+)->dict:
+    '''Summarize the utilization of every metric of every instance (requires
+    the optional numpy package).
+
+    Returns a table of columns with one row per instance and metric: the
+    labels (account_id, instance_class, region, instance_id, instance_type,
+    metric_name as lists of strings), the number of datapoints and the mean,
+    p50, p95, p99 and maximum of the given statistic (numpy float64 arrays,
+    NaN without datapoints), idle_hours and flag.
+
+    For the metrics in utilization_thresholds (by default
+    DEFAULT_UTILIZATION_THRESHOLDS), idle_hours is the time (datapoints of
+    period seconds) below the Idle threshold and flag is 'idle', 'under' or
+    'over' (see DEFAULT_UTILIZATION_THRESHOLDS) or an empty string. Other
+    metrics get NaN idle hours and no flag.
+    '''
+    numpy = _import_numpy()
+    if utilization_thresholds is None:
+        utilization_thresholds = DEFAULT_UTILIZATION_THRESHOLDS
+    summary = dict()
+    for name in SUMMARY_LABEL_COLUMNS:
+        summary[name] = list()
+    value_arrays = list()
+    for instance in instances:
+        for metric_name, datapoints in instance.metric_statistics.items():
+            timestamps, values = metric_statistics_to_arrays(datapoints=datapoints, statistics=(statistic,))
+            summary['account_id'].append(instance.account_id)
+            summary['instance_class'].append(instance.instance_class)
+            summary['region'].append(instance.region)
+            summary['instance_id'].append(instance.instance_id)
+            summary['instance_type'].append(instance.instance_type)
+            summary['metric_name'].append(metric_name)
+            value_arrays.append(numpy.frombuffer(values[statistic], dtype=numpy.float64) if len(values[statistic]) > 0 else numpy.empty(0))
+    row_count = len(value_arrays)
+    raw_lengths = numpy.fromiter((len(value_array) for value_array in value_arrays), dtype=numpy.int64, count=row_count)
+    values = numpy.concatenate(value_arrays) if row_count > 0 else numpy.empty(0)
+    segment_ids = numpy.repeat(numpy.arange(row_count), raw_lengths)
+    present = ~numpy.isnan(values)
+    lengths = numpy.bincount(segment_ids, weights=present, minlength=row_count).astype(numpy.int64)
+    summary['datapoints'] = lengths
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        summary['mean'] = numpy.bincount(segment_ids, weights=numpy.where(present, values, 0.0), minlength=row_count) / lengths
+    summary.update(_segment_statistics(numpy=numpy, values=values, raw_lengths=raw_lengths, lengths=lengths))
+
+    idle_thresholds = numpy.full(row_count, numpy.nan)
+    under_thresholds = numpy.full(row_count, numpy.nan)
+    over_thresholds = numpy.full(row_count, numpy.nan)
+    metric_names = numpy.array(summary['metric_name'], dtype=object)
+    for metric_name, thresholds in utilization_thresholds.items():
+        rows = metric_names == metric_name
+        idle_thresholds[rows] = thresholds.get('Idle', math.nan)
+        under_thresholds[rows] = thresholds.get('Under', math.nan)
+        over_thresholds[rows] = thresholds.get('Over', math.nan)
+    with numpy.errstate(invalid='ignore'):
+        idle_datapoints = numpy.bincount(segment_ids, weights=values < idle_thresholds[segment_ids], minlength=row_count)
+    summary['idle_hours'] = numpy.where(numpy.isnan(idle_thresholds), numpy.nan, idle_datapoints * period / 3600.0)
+    flags = numpy.full(row_count, '', dtype=object)
+    with numpy.errstate(invalid='ignore'):
+        flags[summary['p95'] >= over_thresholds] = 'over'
+        flags[summary['p95'] < under_thresholds] = 'under'
+        flags[summary['p99'] < idle_thresholds] = 'idle'
+    summary['flag'] = flags.tolist()
+    log_wrapper.info(message='Summarized {} datapoints of {} instance metrics'.format(int(lengths.sum()), row_count))
+    return summary
+
+
+def summarize_collection(collection, **kwargs)->dict:
+    '''summarize_instances() of the instances of an AWSInstanceCollection.'''
+    return summarize_instances(instances=collection.instances, **kwargs)
+
+
+def summary_to_rows(summary: dict, flagged_only: bool=False)->list:
+    '''Convert a summary table to a list of dicts, one per row. With
+    flagged_only, only the rows with a utilization flag are returned (a
+    rightsizing report).'''
+    columns = SUMMARY_LABEL_COLUMNS + SUMMARY_VALUE_COLUMNS + ('flag',)
+    rows = list()
+    for index in range(len(summary['instance_id'])):
+        if flagged_only is True and summary['flag'][index] == '':
+            continue
+        row = dict()
+        for name in columns:
+            value = summary[name][index]
+            row[name] = value.item() if hasattr(value, 'item') else value
+        rows.append(row)
+    return rows
+
+
+def format_summary_table(summary: dict, flagged_only: bool=False, max_rows: int=None)->str:
+    '''Format a summary table as aligned text, for printing.'''
+    rows = summary_to_rows(summary=summary, flagged_only=flagged_only)
+    if max_rows is not None:
+        rows = rows[:max_rows]
+    columns = ('instance_id', 'instance_type', 'region', 'metric_name') + SUMMARY_VALUE_COLUMNS + ('flag',)
+    lines = [[name for name in columns],]
+    for row in rows:
+        line = list()
+        for name in columns:
+            value = row[name]
+            if isinstance(value, float):
+                line.append('-' if math.isnan(value) else '{:.2f}'.format(value))
+            else:
+                line.append('{}'.format(value))
+        lines.append(line)
+    widths = [max(len(line[index]) for line in lines) for index in range(len(columns))]
+    return '\n'.join('  '.join(value.ljust(width) for value, width in zip(line, widths)).rstrip() for line in lines)
+
+
+def write_summary_csv(summary: dict, file_name: str, flagged_only: bool=False, log_wrapper: LogWrapper=LogWrapper())->bool:
+    '''Write a summary table to a CSV file.'''
+    try:
+        rows = summary_to_rows(summary=summary, flagged_only=flagged_only)
+        with open(file_name, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=SUMMARY_LABEL_COLUMNS + SUMMARY_VALUE_COLUMNS + ('flag',))
+            writer.writeheader()
+            writer.writerows(rows)
+        log_wrapper.info(message='Wrote the summary of {} instance metrics to "{}"'.format(len(rows), file_name))
+        return True
+    except:
+        log_wrapper.error(message='EXCEPTION: {}'.format(traceback.format_exc()))
+    return False
+
+# EOF
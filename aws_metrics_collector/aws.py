@@ -1,9 +1,19 @@
-import boto3
+import json
+import threading
+import time
 import traceback
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
 from aws_metrics_collector import LogWrapper
 from aws_metrics_collector import get_utc_timestamp
-from aws_metrics_collector.utils import dict_to_json
+from aws_metrics_collector.client_pool import AwsClientPool, UNKNOWN_ACCOUNT_ID, get_default_client_pool, is_role_arn
+from aws_metrics_collector.filters import InstanceFilter
+from aws_metrics_collector.regions import RegionCatalog, get_default_region_catalog
+from aws_metrics_collector.metric_index import get_default_metric_index_cache
+from aws_metrics_collector.profiling import get_default_profiler
+from aws_metrics_collector.metric_series import MetricSeries, to_epoch
+from aws_metrics_collector.response_cache import ResponseCache, get_default_response_cache
+from aws_metrics_collector.tag_cache import TagCache, get_default_tag_cache
 
 
 INSTANCE_CLASSES = (
@@ -12,6 +22,26 @@ INSTANCE_CLASSES = (
     'cloudwatch',
 )
 MAX_RESULTS_DEFAULT = 20
+MAX_RDS_PAGE_SIZE = 100         # describe_db_instances accepts a MaxRecords of 20 to 100
+MAX_METRIC_DATA_QUERIES = 500   # Hard limit of MetricDataQueries per GetMetricData request
+MAX_INCREMENTAL_LOOKBACK = 63 * 86400   # Retention of 5 minute CloudWatch datapoints, in seconds
+START_TIMESTAMP_GROUP_PERIODS = 12  # Metrics whose start timestamps are less than this many periods apart share GetMetricData requests
+MAX_DATAPOINTS_PER_REQUEST = 1440   # Hard limit of datapoints returned by one get_metric_statistics request
+MAX_SPLIT_WORKERS = 4           # Concurrent requests of one metric when its time range has to be split
+MAX_TAG_LOOKUP_WORKERS = 8      # Concurrent list_tags_for_resource requests per page of RDS instances
+DEFAULT_PERIOD = 300
+DEFAULT_STATISTICS = (
+    'Average',
+    'Maximum',
+)
+STANDARD_STATISTICS = (         # Any other statistic (for example p99 or tm90) is an extended statistic
+    'SampleCount',
+    'Average',
+    'Sum',
+    'Minimum',
+    'Maximum',
+)
+HIGH_RESOLUTION_PERIODS = (1, 5, 10, 30)    # Otherwise the period must be a multiple of 60 seconds
 AWS_CLOUDWATCH_NAMESPACE_MAPPING = {    # Refere to https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/aws-services-cloudwatch-metrics.html or (NEW): https://docs.aws.amazon.com/en_pv/AmazonCloudWatch/latest/monitoring/aws-services-cloudwatch-metrics.html
     'ec2': 'AWS/EC2',
     'rds': 'AWS/RDS',
@@ -20,16 +50,89 @@ AWS_CLOUDWATCH_DIMENSION_NAME_MAPPING = {
     'ec2': 'InstanceId',
     'rds': 'DBInstanceIdentifier',
 }
+AWS_CLOUDWATCH_METRIC_UNITS = {    # GetMetricData returns no units: the documented units of the metrics, added to the datapoints of get_metric_data_batched()
+    'ec2': {
+        'CPUUtilization': 'Percent',
+        'CPUCreditUsage': 'Count',
+        'CPUCreditBalance': 'Count',
+        'CPUSurplusCreditBalance': 'Count',
+        'CPUSurplusCreditsCharged': 'Count',
+        'DiskReadOps': 'Count',
+        'DiskWriteOps': 'Count',
+        'DiskReadBytes': 'Bytes',
+        'DiskWriteBytes': 'Bytes',
+        'EBSReadOps': 'Count',
+        'EBSWriteOps': 'Count',
+        'EBSReadBytes': 'Bytes',
+        'EBSWriteBytes': 'Bytes',
+        'EBSIOBalance%': 'Percent',
+        'EBSByteBalance%': 'Percent',
+        'MetadataNoToken': 'Count',
+        'NetworkIn': 'Bytes',
+        'NetworkOut': 'Bytes',
+        'NetworkPacketsIn': 'Count',
+        'NetworkPacketsOut': 'Count',
+        'StatusCheckFailed': 'Count',
+        'StatusCheckFailed_Instance': 'Count',
+        'StatusCheckFailed_System': 'Count',
+    },
+    'rds': {
+        'BinLogDiskUsage': 'Bytes',
+        'BurstBalance': 'Percent',
+        'CPUUtilization': 'Percent',
+        'CPUCreditUsage': 'Count',
+        'CPUCreditBalance': 'Count',
+        'DatabaseConnections': 'Count',
+        'DiskQueueDepth': 'Count',
+        'FreeableMemory': 'Bytes',
+        'FreeStorageSpace': 'Bytes',
+        'MaximumUsedTransactionIDs': 'Count',
+        'NetworkReceiveThroughput': 'Bytes/Second',
+        'NetworkTransmitThroughput': 'Bytes/Second',
+        'ReadIOPS': 'Count/Second',
+        'WriteIOPS': 'Count/Second',
+        'ReadLatency': 'Seconds',
+        'WriteLatency': 'Seconds',
+        'ReadThroughput': 'Bytes/Second',
+        'WriteThroughput': 'Bytes/Second',
+        'ReplicaLag': 'Seconds',
+        'SwapUsage': 'Bytes',
+        'TransactionLogsDiskUsage': 'Bytes',
+        'TransactionLogsGeneration': 'Bytes/Second',
+    },
+}
 
 
 
 class AwsInstance:
+    '''An AWS resource and its metric statistics.
+
+    The class uses __slots__ and keeps the datapoints of every metric in a
+    MetricSeries (see metric_series.py), so that large fleets with many
+    datapoints stay compact in memory.
+    '''
+
+    __slots__ = (
+        'instance_class',
+        'log_wrapper',
+        'last_update',
+        'raw_instance_data',
+        'account_id',
+        'instance_id',
+        'instance_type',
+        'state',
+        'region',
+        'tags',
+        'metrics',
+        'metric_statistics',
+    )
 
     def __init__(self, instance_class: str='ec2', log_wrapper: LogWrapper=LogWrapper()):
         self.instance_class = instance_class
         self.log_wrapper = log_wrapper
         self.last_update = None
         self.raw_instance_data = None
+        self.account_id = 'unknown'
         self.instance_id = 'unknown'
         self.instance_type = 'unknown'
         self.state = 'unknown'
@@ -38,15 +141,25 @@ class AwsInstance:
         self.metrics = list()
         self.metric_statistics = dict()
 
-    def store_raw_instance_data(self, instance_data: dict):
+    def store_raw_instance_data(self, instance_data: dict, keep_raw_instance_data: bool=True):
+        '''Store the describe result of the instance and extract its fields.
+        With keep_raw_instance_data set to False, the describe result is
+        dropped again once the fields are extracted.'''
         if instance_data is not None:
             if isinstance(instance_data, dict):
                 self.raw_instance_data = instance_data
                 self.last_update = get_utc_timestamp(with_decimal=False)
         self._post_store_raw_instance_data_processing()
+        if keep_raw_instance_data is False:
+            self.raw_instance_data = None
+
+    def is_valid(self)->bool:
+        '''True when describe data was stored for the instance.'''
+        return self.last_update is not None
 
     def to_dict(self):
         return {
+            'AccountId': self.account_id,
             'InstanceClass': self.instance_class,
             'LastUpdate': self.last_update,
             'InstanceId': self.instance_id,
@@ -55,15 +168,28 @@ class AwsInstance:
             'InstanceRegion': self.region,
             'Tags': self.tags,
             'Metrics': self.metrics,
-            'MetricStatistics': self.metric_statistics,
+            'MetricStatistics': self.metric_statistics_to_dict(),
         }
 
+    def metric_statistics_to_dict(self)->dict:
+        '''The metric statistics as lists of datapoint dicts, in the format
+        returned by get_metric_statistics.'''
+        result = dict()
+        for metric_name, datapoints in self.metric_statistics.items():
+            if isinstance(datapoints, MetricSeries):
+                result[metric_name] = datapoints.to_datapoints()
+            else:
+                result[metric_name] = datapoints
+        return result
+
     def _post_store_raw_instance_data_processing(self):
         pass
 
 
 class AwsEC2Instance(AwsInstance):
 
+    __slots__ = ()
+
     def __init__(self, log_wrapper: LogWrapper=LogWrapper()):
         super().__init__(instance_class='ec2', log_wrapper=log_wrapper)
 
@@ -88,6 +214,8 @@ class AwsEC2Instance(AwsInstance):
 
 class AwsRDSInstance(AwsInstance):
 
+    __slots__ = ()
+
     def __init__(self, log_wrapper: LogWrapper=LogWrapper()):
         super().__init__(instance_class='rds', log_wrapper=log_wrapper)
 
@@ -100,13 +228,64 @@ class AwsRDSInstance(AwsInstance):
                 self.instance_type = self.raw_instance_data['DBInstanceClass']
             if 'DBInstanceStatus' in self.raw_instance_data:
                 self.state = self.raw_instance_data['DBInstanceStatus']
+            if 'TagList' in self.raw_instance_data:
+                for tag in self.raw_instance_data['TagList']:
+                    if 'Key' in tag and 'Value' in tag:
+                        self.tags[tag['Key']] = tag['Value']
+
+
+class CollectionProgress:
+    '''Thread safe counters of the (account, service, region) tasks of
+    collect_aws_instance_data(), for monitoring.'''
+
+    def __init__(self):
+        self.tasks_queued = 0
+        self.tasks_running = 0
+        self.tasks_completed = 0
+        self._lock = threading.Lock()
+
+    def add_tasks(self, task_count: int):
+        with self._lock:
+            self.tasks_queued += task_count
+
+    def start_task(self):
+        with self._lock:
+            self.tasks_queued -= 1
+            self.tasks_running += 1
+
+    def finish_task(self):
+        with self._lock:
+            self.tasks_running -= 1
+            self.tasks_completed += 1
+
+    def to_dict(self)->dict:
+        with self._lock:
+            return {
+                'TasksQueued': self.tasks_queued,
+                'TasksRunning': self.tasks_running,
+                'TasksCompleted': self.tasks_completed,
+            }
+
+
+_default_collection_progress = CollectionProgress()
+
+
+def get_default_collection_progress()->CollectionProgress:
+    return _default_collection_progress
 
 
 class AWSInstanceCollection:
 
+    __slots__ = ('instances', 'log_wrapper', '_lock')
+
     def __init__(self, log_wrapper: LogWrapper=LogWrapper()):
         self.instances = list()
         self.log_wrapper = log_wrapper
+        self._lock = threading.Lock()
+
+    def add_instances(self, instances: list):
+        with self._lock:
+            self.instances.extend(instances)
 
     def to_dict(self)->dict:
         result = dict()
@@ -116,18 +295,20 @@ class AWSInstanceCollection:
         return result
 
 
-def get_service_client_default(service='ec2', region: str='us-east-1', target_profile: str=None, log_wrapper=LogWrapper()):
+def get_service_client_default(service='ec2', region: str='us-east-1', target_profile: str=None, client_pool: AwsClientPool=None, log_wrapper=LogWrapper()):
+    '''Get a client from the client pool (by default the process wide pool),
+    creating it when it is not yet cached.'''
     client = None
     try:
+        if client_pool is None:
+            client_pool = get_default_client_pool(log_wrapper=log_wrapper)
+        if client_pool.has_client(service=service, region=region, target_profile=target_profile) is True:
+            return client_pool.get_client(service=service, region=region, target_profile=target_profile)
         if service not in INSTANCE_CLASSES:
             raise Exception('Service "{}" not supported for this application yet'.format(service))
         if region not in get_regions_by_service(service=service, log_wrapper=log_wrapper):
             raise Exception('Service "{}" not available in selected region "{}"'.format(service, region))
-        if target_profile is not None:
-            session = boto3.Session(profile_name=target_profile)
-            client = session.client(service, region_name=region)
-        else:
-            client = boto3.client(service, region_name=region)
+        client = client_pool.get_client(service=service, region=region, target_profile=target_profile)
     except:
         log_wrapper.error(message='EXCEPTION: {}'.format(traceback.format_exc()))
     if client is not None:
@@ -137,264 +318,1071 @@ def get_service_client_default(service='ec2', region: str='us-east-1', target_pr
     return client
 
 
-def get_instance_cloudwatch_metrics(aws_client, instance_id: str, service_name: str='ec2', next_token: str=None, log_wrapper=LogWrapper())->list:
+def get_account_id(target_profile: str=None, client_pool: AwsClientPool=None, response_cache: ResponseCache=None, log_wrapper=LogWrapper())->str:
+    '''Return the AWS account ID of a profile or role ARN. When the response
+    cache (by default the process wide cache) is enabled, the account ID of a
+    profile is cached like a list_metrics response, so that offline runs do
+    not call sts:GetCallerIdentity.'''
+    if client_pool is None:
+        client_pool = get_default_client_pool(log_wrapper=log_wrapper)
+    if response_cache is None:
+        response_cache = get_default_response_cache(log_wrapper=log_wrapper)
+    if response_cache.is_enabled() is False or is_role_arn(target_profile=target_profile):
+        return client_pool.get_account_id(target_profile=target_profile)
+    request = {'Operation': 'GetCallerIdentity', 'Profile': target_profile}
+    account_id = response_cache.get(request=request)
+    if account_id is None:
+        if response_cache.offline is True:
+            log_wrapper.error(message='The account ID of profile "{}" is not cached and the response cache is offline'.format(target_profile))
+            return UNKNOWN_ACCOUNT_ID
+        account_id = client_pool.get_account_id(target_profile=target_profile)
+        if account_id != UNKNOWN_ACCOUNT_ID:
+            response_cache.put(request=request, response=account_id, expires=response_cache.get_expires())
+    else:
+        client_pool.set_account_id(target_profile=target_profile, account_id=account_id)
+    return account_id
+
+
+def _list_instance_metric_names(aws_client, list_metrics_kwargs: dict)->list:
+    metric_names = list()
+    paginator = aws_client.get_paginator('list_metrics')
+    for response in paginator.paginate(**list_metrics_kwargs):
+        if 'Metrics' in response:
+            for metric in response['Metrics']:
+                if 'MetricName' in metric:
+                    metric_names.append(metric['MetricName'])
+    return metric_names
+
+
+def get_instance_cloudwatch_metrics(
+    aws_client,
+    instance_id: str,
+    service_name: str='ec2',
+    next_token: str=None,
+    account_id: str=None,
+    response_cache: ResponseCache=None,
+    log_wrapper=LogWrapper()
+)->list:
+    '''List the names of the metrics of an instance. When the response cache
+    is enabled, the result is reused for its recent_ttl (see
+    response_cache.ResponseCache); account_id is part of the cache key.
+    '''
     instance_metrics = list()
     if service_name not in INSTANCE_CLASSES:
         log_wrapper.error(message='Invalid service name.')
     else:
         try:
-            response = dict()
+            if response_cache is None:
+                response_cache = get_default_response_cache(log_wrapper=log_wrapper)
+            pagination_config = dict()
             if next_token is not None:
-                response = aws_client.list_metrics(
-                    Namespace=AWS_CLOUDWATCH_NAMESPACE_MAPPING[service_name],
-                    Dimensions=[
-                        {
-                            'Name': AWS_CLOUDWATCH_DIMENSION_NAME_MAPPING[service_name],
-                            'Value': instance_id
-                        }
-                    ],
-                    NextToken=next_token
+                pagination_config['StartingToken'] = next_token
+            list_metrics_kwargs = {
+                'Namespace': AWS_CLOUDWATCH_NAMESPACE_MAPPING[service_name],
+                'Dimensions': [
+                    {
+                        'Name': AWS_CLOUDWATCH_DIMENSION_NAME_MAPPING[service_name],
+                        'Value': instance_id
+                    }
+                ],
+                'PaginationConfig': pagination_config,
+            }
+            if response_cache.is_enabled() is True:
+                request = {'Operation': 'ListMetrics', 'AccountId': account_id, 'Region': aws_client.meta.region_name}
+                request.update(list_metrics_kwargs)
+                instance_metrics = response_cache.get_or_fetch(
+                    request=request,
+                    fetch_function=lambda: _list_instance_metric_names(aws_client=aws_client, list_metrics_kwargs=list_metrics_kwargs)
                 )
             else:
-                response = aws_client.list_metrics(
-                    Namespace=AWS_CLOUDWATCH_NAMESPACE_MAPPING[service_name],
-                    Dimensions=[
-                        {
-                            'Name': AWS_CLOUDWATCH_DIMENSION_NAME_MAPPING[service_name],
-                            'Value': instance_id
-                        }
-                    ],
-                )
-            if 'Metrics' in response:
-                for metric in response['Metrics']:
-                    if 'MetricName' in metric:
-                        instance_metrics.append(metric['MetricName'])
+                instance_metrics = _list_instance_metric_names(aws_client=aws_client, list_metrics_kwargs=list_metrics_kwargs)
         except:
             log_wrapper.error(message='EXCEPTION: {}'.format(traceback.format_exc()))
     log_wrapper.info(message='Metrics for "{}/{}": {}'.format(service_name, instance_id, instance_metrics))
     return instance_metrics
 
 
-def get_regions_by_service(service='ec2', log_wrapper=LogWrapper())->list:
+def get_regions_by_service(service='ec2', region_catalog: RegionCatalog=None, log_wrapper=LogWrapper())->list:
+    '''Get the regions of a service from the region catalog (by default the
+    process wide catalog), which only looks them up once.'''
     try:
-        return list(boto3.session.Session().get_available_regions(service))
+        if region_catalog is None:
+            region_catalog = get_default_region_catalog(log_wrapper=log_wrapper)
+        with get_default_profiler(log_wrapper=log_wrapper).phase(name='region_discovery'):
+            return region_catalog.get_regions(service=service)
     except:
         log_wrapper.error(message='EXCEPTION: {}'.format(traceback.format_exc()))
     return ['us-east-1']
 
 
+def to_utc_datetime(timestamp: datetime)->datetime:
+    '''Return timestamp as a UTC aware datetime. A naive datetime is taken
+    as UTC, as botocore does when it sends one.'''
+    if timestamp.tzinfo is None:
+        return timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.astimezone(timezone.utc)
+
+
 def _get_start_timestamp()->datetime:
-    yesterday = datetime.now() - timedelta(1)
+    yesterday = datetime.now(tz=timezone.utc) - timedelta(1)
     yesterday = yesterday.replace(hour=0, minute=0, second=0, microsecond=0)
     return yesterday
 
 
 def _get_end_timestamp()->datetime:
-    yesterday = datetime.now() - timedelta(1)
+    yesterday = datetime.now(tz=timezone.utc) - timedelta(1)
     yesterday = yesterday.replace(hour=23, minute=59, second=59, microsecond=0)
     return yesterday
 
 
+def validate_period(period: int):
+    if not isinstance(period, int) or period < 1 or (period not in HIGH_RESOLUTION_PERIODS and period % 60 != 0):
+        raise Exception('Invalid period {}: must be 1, 5, 10, 30 or a multiple of 60 seconds'.format(period))
+
+
+def split_statistics(statistics: tuple)->tuple:
+    '''Split statistics in the (Statistics, ExtendedStatistics) parameters of
+    get_metric_statistics.'''
+    standard_statistics = [statistic for statistic in statistics if statistic in STANDARD_STATISTICS]
+    extended_statistics = [statistic for statistic in statistics if statistic not in STANDARD_STATISTICS]
+    return standard_statistics, extended_statistics
+
+
+def split_time_range(
+    start_timestamp: datetime,
+    end_timestamp: datetime,
+    period: int=DEFAULT_PERIOD,
+    max_datapoints: int=MAX_DATAPOINTS_PER_REQUEST
+)->list:
+    '''Split the range from start_timestamp to end_timestamp in consecutive
+    (start, end) ranges of at most max_datapoints periods each. The ranges
+    are UTC aware datetimes (see to_utc_datetime()), so naive and aware
+    timestamps can be mixed.'''
+    time_ranges = list()
+    step = timedelta(seconds=period * max_datapoints)
+    range_start = to_utc_datetime(timestamp=start_timestamp)
+    end_timestamp = to_utc_datetime(timestamp=end_timestamp)
+    while range_start < end_timestamp:
+        range_end = min(range_start + step, end_timestamp)
+        time_ranges.append((range_start, range_end))
+        range_start = range_end
+    return time_ranges
+
+
+def _get_metric_statistics_range(aws_client, request_kwargs: dict, start_timestamp: datetime, end_timestamp: datetime)->list:
+    response = aws_client.get_metric_statistics(StartTime=start_timestamp, EndTime=end_timestamp, **request_kwargs)
+    datapoints = response.get('Datapoints', list())
+    for datapoint in datapoints:
+        if 'ExtendedStatistics' in datapoint:
+            datapoint.update(datapoint.pop('ExtendedStatistics'))
+    return datapoints
+
+
+def _get_metric_statistics_range_cached(
+    aws_client,
+    request_kwargs: dict,
+    start_timestamp: datetime,
+    end_timestamp: datetime,
+    account_id: str=None,
+    response_cache: ResponseCache=None
+)->list:
+    '''_get_metric_statistics_range() through the response cache. The
+    datapoints are cached with epoch timestamps; a closed time range is cached
+    forever.'''
+    if response_cache is None or response_cache.is_enabled() is False:
+        return _get_metric_statistics_range(aws_client=aws_client, request_kwargs=request_kwargs, start_timestamp=start_timestamp, end_timestamp=end_timestamp)
+
+    def fetch_function()->list:
+        datapoints = _get_metric_statistics_range(aws_client=aws_client, request_kwargs=request_kwargs, start_timestamp=start_timestamp, end_timestamp=end_timestamp)
+        for datapoint in datapoints:
+            datapoint['Timestamp'] = to_epoch(datapoint['Timestamp'])
+        return datapoints
+
+    request = {
+        'Operation': 'GetMetricStatistics',
+        'AccountId': account_id,
+        'Region': aws_client.meta.region_name,
+        'StartTime': to_epoch(start_timestamp),
+        'EndTime': to_epoch(end_timestamp),
+    }
+    request.update(request_kwargs)
+    datapoints = response_cache.get_or_fetch(request=request, fetch_function=fetch_function, window_end=to_epoch(end_timestamp))
+    for datapoint in datapoints:
+        datapoint['Timestamp'] = datetime.fromtimestamp(datapoint['Timestamp'], timezone.utc)
+    return datapoints
+
+
 def get_instance_metric_statistics(
     aws_client, 
     instance_id: str,
     service_name: str='ec2',
     metric_name: str='CPUUtilization',
-    start_timestamp: datetime=_get_start_timestamp(),
-    end_timestamp: datetime=_get_end_timestamp(),
-    period: int=300,
+    start_timestamp: datetime=None,
+    end_timestamp: datetime=None,
+    period: int=DEFAULT_PERIOD,
+    statistics: tuple=DEFAULT_STATISTICS,
+    max_datapoints_per_request: int=MAX_DATAPOINTS_PER_REQUEST,
+    max_workers: int=MAX_SPLIT_WORKERS,
+    account_id: str=None,
+    response_cache: ResponseCache=None,
     log_wrapper=LogWrapper()
 )->dict:
+    '''Retrieve the statistics of one metric with get_metric_statistics, from
+    start_timestamp to end_timestamp (by default the whole of yesterday, UTC).
+
+    statistics may contain standard statistics and extended statistics such
+    as percentiles (for example p99), which are returned as keys of the
+    datapoints like the standard statistics. A time range of more than
+    max_datapoints_per_request periods is split in several requests, of which
+    up to max_workers are sent concurrently. When any of those requests
+    fails, no datapoints are returned.
+
+    When the response cache is enabled (by default the process wide cache,
+    see response_cache.ResponseCache), every time range is looked up in the
+    cache first; account_id is part of the cache key.
+    '''
     result = dict()
-    result[metric_name] = dict()
+    result[metric_name] = list()
     if service_name not in AWS_CLOUDWATCH_NAMESPACE_MAPPING:
         log_wrapper.error(message='Invalid service name.')
         return result
+    if start_timestamp is None:
+        start_timestamp = _get_start_timestamp()
+    if end_timestamp is None:
+        end_timestamp = _get_end_timestamp()
     dimension_name = AWS_CLOUDWATCH_DIMENSION_NAME_MAPPING[service_name]
     name_space = AWS_CLOUDWATCH_NAMESPACE_MAPPING[service_name]
     try:
+        if response_cache is None:
+            response_cache = get_default_response_cache(log_wrapper=log_wrapper)
         log_wrapper.info('Retrieving metrics data for "{}/{}/{}/{}/{}"'.format(service_name, name_space, dimension_name, instance_id, metric_name))
-        response = aws_client.get_metric_statistics(
-            Namespace=name_space,
-            MetricName=metric_name,
-            Dimensions=[
+        standard_statistics, extended_statistics = split_statistics(statistics=statistics)
+        request_kwargs = {
+            'Namespace': name_space,
+            'MetricName': metric_name,
+            'Dimensions': [
                 {
                     'Name': dimension_name,
                     'Value': instance_id
                 },
             ],
-            StartTime=start_timestamp,
-            EndTime=end_timestamp,
-            Period=period,
-            Statistics=[
-                'Average',
-                'Maximum',
-            ]
-        )
-        if 'Datapoints' in response:
-            result[metric_name] = response['Datapoints']
+            'Period': period,
+        }
+        if len(standard_statistics) > 0:
+            request_kwargs['Statistics'] = standard_statistics
+        if len(extended_statistics) > 0:
+            request_kwargs['ExtendedStatistics'] = extended_statistics
+        time_ranges = split_time_range(start_timestamp=start_timestamp, end_timestamp=end_timestamp, period=period, max_datapoints=max_datapoints_per_request)
+        datapoints_by_timestamp = dict()
+        if len(time_ranges) == 1 or max_workers is None or max_workers <= 1:
+            for range_start, range_end in time_ranges:
+                for datapoint in _get_metric_statistics_range_cached(aws_client=aws_client, request_kwargs=request_kwargs, start_timestamp=range_start, end_timestamp=range_end, account_id=account_id, response_cache=response_cache):
+                    datapoints_by_timestamp[datapoint['Timestamp']] = datapoint
+        else:
+            log_wrapper.info(message='Splitting the request in {} time ranges'.format(len(time_ranges)))
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(time_ranges))) as executor:
+                futures = [
+                    executor.submit(_get_metric_statistics_range_cached, aws_client=aws_client, request_kwargs=request_kwargs, start_timestamp=range_start, end_timestamp=range_end, account_id=account_id, response_cache=response_cache)
+                    for range_start, range_end in time_ranges
+                ]
+                for future in futures:
+                    for datapoint in future.result():
+                        datapoints_by_timestamp[datapoint['Timestamp']] = datapoint
+        result[metric_name] = [datapoints_by_timestamp[timestamp] for timestamp in sorted(datapoints_by_timestamp)]
     except:
         log_wrapper.error(message='EXCEPTION: {}'.format(traceback.format_exc()))
-    log_wrapper.info(message='Metric Statistics for "{}/{}/{}/{}/{}": {} bytes of JSON data'.format(service_name, name_space, dimension_name, instance_id, metric_name, len(dict_to_json(result))))
+    log_wrapper.info(message='Metric Statistics for "{}/{}/{}/{}/{}": {} datapoints'.format(service_name, name_space, dimension_name, instance_id, metric_name, len(result[metric_name])))
     return result
 
 
-def get_ec2_instances(
-    aws_client, 
-    next_token: str=None, 
-    max_results_per_iteration: int=MAX_RESULTS_DEFAULT, 
-    log_wrapper=LogWrapper()
+def _get_metric_data_chunk(
+    aws_client,
+    chunk: list,
+    start_timestamp: datetime,
+    end_timestamp: datetime,
+    period: int,
+    statistics: tuple
 )->list:
-    '''Using boto3, get the list of EC2 instances and create a AwsEC2Instance 
-    instance of each, storing the collection in a result which is then returned.
+    '''Page through one GetMetricData request of the (service_name,
+    instance_id, metric_name) tuples of chunk. Returns the list of datapoints
+    of every tuple, in the order of chunk.'''
+    query_map = dict()
+    metric_data_queries = list()
+    for metric_idx, metric_query in enumerate(chunk):
+        service_name, instance_id, metric_name = metric_query
+        for stat_idx, statistic in enumerate(statistics):
+            query_id = 'q{}s{}'.format(metric_idx, stat_idx)
+            query_map[query_id] = (metric_idx, statistic)
+            metric_data_queries.append(
+                {
+                    'Id': query_id,
+                    'MetricStat': {
+                        'Metric': {
+                            'Namespace': AWS_CLOUDWATCH_NAMESPACE_MAPPING[service_name],
+                            'MetricName': metric_name,
+                            'Dimensions': [
+                                {
+                                    'Name': AWS_CLOUDWATCH_DIMENSION_NAME_MAPPING[service_name],
+                                    'Value': instance_id
+                                },
+                            ],
+                        },
+                        'Period': period,
+                        'Stat': statistic,
+                    },
+                    'ReturnData': True,
+                }
+            )
+    datapoints = [dict() for metric_query in chunk]
+    next_token = None
+    while True:
+        kwargs = {
+            'MetricDataQueries': metric_data_queries,
+            'StartTime': start_timestamp,
+            'EndTime': end_timestamp,
+            'ScanBy': 'TimestampAscending',
+        }
+        if next_token is not None:
+            kwargs['NextToken'] = next_token
+        response = aws_client.get_metric_data(**kwargs)
+        for metric_data_result in response.get('MetricDataResults', list()):
+            if metric_data_result.get('Id') not in query_map:
+                continue
+            metric_idx, statistic = query_map[metric_data_result['Id']]
+            metric_datapoints = datapoints[metric_idx]
+            for timestamp, value in zip(metric_data_result.get('Timestamps', list()), metric_data_result.get('Values', list())):
+                if timestamp not in metric_datapoints:
+                    metric_datapoints[timestamp] = {'Timestamp': timestamp}
+                metric_datapoints[timestamp][statistic] = value
+        next_token = response.get('NextToken', None)
+        if next_token is None or len(next_token) == 0:
+            break
+    return [[metric_datapoints[timestamp] for timestamp in sorted(metric_datapoints)] for metric_datapoints in datapoints]
+
+
+def _get_metric_data_chunk_cached(
+    aws_client,
+    chunk: list,
+    start_timestamp: datetime,
+    end_timestamp: datetime,
+    period: int,
+    statistics: tuple,
+    account_id: str=None,
+    response_cache: ResponseCache=None
+)->list:
+    '''_get_metric_data_chunk() through the response cache, keyed by the
+    tuples of the chunk, the time range, the period and the statistics. The
+    datapoints are cached with epoch timestamps; a closed time range is cached
+    forever.'''
+    if response_cache is None or response_cache.is_enabled() is False:
+        return _get_metric_data_chunk(aws_client=aws_client, chunk=chunk, start_timestamp=start_timestamp, end_timestamp=end_timestamp, period=period, statistics=statistics)
+
+    def fetch_function()->list:
+        chunk_datapoints = _get_metric_data_chunk(aws_client=aws_client, chunk=chunk, start_timestamp=start_timestamp, end_timestamp=end_timestamp, period=period, statistics=statistics)
+        for datapoints in chunk_datapoints:
+            for datapoint in datapoints:
+                datapoint['Timestamp'] = to_epoch(datapoint['Timestamp'])
+        return chunk_datapoints
+
+    request = {
+        'Operation': 'GetMetricData',
+        'AccountId': account_id,
+        'Region': aws_client.meta.region_name,
+        'Metrics': chunk,
+        'StartTime': to_epoch(start_timestamp),
+        'EndTime': to_epoch(end_timestamp),
+        'Period': period,
+        'Statistics': statistics,
+    }
+    chunk_datapoints = response_cache.get_or_fetch(request=request, fetch_function=fetch_function, window_end=to_epoch(end_timestamp))
+    for datapoints in chunk_datapoints:
+        for datapoint in datapoints:
+            datapoint['Timestamp'] = datetime.fromtimestamp(datapoint['Timestamp'], timezone.utc)
+    return chunk_datapoints
+
+
+def get_metric_data_batched(
+    aws_client,
+    metric_queries: list,
+    start_timestamp: datetime=None,
+    end_timestamp: datetime=None,
+    period: int=DEFAULT_PERIOD,
+    statistics: tuple=DEFAULT_STATISTICS,
+    max_queries_per_request: int=MAX_METRIC_DATA_QUERIES,
+    account_id: str=None,
+    response_cache: ResponseCache=None,
+    log_wrapper=LogWrapper()
+)->dict:
+    '''Retrieve the statistics of many metrics with as few GetMetricData
+    requests as possible.
+
+    Each item in metric_queries is a (service_name, instance_id, metric_name)
+    tuple. Every statistic requires its own query, so one request carries
+    max_queries_per_request // len(statistics) metrics. Statistics can include
+    percentiles such as p99. GetMetricData pages through any number of
+    datapoints, so the time range is never split. The result is keyed by
+    the same tuples and each value is a list of datapoints in the same format
+    as returned by get_metric_statistics. GetMetricData does not return the
+    unit of a metric, so the Unit of the datapoints is taken from
+    AWS_CLOUDWATCH_METRIC_UNITS; the datapoints of other metrics have no
+    Unit. Tuples from a request that failed are left out of the result so
+    that the caller can fall back to get_instance_metric_statistics for
+    them.
+
+    When the response cache is enabled (by default the process wide cache,
+    see response_cache.ResponseCache), every request is looked up in the
+    cache first; account_id is part of the cache key.
     '''
-    result = list()
-    if aws_client is not None:
+    result = dict()
+    if start_timestamp is None:
+        start_timestamp = _get_start_timestamp()
+    if end_timestamp is None:
+        end_timestamp = _get_end_timestamp()
+    if response_cache is None:
+        response_cache = get_default_response_cache(log_wrapper=log_wrapper)
+    metrics_per_request = max(1, max_queries_per_request // len(statistics))
+    for chunk_start in range(0, len(metric_queries), metrics_per_request):
+        chunk = metric_queries[chunk_start:chunk_start+metrics_per_request]
         try:
-            if next_token is not None:
-                response = aws_client.describe_instances(
-                    MaxResults=max_results_per_iteration,
-                    NextToken=next_token
-                )
+            log_wrapper.info(message='Retrieving metric data for {} metrics in {} queries'.format(len(chunk), len(chunk) * len(statistics)))
+            chunk_datapoints = _get_metric_data_chunk_cached(
+                aws_client=aws_client,
+                chunk=chunk,
+                start_timestamp=start_timestamp,
+                end_timestamp=end_timestamp,
+                period=period,
+                statistics=statistics,
+                account_id=account_id,
+                response_cache=response_cache
+            )
+            for metric_query, datapoints in zip(chunk, chunk_datapoints):
+                unit = AWS_CLOUDWATCH_METRIC_UNITS.get(metric_query[0], dict()).get(metric_query[2], None)
+                if unit is not None:
+                    for datapoint in datapoints:
+                        datapoint['Unit'] = unit
+                result[metric_query] = datapoints
+        except:
+            log_wrapper.error(message='EXCEPTION: {}'.format(traceback.format_exc()))
+    log_wrapper.info(message='Metric data retrieved for {} of {} metrics'.format(len(result), len(metric_queries)))
+    return result
+
+
+def get_high_water_mark_start_timestamp(
+    high_water_marks: dict,
+    instance,
+    metric_name: str,
+    start_timestamp: datetime
+)->datetime:
+    '''Return the timestamp from which the datapoints of a metric still have
+    to be retrieved: the last stored datapoint of the metric (it is retrieved
+    again as it may have been incomplete when stored), limited to the
+    CloudWatch retention, or start_timestamp when nothing was stored yet.
+    The result is always a UTC aware datetime (see to_utc_datetime()).
+    '''
+    if high_water_marks is None:
+        return to_utc_datetime(timestamp=start_timestamp)
+    key = (instance.account_id, instance.instance_class, instance.region, instance.instance_id, metric_name)
+    if key not in high_water_marks:
+        return to_utc_datetime(timestamp=start_timestamp)
+    high_water_mark = datetime.fromtimestamp(high_water_marks[key], tz=timezone.utc)
+    oldest_timestamp = datetime.now(tz=timezone.utc) - timedelta(seconds=MAX_INCREMENTAL_LOOKBACK)
+    return max(high_water_mark, oldest_timestamp)
+
+
+def group_start_timestamps(start_timestamps, max_spread: float)->dict:
+    '''Map every start timestamp to the first start timestamp of its group.
+    The sorted timestamps are grouped so that every timestamp of a group is
+    less than max_spread seconds after the first one.'''
+    groups = dict()
+    group_start_timestamp = None
+    for start_timestamp in sorted(set(start_timestamps)):
+        if group_start_timestamp is None or (start_timestamp - group_start_timestamp).total_seconds() >= max_spread:
+            group_start_timestamp = start_timestamp
+        groups[start_timestamp] = group_start_timestamp
+    return groups
+
+
+def collect_instance_metric_statistics(
+    instances: list,
+    service_name: str='ec2',
+    region: str='us-east-1',
+    use_metric_data: bool=True,
+    target_profile: str=None,
+    client_pool: AwsClientPool=None,
+    start_timestamp: datetime=None,
+    end_timestamp: datetime=None,
+    high_water_marks: dict=None,
+    use_metric_index: bool=True,
+    period: int=DEFAULT_PERIOD,
+    statistics: tuple=DEFAULT_STATISTICS,
+    log_wrapper=LogWrapper()
+):
+    '''Discover the metrics of every instance and populate their
+    metric_statistics.
+
+    With use_metric_index, the metrics of the instances are looked up in an
+    index of the whole namespace in the region, built with one list_metrics
+    sweep and cached for all pages (see metric_index.MetricIndexCache).
+    Otherwise, or when the index could not be built, list_metrics is called
+    for every instance. It is also called for every instance that is not in
+    an index built before this call, such as an instance launched since.
+
+    With use_metric_data, the statistics of all the instances are retrieved
+    with batched GetMetricData requests and any metric the batch could not
+    retrieve falls back to one get_metric_statistics call per metric.
+
+    Every one of these requests goes through the process wide response cache
+    (see response_cache.ResponseCache) when it is enabled.
+
+    The statistics (standard statistics and/or percentiles) are retrieved
+    with the given period from start_timestamp to end_timestamp (by default
+    the whole of yesterday, UTC). For incremental collection,
+    high_water_marks maps (account_id, instance_class, region, instance_id,
+    metric_name) to the epoch timestamp of the last stored datapoint, and those metrics are
+    only retrieved from that timestamp onwards. So that metrics with
+    different high water marks still share requests, start timestamps less
+    than START_TIMESTAMP_GROUP_PERIODS periods apart are lowered to the
+    earliest of them (see group_start_timestamps()); the datapoints that are
+    retrieved again replace the stored ones.
+    '''
+    if len(instances) == 0:
+        return
+    cloudwatch_client = get_service_client_default(service='cloudwatch', region=region, target_profile=target_profile, client_pool=client_pool, log_wrapper=log_wrapper)
+    if start_timestamp is None:
+        start_timestamp = _get_start_timestamp()
+    if end_timestamp is None:
+        end_timestamp = _get_end_timestamp()
+    account_id = instances[0].account_id
+    response_cache = get_default_response_cache(log_wrapper=log_wrapper)
+    profiler = get_default_profiler(log_wrapper=log_wrapper)
+    with profiler.phase(name='metric_discovery'):
+        discovery_start_time = time.monotonic()
+        metric_index = None
+        if use_metric_index is True and cloudwatch_client is not None:
+            metric_index = get_default_metric_index_cache(log_wrapper=log_wrapper).get_index(
+                aws_client=cloudwatch_client,
+                account=target_profile,
+                region=region,
+                namespace=AWS_CLOUDWATCH_NAMESPACE_MAPPING[service_name],
+                dimension_name=AWS_CLOUDWATCH_DIMENSION_NAME_MAPPING[service_name],
+                account_id=account_id,
+                response_cache=response_cache
+            )
+        metric_start_timestamps = dict()
+        index_misses = 0
+        for instance in instances:
+            # An index built before this page may not know instances launched since; those are listed one by one
+            if metric_index is not None and (metric_index.has_resource(dimension_value=instance.instance_id) is True or metric_index.build_time >= discovery_start_time):
+                instance.metrics = metric_index.get_metrics(dimension_value=instance.instance_id)
             else:
-                response = aws_client.describe_instances(
-                    MaxResults=max_results_per_iteration
+                if metric_index is not None:
+                    index_misses += 1
+                instance.metrics = get_instance_cloudwatch_metrics(
+                    aws_client=cloudwatch_client,
+                    instance_id=instance.instance_id,
+                    service_name=service_name,
+                    next_token=None,
+                    account_id=instance.account_id,
+                    log_wrapper=log_wrapper
                 )
-            ### Main processing ###
+            for metric in instance.metrics:
+                metric_query = (service_name, instance.instance_id, metric)
+                metric_start_timestamp = get_high_water_mark_start_timestamp(
+                    high_water_marks=high_water_marks,
+                    instance=instance,
+                    metric_name=metric,
+                    start_timestamp=start_timestamp
+                )
+                metric_start_timestamps[metric_query] = metric_start_timestamp
+        group_starts = group_start_timestamps(start_timestamps=metric_start_timestamps.values(), max_spread=period * START_TIMESTAMP_GROUP_PERIODS)
+        metric_queries_by_start_timestamp = dict()
+        for metric_query in metric_start_timestamps:
+            metric_start_timestamps[metric_query] = group_starts[metric_start_timestamps[metric_query]]
+            metric_queries_by_start_timestamp.setdefault(metric_start_timestamps[metric_query], list()).append(metric_query)
+        if index_misses > 0:
+            log_wrapper.info(message='{} of {} instances were not in the metric index of "{}"; their metrics were listed per instance'.format(index_misses, len(instances), AWS_CLOUDWATCH_NAMESPACE_MAPPING[service_name]))
+    with profiler.phase(name='metric_retrieval'):
+        batched_statistics = dict()
+        if use_metric_data is True and cloudwatch_client is not None:
+            for metric_start_timestamp, metric_queries in metric_queries_by_start_timestamp.items():
+                batched_statistics.update(
+                    get_metric_data_batched(
+                        aws_client=cloudwatch_client,
+                        metric_queries=metric_queries,
+                        start_timestamp=metric_start_timestamp,
+                        end_timestamp=end_timestamp,
+                        period=period,
+                        statistics=statistics,
+                        account_id=account_id,
+                        response_cache=response_cache,
+                        log_wrapper=log_wrapper
+                    )
+                )
+        for instance in instances:
+            for metric in instance.metrics:
+                metric_query = (service_name, instance.instance_id, metric)
+                if metric_query in batched_statistics:
+                    instance.metric_statistics[metric] = MetricSeries.from_datapoints(datapoints=batched_statistics[metric_query])
+                else:
+                    metric_statistics = get_instance_metric_statistics(
+                        aws_client=cloudwatch_client,
+                        instance_id=instance.instance_id,
+                        service_name=service_name,
+                        metric_name=metric,
+                        start_timestamp=metric_start_timestamps[metric_query],
+                        end_timestamp=end_timestamp,
+                        period=period,
+                        statistics=statistics,
+                        account_id=instance.account_id,
+                        log_wrapper=log_wrapper
+                    )
+                    instance.metric_statistics[metric] = MetricSeries.from_datapoints(datapoints=metric_statistics[metric])
+
+
+def iter_cached_pages(aws_client, operation: str, paginate_kwargs: dict, account_id: str=None, response_cache: ResponseCache=None):
+    '''Yield the pages of aws_client.get_paginator(operation).paginate(**paginate_kwargs).
+
+    When response_cache is enabled, every page is cached by the request and
+    its page number and reused for its recent_ttl; account_id is part of the
+    cache key. The pages are cached as JSON, so the timestamps in them (such
+    as LaunchTime) are strings. When a page is not cached, the paginator is
+    started again and skips the pages that were already yielded (caching
+    them again); offline, an exception is raised instead.
+    '''
+    paginator = aws_client.get_paginator(operation)
+    if response_cache is None or response_cache.is_enabled() is False:
+        for response in paginator.paginate(**paginate_kwargs):
+            yield response
+        return
+    request = {'Operation': aws_client.meta.method_to_api_mapping[operation], 'AccountId': account_id, 'Region': aws_client.meta.region_name}
+    request.update(paginate_kwargs)
+    page_number = 0
+    while True:
+        entry = response_cache.get(request=dict(request, Page=page_number))
+        if entry is None:
+            break
+        if entry['Response'] is None:     # Cached after the last page
+            return
+        yield entry['Response']
+        page_number += 1
+    if response_cache.offline is True:
+        raise Exception('Page {} of {} is not cached and the response cache is offline'.format(page_number, request))
+    expires = response_cache.get_expires()
+    fetched_page_number = 0
+    for response in paginator.paginate(**paginate_kwargs):
+        response.pop('ResponseMetadata', None)
+        response = json.loads(json.dumps(response, default=str))
+        response_cache.put(request=dict(request, Page=fetched_page_number), response={'Response': response}, expires=expires)
+        if fetched_page_number >= page_number:
+            yield response
+        fetched_page_number += 1
+    response_cache.put(request=dict(request, Page=fetched_page_number), response={'Response': None}, expires=expires)
+
+
+def iter_ec2_instances(
+    aws_client, 
+    next_token: str=None, 
+    page_size: int=MAX_RESULTS_DEFAULT, 
+    use_metric_data: bool=True,
+    target_profile: str=None,
+    client_pool: AwsClientPool=None,
+    start_timestamp: datetime=None,
+    end_timestamp: datetime=None,
+    high_water_marks: dict=None,
+    use_metric_index: bool=True,
+    period: int=DEFAULT_PERIOD,
+    statistics: tuple=DEFAULT_STATISTICS,
+    keep_raw_instance_data: bool=False,
+    instance_filter: InstanceFilter=None,
+    log_wrapper=LogWrapper()
+):
+    '''Using a boto3 paginator (see iter_cached_pages()), yield a AwsEC2Instance for each EC2 instance
+    with its metric statistics. The metric statistics are collected per page
+    of page_size instances, so only one page is held in memory at a time.
+    '''
+    if aws_client is None:
+        log_wrapper.warning(message='No EC2 instances were fetched because the aws_client was not defined - failing gracefully...')
+        return
+    try:
+        account_id = get_account_id(target_profile=target_profile, client_pool=client_pool, log_wrapper=log_wrapper)
+        if instance_filter is None:
+            instance_filter = InstanceFilter()
+        pagination_config = {'PageSize': page_size}
+        if next_token is not None:
+            pagination_config['StartingToken'] = next_token
+        paginate_kwargs = {'PaginationConfig': pagination_config}
+        describe_filters = instance_filter.get_describe_filters(service='ec2')
+        if len(describe_filters) > 0:
+            paginate_kwargs['Filters'] = describe_filters
+        pages = iter_cached_pages(
+            aws_client=aws_client,
+            operation='describe_instances',
+            paginate_kwargs=paginate_kwargs,
+            account_id=account_id,
+            response_cache=get_default_response_cache(log_wrapper=log_wrapper)
+        )
+        for response in pages:
+            page_instances = list()
             if 'Reservations' in response:
                 for reservation in response['Reservations']:
                     if 'Instances' in reservation:
                         for instance_data in reservation['Instances']:
                             ec2instance = AwsEC2Instance(log_wrapper=log_wrapper)
-                            ec2instance.store_raw_instance_data(instance_data=instance_data)
-                            if ec2instance.raw_instance_data is not None:
+                            ec2instance.store_raw_instance_data(instance_data=instance_data, keep_raw_instance_data=keep_raw_instance_data)
+                            if ec2instance.is_valid() is True and instance_filter.matches(instance=ec2instance) is True:
+                                ec2instance.account_id = account_id
                                 ec2instance.region = aws_client.meta.region_name
-                                ec2instance.metrics = get_instance_cloudwatch_metrics(
-                                    aws_client=get_service_client_default(service='cloudwatch', region=aws_client.meta.region_name),
-                                    instance_id=ec2instance.instance_id,
-                                    service_name='ec2',
-                                    next_token=None,
-                                    log_wrapper=log_wrapper
-                                )
-                                if len(ec2instance.metrics) > 0:
-                                    for metric in ec2instance.metrics:
-                                        metric_statistics = get_instance_metric_statistics(
-                                            aws_client=get_service_client_default(service='cloudwatch', region=aws_client.meta.region_name),
-                                            instance_id=ec2instance.instance_id,
-                                            service_name='ec2',
-                                            metric_name=metric,
-                                            start_timestamp=_get_start_timestamp(),
-                                            end_timestamp=_get_end_timestamp(),
-                                            period=300,
-                                            log_wrapper=log_wrapper
-                                        )
-                                        ec2instance.metric_statistics[metric] = metric_statistics[metric]
-                                result.append(ec2instance)
-
-            ### end main processing ###
-            if 'NextToken' in response:
-                if isinstance(response['NextToken'], str):
-                    if len(response['NextToken']) > 0:
-                        next_result = get_ec2_instances(
-                            aws_client=aws_client, 
-                            next_token=response['NextToken'], 
-                            max_results_per_iteration=max_results_per_iteration, 
-                            log_wrapper=log_wrapper
-                        )
-                        result = result + next_result
-        except:
-            log_wrapper.error(message='EXCEPTION: {}'.format(traceback.format_exc()))
-    else:
-        log_wrapper.warning(message='No EC2 instances were fetched because the aws_client was not defined - failing gracefully...')
-    return result
+                                page_instances.append(ec2instance)
+            collect_instance_metric_statistics(
+                instances=[ec2instance for ec2instance in page_instances if instance_filter.collect_metrics(instance=ec2instance) is True],
+                service_name='ec2',
+                region=aws_client.meta.region_name,
+                use_metric_data=use_metric_data,
+                target_profile=target_profile,
+                client_pool=client_pool,
+                start_timestamp=start_timestamp,
+                end_timestamp=end_timestamp,
+                high_water_marks=high_water_marks,
+                use_metric_index=use_metric_index,
+                period=period,
+                statistics=statistics,
+                log_wrapper=log_wrapper
+            )
+            get_default_profiler(log_wrapper=log_wrapper).count(name='ec2_instances', value=len(page_instances))
+            for ec2instance in page_instances:
+                yield ec2instance
+    except:
+        log_wrapper.error(message='EXCEPTION: {}'.format(traceback.format_exc()))
+
+
+def get_ec2_instances(
+    aws_client, 
+    next_token: str=None, 
+    max_results_per_iteration: int=MAX_RESULTS_DEFAULT, 
+    use_metric_data: bool=True,
+    target_profile: str=None,
+    client_pool: AwsClientPool=None,
+    start_timestamp: datetime=None,
+    end_timestamp: datetime=None,
+    high_water_marks: dict=None,
+    use_metric_index: bool=True,
+    period: int=DEFAULT_PERIOD,
+    statistics: tuple=DEFAULT_STATISTICS,
+    keep_raw_instance_data: bool=False,
+    instance_filter: InstanceFilter=None,
+    log_wrapper=LogWrapper()
+)->list:
+    '''Using boto3, get the list of EC2 instances and create a AwsEC2Instance 
+    instance of each, storing the collection in a result which is then returned.
+    '''
+    return list(
+        iter_ec2_instances(
+            aws_client=aws_client,
+            next_token=next_token,
+            page_size=max_results_per_iteration,
+            use_metric_data=use_metric_data,
+            target_profile=target_profile,
+            client_pool=client_pool,
+            start_timestamp=start_timestamp,
+            end_timestamp=end_timestamp,
+            high_water_marks=high_water_marks,
+            use_metric_index=use_metric_index,
+            period=period,
+            statistics=statistics,
+            keep_raw_instance_data=keep_raw_instance_data,
+            instance_filter=instance_filter,
+            log_wrapper=log_wrapper
+        )
+    )
+
+
+def _list_rds_instance_tags(aws_client, db_instance_arn: str)->dict:
+    tags = dict()
+    response = aws_client.list_tags_for_resource(ResourceName=db_instance_arn)
+    if 'TagList' in response:
+        for tag in response['TagList']:
+            if 'Key' in tag and 'Value' in tag:
+                tags[tag['Key']] = tag['Value']
+    return tags
 
 
 def get_rds_instance_tags(aws_client, db_instance_arn: str, log_wrapper=LogWrapper())->dict:
     tags = dict()
     try:
         log_wrapper.info(message='Retrieving tags for RDS instance "{}"'.format(db_instance_arn))
-        response = aws_client.list_tags_for_resource(ResourceName=db_instance_arn)
-        if 'TagList' in response:
-            for tag in response['TagList']:
-                if 'Key' in tag and 'Value' in tag:
-                    tags[tag['Key']] = tag['Value']
-
+        tags = _list_rds_instance_tags(aws_client=aws_client, db_instance_arn=db_instance_arn)
     except:
         log_wrapper.error(message='EXCEPTION: {}'.format(traceback.format_exc()))
     return tags
 
 
+def get_rds_instances_tags(
+    aws_client,
+    db_instance_arns: list,
+    max_workers: int=MAX_TAG_LOOKUP_WORKERS,
+    tag_cache: TagCache=None,
+    response_cache: ResponseCache=None,
+    log_wrapper=LogWrapper()
+)->dict:
+    '''Return the tags of a batch of RDS instances as {arn: tags}. Tags that
+    are in the tag cache are not looked up again; the others are retrieved
+    with concurrent list_tags_for_resource requests and added to the cache.
+    When a lookup fails, the instance gets no tags and is not cached, so it is
+    retried on the next run. When the response cache (by default the process
+    wide cache) is offline, only the tag cache is used.
+    '''
+    if tag_cache is None:
+        tag_cache = get_default_tag_cache(log_wrapper=log_wrapper)
+    if response_cache is None:
+        response_cache = get_default_response_cache(log_wrapper=log_wrapper)
+    tags_by_arn = dict()
+    uncached_arns = list()
+    for db_instance_arn in db_instance_arns:
+        tags = tag_cache.get(arn=db_instance_arn)
+        if tags is not None:
+            tags_by_arn[db_instance_arn] = tags
+        else:
+            uncached_arns.append(db_instance_arn)
+    if len(uncached_arns) == 0:
+        return tags_by_arn
+    if response_cache.offline is True:
+        log_wrapper.warning(message='The tags of {} RDS instances are not cached and the response cache is offline'.format(len(uncached_arns)))
+        for db_instance_arn in uncached_arns:
+            tags_by_arn[db_instance_arn] = dict()
+        return tags_by_arn
+    log_wrapper.info(message='Retrieving tags for {} RDS instances ({} cached)'.format(len(uncached_arns), len(tags_by_arn)))
+    retrieved_tags = dict()
+    with get_default_profiler(log_wrapper=log_wrapper).phase(name='rds_tag_lookup'), ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(uncached_arns)))) as executor:
+        futures = dict()
+        for db_instance_arn in uncached_arns:
+            futures[executor.submit(_list_rds_instance_tags, aws_client=aws_client, db_instance_arn=db_instance_arn)] = db_instance_arn
+        for future in as_completed(futures):
+            db_instance_arn = futures[future]
+            try:
+                retrieved_tags[db_instance_arn] = future.result()
+            except:
+                log_wrapper.error(message='EXCEPTION retrieving the tags of "{}": {}'.format(db_instance_arn, traceback.format_exc()))
+                tags_by_arn[db_instance_arn] = dict()
+    tag_cache.put_many(tags_by_arn=retrieved_tags)
+    tags_by_arn.update(retrieved_tags)
+    return tags_by_arn
+
+
+def iter_rds_instances(
+    aws_client, 
+    next_token: str=None, 
+    page_size: int=MAX_RESULTS_DEFAULT, 
+    use_metric_data: bool=True,
+    target_profile: str=None,
+    client_pool: AwsClientPool=None,
+    start_timestamp: datetime=None,
+    end_timestamp: datetime=None,
+    high_water_marks: dict=None,
+    use_metric_index: bool=True,
+    period: int=DEFAULT_PERIOD,
+    statistics: tuple=DEFAULT_STATISTICS,
+    keep_raw_instance_data: bool=False,
+    instance_filter: InstanceFilter=None,
+    log_wrapper=LogWrapper()
+):
+    '''Using a boto3 paginator (see iter_cached_pages()), yield a AwsRDSInstance for each RDS instance
+    with its tags and metric statistics. The metric statistics are collected
+    per page of page_size instances (at most MAX_RDS_PAGE_SIZE), so only one
+    page is held in memory at a time.
+    '''
+    if aws_client is None:
+        log_wrapper.warning(message='No RDS instances were fetched because the aws_client was not defined - failing gracefully...')
+        return
+    try:
+        account_id = get_account_id(target_profile=target_profile, client_pool=client_pool, log_wrapper=log_wrapper)
+        if instance_filter is None:
+            instance_filter = InstanceFilter()
+        pagination_config = {'PageSize': min(page_size, MAX_RDS_PAGE_SIZE)}
+        if next_token is not None:
+            pagination_config['StartingToken'] = next_token
+        paginate_kwargs = {'PaginationConfig': pagination_config}
+        describe_filters = instance_filter.get_describe_filters(service='rds')
+        if len(describe_filters) > 0:
+            paginate_kwargs['Filters'] = describe_filters
+        pages = iter_cached_pages(
+            aws_client=aws_client,
+            operation='describe_db_instances',
+            paginate_kwargs=paginate_kwargs,
+            account_id=account_id,
+            response_cache=get_default_response_cache(log_wrapper=log_wrapper)
+        )
+        for response in pages:
+            page_instances = list()
+            untagged_instances = dict()
+            if 'DBInstances' in response:
+                for db_instance_data in response['DBInstances']:
+                    rds_instance = AwsRDSInstance(log_wrapper=log_wrapper)
+                    rds_instance.store_raw_instance_data(instance_data=db_instance_data, keep_raw_instance_data=keep_raw_instance_data)
+                    if rds_instance.is_valid() is False or instance_filter.matches_state(instance=rds_instance) is False:
+                        continue
+                    rds_instance.account_id = account_id
+                    rds_instance.region = aws_client.meta.region_name
+                    if 'TagList' not in db_instance_data:   # Older API responses do not embed the tags
+                        if 'DBInstanceArn' in db_instance_data:
+                            untagged_instances[db_instance_data['DBInstanceArn']] = rds_instance
+                        else:
+                            log_wrapper.warning(message='The data set did not contain an ARN - tags will NOT be retrieved.')
+                    page_instances.append(rds_instance)
+            if len(untagged_instances) > 0:
+                tags_by_arn = get_rds_instances_tags(aws_client=aws_client, db_instance_arns=list(untagged_instances.keys()), log_wrapper=log_wrapper)
+                for db_instance_arn, rds_instance in untagged_instances.items():
+                    rds_instance.tags = tags_by_arn.get(db_instance_arn, dict())
+            page_instances = [rds_instance for rds_instance in page_instances if instance_filter.matches_tags(instance=rds_instance) is True]
+            collect_instance_metric_statistics(
+                instances=[rds_instance for rds_instance in page_instances if instance_filter.collect_metrics(instance=rds_instance) is True],
+                service_name='rds',
+                region=aws_client.meta.region_name,
+                use_metric_data=use_metric_data,
+                target_profile=target_profile,
+                client_pool=client_pool,
+                start_timestamp=start_timestamp,
+                end_timestamp=end_timestamp,
+                high_water_marks=high_water_marks,
+                use_metric_index=use_metric_index,
+                period=period,
+                statistics=statistics,
+                log_wrapper=log_wrapper
+            )
+            get_default_profiler(log_wrapper=log_wrapper).count(name='rds_instances', value=len(page_instances))
+            for rds_instance in page_instances:
+                yield rds_instance
+    except:
+        log_wrapper.error(message='EXCEPTION: {}'.format(traceback.format_exc()))
+
+
 def get_rds_instances(
     aws_client, 
     next_token: str=None, 
     max_results_per_iteration: int=MAX_RESULTS_DEFAULT, 
+    use_metric_data: bool=True,
+    target_profile: str=None,
+    client_pool: AwsClientPool=None,
+    start_timestamp: datetime=None,
+    end_timestamp: datetime=None,
+    high_water_marks: dict=None,
+    use_metric_index: bool=True,
+    period: int=DEFAULT_PERIOD,
+    statistics: tuple=DEFAULT_STATISTICS,
+    keep_raw_instance_data: bool=False,
+    instance_filter: InstanceFilter=None,
     log_wrapper=LogWrapper()
 )->list:
     '''Using boto3, get the list of RDS instances and create a AwsRDSInstance 
     instance of each, storing the collection in a result which is then returned.
     '''
-    result = list()
-    if aws_client is not None:
-        try:
-            if next_token is not None:
-                response = aws_client.describe_db_instances(
-                    MaxRecords=max_results_per_iteration,
-                    Marker=next_token
-                )
-            else:
-                response = aws_client.describe_db_instances(
-                    MaxRecords=max_results_per_iteration
-                )
-            ### Main processing ###
+    return list(
+        iter_rds_instances(
+            aws_client=aws_client,
+            next_token=next_token,
+            page_size=max_results_per_iteration,
+            use_metric_data=use_metric_data,
+            target_profile=target_profile,
+            client_pool=client_pool,
+            start_timestamp=start_timestamp,
+            end_timestamp=end_timestamp,
+            high_water_marks=high_water_marks,
+            use_metric_index=use_metric_index,
+            period=period,
+            statistics=statistics,
+            keep_raw_instance_data=keep_raw_instance_data,
+            instance_filter=instance_filter,
+            log_wrapper=log_wrapper
+        )
+    )
 
-            if 'DBInstances' in response:
-                for db_instance_data in response['DBInstances']:
-                    rds_instance = AwsRDSInstance(log_wrapper=log_wrapper)
-                    rds_instance.store_raw_instance_data(instance_data=db_instance_data)
-                    if 'DBInstanceArn' in db_instance_data:
-                        rds_instance.tags = get_rds_instance_tags(aws_client=aws_client, db_instance_arn=db_instance_data['DBInstanceArn'], log_wrapper=log_wrapper)
-                    else:
-                        log_wrapper.warning(message='The data set did not contain an ARN - tags will NOT be retrieved.')
-                    if rds_instance.raw_instance_data is not None:
-                        rds_instance.region = aws_client.meta.region_name
-                        rds_instance.metrics = get_instance_cloudwatch_metrics(
-                            aws_client=get_service_client_default(service='cloudwatch', region=aws_client.meta.region_name),
-                            instance_id=rds_instance.instance_id,
-                            service_name='rds',
-                            next_token=None,
-                            log_wrapper=log_wrapper
-                        )
-                        if len(rds_instance.metrics) > 0:
-                            for metric in rds_instance.metrics:
-                                metric_statistics = get_instance_metric_statistics(
-                                    aws_client=get_service_client_default(service='cloudwatch', region=aws_client.meta.region_name),
-                                    instance_id=rds_instance.instance_id,
-                                    service_name='rds',
-                                    metric_name=metric,
-                                    start_timestamp=_get_start_timestamp(),
-                                    end_timestamp=_get_end_timestamp(),
-                                    period=300,
-                                    log_wrapper=log_wrapper
-                                )
-                                rds_instance.metric_statistics[metric] = metric_statistics[metric]
-                        result.append(rds_instance)
-
-            ### end main processing ###
-            if 'Marker' in response:
-                if isinstance(response['Marker'], str):
-                    if len(response['Marker']) > 0:
-                        next_result = get_rds_instances(
-                            aws_client=aws_client, 
-                            next_token=response['Marker'], 
-                            max_results_per_iteration=max_results_per_iteration, 
-                            log_wrapper=log_wrapper
-                        )
-                        result = result + next_result
-        except:
-            log_wrapper.error(message='EXCEPTION: {}'.format(traceback.format_exc()))
-    else:
-        log_wrapper.warning(message='No RDS instances were fetched because the aws_client was not defined - failing gracefully...')
-    return result
+
+def collect_service_region_instances(
+    service: str='ec2',
+    region: str='us-east-1',
+    target_profile: str=None,
+    use_metric_data: bool=True,
+    client_pool: AwsClientPool=None,
+    start_timestamp: datetime=None,
+    end_timestamp: datetime=None,
+    high_water_marks: dict=None,
+    use_metric_index: bool=True,
+    period: int=DEFAULT_PERIOD,
+    statistics: tuple=DEFAULT_STATISTICS,
+    page_size: int=MAX_RESULTS_DEFAULT,
+    instance_handler=None,
+    keep_instances: bool=True,
+    keep_raw_instance_data: bool=False,
+    instance_filter: InstanceFilter=None,
+    log_wrapper=LogWrapper()
+)->list:
+    '''Collect the instances of a service in a region. Each instance is
+    passed to instance_handler (when set) as soon as its metric statistics are
+    collected, and is only kept in the returned list when keep_instances is
+    True.'''
+    log_wrapper.info('Now checking region "{}"'.format(region))
+    client = get_service_client_default(service=service, region=region, target_profile=target_profile, client_pool=client_pool, log_wrapper=log_wrapper)
+    instances = list()
+    instance_iterator = list()
+    if service == 'ec2':
+        instance_iterator = iter_ec2_instances(
+            aws_client=client,
+            page_size=page_size,
+            use_metric_data=use_metric_data,
+            target_profile=target_profile,
+            client_pool=client_pool,
+            start_timestamp=start_timestamp,
+            end_timestamp=end_timestamp,
+            high_water_marks=high_water_marks,
+            use_metric_index=use_metric_index,
+            period=period,
+            statistics=statistics,
+            keep_raw_instance_data=keep_raw_instance_data,
+            instance_filter=instance_filter,
+            log_wrapper=log_wrapper
+        )
+    if service == 'rds':
+        instance_iterator = iter_rds_instances(
+            aws_client=client,
+            page_size=page_size,
+            use_metric_data=use_metric_data,
+            target_profile=target_profile,
+            client_pool=client_pool,
+            start_timestamp=start_timestamp,
+            end_timestamp=end_timestamp,
+            high_water_marks=high_water_marks,
+            use_metric_index=use_metric_index,
+            period=period,
+            statistics=statistics,
+            keep_raw_instance_data=keep_raw_instance_data,
+            instance_filter=instance_filter,
+            log_wrapper=log_wrapper
+        )
+    instance_count = 0
+    for instance in instance_iterator:
+        instance_count += 1
+        if instance_handler is not None:
+            try:
+                instance_handler(instance)
+            except:
+                log_wrapper.error(message='EXCEPTION: {}'.format(traceback.format_exc()))
+        if keep_instances is True:
+            instances.append(instance)
+    log_wrapper.info('Added {} instances'.format(instance_count))
+    return instances
+
+
+def _collect_service_region_instances_limited(region_semaphore: threading.Semaphore, **kwargs)->list:
+    with region_semaphore:
+        return _collect_service_region_instances_tracked(**kwargs)
+
+
+def _collect_service_region_instances_tracked(**kwargs)->list:
+    collection_progress = get_default_collection_progress()
+    collection_progress.start_task()
+    try:
+        return collect_service_region_instances(**kwargs)
+    finally:
+        collection_progress.finish_task()
 
 
 def collect_aws_instance_data(
@@ -402,34 +1390,136 @@ def collect_aws_instance_data(
     all_regions: bool=True,
     regions: list=None,
     target_profile: str=None,
+    use_metric_data: bool=True,
+    max_workers: int=1,
+    max_workers_per_region: int=None,
+    client_pool: AwsClientPool=None,
+    start_timestamp: datetime=None,
+    end_timestamp: datetime=None,
+    high_water_marks: dict=None,
+    use_metric_index: bool=True,
+    period: int=DEFAULT_PERIOD,
+    statistics: tuple=DEFAULT_STATISTICS,
+    page_size: int=MAX_RESULTS_DEFAULT,
+    instance_handler=None,
+    keep_instances: bool=True,
+    target_profiles: list=None,
+    keep_raw_instance_data: bool=False,
+    instance_filter: InstanceFilter=None,
     log_wrapper=LogWrapper()
 )->AWSInstanceCollection:
+    '''Collect the instances and metric statistics of every service in every
+    selected region.
+
+    To collect from several AWS accounts, pass a list of profile names and/or
+    IAM role ARNs as target_profiles (target_profile is then ignored). Every
+    instance has the account_id of the account it was collected from.
+
+    With max_workers greater than 1, the (account, service, region)
+    combinations are collected concurrently in a thread pool of that size.
+    The optional max_workers_per_region limits how many of those tasks may
+    target the same region of the same account at the same time. All clients
+    come from client_pool, or the process wide default pool when it is None.
+    Log messages of every task are prefixed with the service and region (and
+    the account when there are several) it is working on.
+
+    Every collected instance is passed to instance_handler (when set), which
+    may be called from several threads at once. To stream the instances to a
+    file or database without keeping them all in memory, set keep_instances
+    to False; the returned collection is then empty.
+
+    The metric statistics are retrieved with the given period and statistics
+    (for example ('Average', 'Maximum', 'p99')) from start_timestamp to
+    end_timestamp, by default the whole of yesterday (UTC). Naive datetimes
+    are taken as UTC.
+
+    The describe result of every instance is dropped once its fields are
+    extracted, unless keep_raw_instance_data is True (it is then available
+    as the raw_instance_data of the instance).
+
+    Pass an InstanceFilter (see filters.py) as instance_filter to only
+    collect instances in certain states or with certain tags, and optionally
+    to skip the metrics of instances that are not running.
+    '''
     instance_data_collection = AWSInstanceCollection(log_wrapper=log_wrapper)
     try:
+        validate_period(period=period)
+        if target_profiles is None or len(target_profiles) == 0:
+            target_profiles = [target_profile,]
+        tasks = list()
         for service in services:
+            service_regions = regions
             if all_regions is True:
-                regions = get_regions_by_service(service=service, log_wrapper=log_wrapper)
-            log_wrapper.info('Checking regions: {}'.format(regions))
-            for region in regions:
-                log_wrapper.info('Now checking region "{}"'.format(region))
-                client = get_service_client_default(service=service, region=region, target_profile=target_profile, log_wrapper=log_wrapper)
-                instances = list()
-                if service == 'ec2':
-                    instances = get_ec2_instances(
-                        aws_client=client,
-                        log_wrapper=log_wrapper
-                    )
-                if service == 'rds':
-                    instances = get_rds_instances(
-                        aws_client=client,
-                        log_wrapper=log_wrapper
+                service_regions = get_regions_by_service(service=service, log_wrapper=log_wrapper)
+            log_wrapper.info('Checking regions for service "{}": {}'.format(service, service_regions))
+            for profile in target_profiles:
+                for region in service_regions:
+                    task_context = '{}/{}'.format(service, region)
+                    if len(target_profiles) > 1:
+                        task_context = '{}/{}'.format(profile if profile is not None else 'default', task_context)
+                    tasks.append((profile, service, region, task_context))
+        get_default_collection_progress().add_tasks(task_count=len(tasks))
+        if max_workers is None or max_workers <= 1:
+            for profile, service, region, task_context in tasks:
+                instances = _collect_service_region_instances_tracked(
+                    service=service,
+                    region=region,
+                    target_profile=profile,
+                    use_metric_data=use_metric_data,
+                    client_pool=client_pool,
+                    start_timestamp=start_timestamp,
+                    end_timestamp=end_timestamp,
+                    high_water_marks=high_water_marks,
+                    use_metric_index=use_metric_index,
+                    period=period,
+                    statistics=statistics,
+                    page_size=page_size,
+                    instance_handler=instance_handler,
+                    keep_instances=keep_instances,
+                    keep_raw_instance_data=keep_raw_instance_data,
+                    instance_filter=instance_filter,
+                    log_wrapper=log_wrapper.with_context(task_context)
+                )
+                instance_data_collection.add_instances(instances=instances)
+        else:
+            region_semaphores = dict()
+            for profile, service, region, task_context in tasks:
+                if (profile, region) not in region_semaphores:
+                    region_semaphores[(profile, region)] = threading.Semaphore(max_workers_per_region if max_workers_per_region is not None else max_workers)
+            log_wrapper.info('Collecting {} account/service/region combinations with {} workers'.format(len(tasks), max_workers))
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = dict()
+                for profile, service, region, task_context in tasks:
+                    future = executor.submit(
+                        _collect_service_region_instances_limited,
+                        region_semaphore=region_semaphores[(profile, region)],
+                        service=service,
+                        region=region,
+                        target_profile=profile,
+                        use_metric_data=use_metric_data,
+                        client_pool=client_pool,
+                        start_timestamp=start_timestamp,
+                        end_timestamp=end_timestamp,
+                        high_water_marks=high_water_marks,
+                        use_metric_index=use_metric_index,
+                        period=period,
+                        statistics=statistics,
+                        page_size=page_size,
+                        instance_handler=instance_handler,
+                        keep_instances=keep_instances,
+                        keep_raw_instance_data=keep_raw_instance_data,
+                        instance_filter=instance_filter,
+                        log_wrapper=log_wrapper.with_context(task_context)
                     )
-                if len(instances) > 0:
-                    for instance in instances:
-                        instance_data_collection.instances.append(instance)
-                log_wrapper.info('Added {} instances'.format(len(instances)))
+                    futures[future] = task_context
+                for future in as_completed(futures):
+                    try:
+                        instance_data_collection.add_instances(instances=future.result())
+                    except:
+                        log_wrapper.error(message='EXCEPTION in "{}": {}'.format(futures[future], traceback.format_exc()))
     except:
         log_wrapper.error(message='EXCEPTION: {}'.format(traceback.format_exc()))
+    get_default_tag_cache(log_wrapper=log_wrapper).save()
     return instance_data_collection
 
 # EOF 
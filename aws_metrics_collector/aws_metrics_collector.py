@@ -1,36 +1,290 @@
+import functools
 import os
+import signal
+from datetime import datetime, timedelta, timezone
 from aws_metrics_collector import LogWrapper
-from aws_metrics_collector.aws import collect_aws_instance_data
-from aws_metrics_collector.utils import dict_to_json
+from aws_metrics_collector.analysis import summarize_instances, write_summary_csv
+from aws_metrics_collector.aws import collect_aws_instance_data, get_default_collection_progress
+from aws_metrics_collector.columnar import write_columnar_file
+from aws_metrics_collector.export import export_collection
+from aws_metrics_collector.filters import InstanceFilter
+from aws_metrics_collector.client_pool import configure_default_client_pool, shutdown_default_client_pool
+from aws_metrics_collector.profiling import configure_default_profiler, get_default_profiler, run_with_profiler
+from aws_metrics_collector.prometheus import PrometheusExporter
+from aws_metrics_collector.regions import configure_default_region_catalog
+from aws_metrics_collector.response_cache import configure_default_response_cache
+from aws_metrics_collector.scheduler import CollectionScheduler
+from aws_metrics_collector.sqlite_store import SQLiteStore
+from aws_metrics_collector.tag_cache import configure_default_tag_cache
+from aws_metrics_collector.throttling import get_default_rate_limiter
+from aws_metrics_collector.writers import NdjsonWriter, COMPRESSION_FILE_EXTENSIONS
 
 
 database_file = '{}{}aws_instance_metric_statistics.sqlite'.format(os.getcwd(), os.sep)
+store_in_database = True
+incremental_collection = False # Only retrieve datapoints newer than the last datapoints stored in the database
+incremental_initial_lookback = 86400   # Seconds of datapoints to retrieve for metrics not yet in the database
+collection_start_timestamp = None   # For example datetime(2020, 1, 1, tzinfo=timezone.utc) - None = the start of yesterday (UTC)
+collection_end_timestamp = None     # None = the end of yesterday, UTC (or now, with incremental_collection)
+metric_period = 300            # Seconds per datapoint: 1, 5, 10, 30 or a multiple of 60
+metric_statistics = ('Average', 'Maximum')  # Standard statistics and/or percentiles such as 'p99'
 dump_raw_json_to_file = True
 json_file = '{}{}data.json'.format(os.getcwd(), os.sep)
+json_compact = False           # Write data.json without indentation (much faster to serialize)
+json_export_workers = None     # Processes serializing data.json (None = one per CPU, 1 = in this process)
+json_partitioned = False       # Write data-00000.json, data-00001.json, ... (one complete document per shard) instead of data.json
+stream_to_ndjson = False       # Stream instances to ndjson_file while collecting instead of writing json_file at the end
+ndjson_file = '{}{}data.ndjson'.format(os.getcwd(), os.sep)    # The compression extension is added automatically
+ndjson_compression = None      # None, 'gzip' or 'zstd' (requires the zstandard package)
+ndjson_per_datapoint = False   # Write one line per datapoint instead of one line per instance
+columnar_file = None           # For example '{}{}data.parquet'.format(os.getcwd(), os.sep) - requires the pyarrow package
+columnar_format = 'parquet'    # 'parquet' or 'arrow' (Arrow IPC)
+summary_file = None            # For example '{}{}summary.csv'.format(os.getcwd(), os.sep) - p50/p95/p99/max and utilization flags per instance metric, requires the numpy package
 services = ['ec2', 'rds']
 all_regions = True
-regions = None
+regions = None                 # When all_regions is False, only these regions are used and no region lookups are done
+region_catalog_file = None     # For example '{}{}region_catalog.json'.format(os.getcwd(), os.sep) - persist the region catalog for faster starts
+region_catalog_ttl = 86400     # Seconds before the regions of a service are looked up again (None = never)
+rds_tag_cache_file = None      # For example '{}{}rds_tag_cache.json'.format(os.getcwd(), os.sep) - persist the RDS tags looked up with list_tags_for_resource, saved at the end of every collection
+rds_tag_cache_ttl = 3600       # Seconds before the tags of an RDS instance are looked up again (None = never)
+response_cache_dir = None      # For example '{}{}response_cache'.format(os.getcwd(), os.sep) - cache the describe, list_metrics and metric data responses on disk
+response_cache_max_size = 512 * 1024 * 1024    # Bytes of compressed responses to keep; the least recently used are removed first
+response_cache_ttl = 300       # Seconds a response of a time range that is not yet closed (or of describe and list_metrics) is reused
+response_cache_offline = False # Only use cached responses (also expired ones) and never call AWS
 target_profile = None
+target_profiles = None         # List of profile names and/or IAM role ARNs to collect from in parallel (overrides target_profile)
+role_source_profile = None     # Profile used to assume the roles in target_profiles (None = default credentials)
+use_get_metric_data = True     # Set to False to retrieve each metric with a get_metric_statistics call
+use_metric_index = True        # Discover the metrics of all instances with one list_metrics sweep per region and namespace
+max_workers = 8                # Number of service/region combinations collected concurrently (1 = sequential)
+max_workers_per_region = 2     # Limit of concurrent tasks against the same region
+describe_page_size = 100       # Instances per describe page; metric statistics are collected one page at a time
+max_pool_connections = 10      # HTTP connections per AWS client, should be at least the number of concurrent users of a client
+max_api_attempts = 8           # Attempts of a throttled AWS API call before it fails
+ec2_instance_states = None     # For example ['running', 'stopped'] - None = all states
+rds_instance_states = None     # For example ['available'] - None = all states
+instance_tags = None           # Only collect instances with these tags, for example {'Environment': 'production', 'Team': ['a', 'b'], 'Owner': None}
+rds_engines = None             # For example ['postgres', 'mysql'] - None = all engines
+skip_metrics_when_not_running = False  # Do not retrieve the metrics of stopped (or otherwise not running) instances
+keep_raw_instance_data = False # Keep the full describe result of every instance in memory (not used by any of the outputs)
+daemon_interval = 300          # run_daemon(): seconds between the start of two collection cycles
+daemon_jitter = 30             # run_daemon(): maximum random delay added to the start of every cycle
+prometheus_port = None         # run_daemon(): serve the latest values and collector telemetry on http://<host>:<port>/metrics, for example 9107
+run_report = True              # Log the time per phase and per AWS API, calls, retries and bytes received at the end of run() (and of every run_daemon() cycle)
+run_report_file = None         # Also write the run report as JSON, for example '{}{}run_report.json'.format(os.getcwd(), os.sep)
+run_trace_file = None          # Write every phase and API call to this file as a Chrome trace (chrome://tracing or ui.perfetto.dev)
+profile_mode = None            # None, 'cprofile' or 'pyinstrument' (requires the pyinstrument package) - profile the whole run of run() (not supported by run_daemon())
+profile_file = '{}{}aws_metrics_collector.prof'.format(os.getcwd(), os.sep)    # Output of profile_mode: pstats file (cprofile) or HTML (pyinstrument)
 log_wrapper = LogWrapper()
 
 
+def configure_clients():
+    configure_default_client_pool(
+        max_pool_connections=max_pool_connections,
+        max_attempts=max_api_attempts,
+        role_source_profile=role_source_profile,
+        log_wrapper=log_wrapper
+    )
+    configure_default_region_catalog(
+        ttl=region_catalog_ttl,
+        cache_file=region_catalog_file,
+        allowed_regions=None if all_regions is True else regions,
+        log_wrapper=log_wrapper
+    )
+    configure_default_tag_cache(
+        ttl=rds_tag_cache_ttl,
+        cache_file=rds_tag_cache_file,
+        log_wrapper=log_wrapper
+    )
+    configure_default_response_cache(
+        cache_dir=response_cache_dir,
+        max_size=response_cache_max_size,
+        recent_ttl=response_cache_ttl,
+        offline=response_cache_offline,
+        log_wrapper=log_wrapper
+    )
+
+
+def write_json_file(data):
+    '''Write data.json (serialized in parallel, see export.export_instances())
+    through a temporary file, so that readers never see a partially written
+    file.'''
+    log_wrapper.info(message='Writing out raw data file to "{}"'.format(json_file))
+    export_collection(
+        collection=data,
+        file_name=json_file,
+        compact=json_compact,
+        partitioned=json_partitioned,
+        max_workers=json_export_workers,
+        log_wrapper=log_wrapper
+    )
+
+
+def run_collection_cycle(prometheus_exporter: PrometheusExporter=None):
+    '''Collect once and write the results to all configured outputs. The AWS
+    clients, region catalog and metric indexes of previous cycles are reused.'''
+    start_timestamp = collection_start_timestamp
+    end_timestamp = collection_end_timestamp
+    high_water_marks = None
+    if incremental_collection is True:
+        store = SQLiteStore(database_file=database_file, log_wrapper=log_wrapper)
+        high_water_marks = store.get_high_water_marks()
+        store.close()
+        if end_timestamp is None:
+            end_timestamp = datetime.now(tz=timezone.utc)
+        if start_timestamp is None:
+            start_timestamp = end_timestamp - timedelta(seconds=incremental_initial_lookback)
+    ndjson_writer = None
+    store = None
+    instance_handler = None
+    if stream_to_ndjson is True:
+        # Nothing is kept in memory: every instance is written to the NDJSON file (and the database) as soon as it is collected
+        ndjson_writer = NdjsonWriter(
+            file_name='{}{}'.format(ndjson_file, COMPRESSION_FILE_EXTENSIONS[ndjson_compression]),
+            compression=ndjson_compression,
+            per_datapoint=ndjson_per_datapoint,
+            log_wrapper=log_wrapper
+        )
+        if store_in_database is True:
+            store = SQLiteStore(database_file=database_file, log_wrapper=log_wrapper)
+
+        def instance_handler(instance):
+            ndjson_writer.write_instance(instance=instance)
+            if store is not None:
+                store.store_instances(instances=[instance,])
+            if prometheus_exporter is not None:
+                prometheus_exporter.record_instance(instance=instance)
+
+    profiler = get_default_profiler(log_wrapper=log_wrapper)
+    with profiler.phase(name='collection'):
+        data = collect_aws_instance_data(
+            services=services,
+            all_regions=all_regions,
+            regions=regions,
+            target_profile=target_profile,
+            use_metric_data=use_get_metric_data,
+            max_workers=max_workers,
+            max_workers_per_region=max_workers_per_region,
+            page_size=describe_page_size,
+            start_timestamp=start_timestamp,
+            end_timestamp=end_timestamp,
+            period=metric_period,
+            statistics=metric_statistics,
+            high_water_marks=high_water_marks,
+            use_metric_index=use_metric_index,
+            instance_handler=instance_handler,
+            keep_instances=not stream_to_ndjson,
+            target_profiles=target_profiles,
+            keep_raw_instance_data=keep_raw_instance_data,
+            instance_filter=InstanceFilter(
+                ec2_states=ec2_instance_states,
+                rds_states=rds_instance_states,
+                tags=instance_tags,
+                rds_engines=rds_engines,
+                skip_metrics_when_not_running=skip_metrics_when_not_running
+            ),
+            log_wrapper=log_wrapper
+        )
+    if ndjson_writer is not None:
+        ndjson_writer.close()
+    if store is not None:
+        store.close()
+    if stream_to_ndjson is False:
+        profiler.count(name='datapoints', value=sum(len(datapoints) for instance in data.instances for datapoints in instance.metric_statistics.values()))
+    if store_in_database is True and stream_to_ndjson is False:
+        log_wrapper.info(message='Storing data in database "{}"'.format(database_file))
+        with profiler.phase(name='store_database'):
+            store = SQLiteStore(database_file=database_file, log_wrapper=log_wrapper)
+            store.store_collection(collection=data)
+            store.close()
+    if dump_raw_json_to_file is True and stream_to_ndjson is False:
+        with profiler.phase(name='write_json'):
+            write_json_file(data=data)
+    if columnar_file is not None and stream_to_ndjson is False:
+        with profiler.phase(name='write_columnar'):
+            write_columnar_file(instances=data.instances, file_name=columnar_file, file_format=columnar_format, log_wrapper=log_wrapper)
+    if summary_file is not None and stream_to_ndjson is False:
+        with profiler.phase(name='write_summary'):
+            write_summary_csv(summary=summarize_instances(instances=data.instances, period=metric_period, log_wrapper=log_wrapper), file_name=summary_file, log_wrapper=log_wrapper)
+    if prometheus_exporter is not None:
+        with profiler.phase(name='prometheus_publish'):
+            prometheus_exporter.record_instances(instances=data.instances)
+            prometheus_exporter.publish()
+
+
+def write_run_report():
+    '''Log the run report of the default profiler and write the report and
+    trace files, when configured.'''
+    profiler = get_default_profiler(log_wrapper=log_wrapper)
+    if run_report is True:
+        profiler.log_report()
+    if run_report_file is not None:
+        profiler.write_report(file_name=run_report_file)
+    if run_trace_file is not None:
+        profiler.write_trace(file_name=run_trace_file)
+
+
+def run_daemon_cycle(prometheus_exporter: PrometheusExporter=None):
+    '''One cycle of run_daemon(): the profiler is reset first, so that the
+    run report (logged and written at the end of the cycle, also when it
+    fails) only covers this cycle.'''
+    get_default_profiler(log_wrapper=log_wrapper).reset()
+    try:
+        run_collection_cycle(prometheus_exporter=prometheus_exporter)
+    finally:
+        write_run_report()
+
+
 def run():
     log_wrapper.info(message='START')
     log_wrapper.info(message='Database file to be used: {}'.format(database_file))
-    data = collect_aws_instance_data(
-        services=services,
-        all_regions=all_regions,
-        regions=regions,
-        target_profile=target_profile,
+    configure_default_profiler(trace=run_trace_file is not None, log_wrapper=log_wrapper)
+    configure_clients()
+    run_with_profiler(function=run_collection_cycle, mode=profile_mode, output_file=profile_file, log_wrapper=log_wrapper)
+    shutdown_default_client_pool()
+    get_default_rate_limiter().log_statistics()
+    write_run_report()
+    log_wrapper.info(message='DONE')
+
+
+def run_daemon():
+    '''Keep running collection cycles every daemon_interval seconds until
+    SIGINT or SIGTERM is received. The process, AWS clients, region catalog
+    and metric indexes stay warm between cycles. The run report of every
+    cycle is logged and written at its end (see run_daemon_cycle());
+    profile_mode only applies to run().'''
+    log_wrapper.info(message='START daemon')
+    log_wrapper.info(message='Database file to be used: {}'.format(database_file))
+    if incremental_collection is False:
+        log_wrapper.warning(message='incremental_collection is disabled - every cycle collects the same time range')
+    if profile_mode is not None:
+        log_wrapper.warning(message='profile_mode is not supported by the daemon and is ignored')
+    configure_default_profiler(trace=run_trace_file is not None, log_wrapper=log_wrapper)
+    configure_clients()
+    prometheus_exporter = None
+    if prometheus_port is not None:
+        prometheus_exporter = PrometheusExporter(port=prometheus_port, collection_progress=get_default_collection_progress(), log_wrapper=log_wrapper)
+    scheduler = CollectionScheduler(
+        cycle_function=functools.partial(run_daemon_cycle, prometheus_exporter=prometheus_exporter),
+        interval=daemon_interval,
+        jitter=daemon_jitter,
         log_wrapper=log_wrapper
     )
-    if dump_raw_json_to_file is True:
-        if os.path.exists(json_file):
-            log_wrapper.info(message='Removing exiting data file "{}"'.format(json_file))
-            os.unlink(json_file)
-        log_wrapper.info(message='Writing out raw data file to "{}"'.format(json_file))
-        with open(json_file, 'w') as f:
-            f.write(dict_to_json(data.to_dict()))
+    if prometheus_exporter is not None:
+        prometheus_exporter.scheduler = scheduler
+        prometheus_exporter.start()
+
+    def stop_scheduler(signal_number, frame):
+        log_wrapper.info(message='Received signal {} - stopping after the running cycle'.format(signal_number))
+        scheduler.stop()
+
+    signal.signal(signal.SIGINT, stop_scheduler)
+    signal.signal(signal.SIGTERM, stop_scheduler)
+    scheduler.run_forever()
+    if prometheus_exporter is not None:
+        prometheus_exporter.stop()
+    shutdown_default_client_pool()
+    get_default_rate_limiter().log_statistics()
     log_wrapper.info(message='DONE')
 
 
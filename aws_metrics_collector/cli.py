@@ -0,0 +1,181 @@
+'''Command line interface of the collector (amcollect and amcollectd).
+
+Only argparse is imported at module level: the collector itself (and with it
+the logging setup) is imported after the arguments are parsed, and boto3 only
+when the first AWS client is created, so --help and --dry-run return without
+importing boto3 or creating a log file.
+'''
+import argparse
+import os
+import sys
+
+
+OPTION_VARIABLES = (     # (argparse destination, variable of aws_metrics_collector.aws_metrics_collector)
+    ('services', 'services'),
+    ('regions', 'regions'),
+    ('profiles', 'target_profiles'),
+    ('role_source_profile', 'role_source_profile'),
+    ('start', 'collection_start_timestamp'),
+    ('end', 'collection_end_timestamp'),
+    ('period', 'metric_period'),
+    ('statistics', 'metric_statistics'),
+    ('incremental', 'incremental_collection'),
+    ('no_metric_data', 'use_get_metric_data'),
+    ('no_metric_index', 'use_metric_index'),
+    ('max_workers', 'max_workers'),
+    ('database_file', 'database_file'),
+    ('no_database', 'store_in_database'),
+    ('json_file', 'json_file'),
+    ('no_json', 'dump_raw_json_to_file'),
+    ('json_compact', 'json_compact'),
+    ('ndjson_file', 'ndjson_file'),
+    ('stream_to_ndjson', 'stream_to_ndjson'),
+    ('columnar_file', 'columnar_file'),
+    ('summary_file', 'summary_file'),
+    ('response_cache_dir', 'response_cache_dir'),
+    ('offline', 'response_cache_offline'),
+    ('run_report_file', 'run_report_file'),
+    ('trace_file', 'run_trace_file'),
+    ('profile_mode', 'profile_mode'),
+    ('profile_file', 'profile_file'),
+    ('interval', 'daemon_interval'),
+    ('prometheus_port', 'prometheus_port'),
+)
+NEGATED_OPTIONS = (     # Options that set their variable to False
+    'no_database',
+    'no_json',
+    'no_metric_data',
+    'no_metric_index',
+)
+
+
+def parse_timestamp(value: str):
+    '''An ISO 8601 timestamp, for example 2020-01-01T00:00:00; without a time
+    zone it is taken as UTC.'''
+    from datetime import datetime, timezone
+    try:
+        timestamp = datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('"{}" is not an ISO 8601 timestamp'.format(value))
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp
+
+
+def get_parser(prog: str=None)->argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description='Collect the CloudWatch metric statistics of EC2 and RDS instances. Options that are not given keep the values set in aws_metrics_collector/aws_metrics_collector.py.'
+    )
+    parser.add_argument('--daemon', action='store_true', help='Keep running collection cycles (see --interval) until SIGINT or SIGTERM')
+    parser.add_argument('--dry-run', action='store_true', help='Print the effective configuration as JSON and exit, without calling AWS')
+    collection = parser.add_argument_group('collection')
+    collection.add_argument('--services', nargs='+', choices=('ec2', 'rds'), help='Services to collect')
+    collection.add_argument('--regions', nargs='+', metavar='REGION', help='Only collect these regions (no region lookups are done)')
+    collection.add_argument('--profiles', nargs='+', metavar='PROFILE', help='Profile names and/or IAM role ARNs to collect from')
+    collection.add_argument('--role-source-profile', metavar='PROFILE', help='Profile used to assume the roles in --profiles')
+    collection.add_argument('--start', type=parse_timestamp, metavar='TIMESTAMP', help='Start of the collected time range (ISO 8601, UTC when no time zone is given)')
+    collection.add_argument('--end', type=parse_timestamp, metavar='TIMESTAMP', help='End of the collected time range (ISO 8601, UTC when no time zone is given)')
+    collection.add_argument('--period', type=int, metavar='SECONDS', help='Seconds per datapoint: 1, 5, 10, 30 or a multiple of 60')
+    collection.add_argument('--statistics', nargs='+', metavar='STATISTIC', help='Standard statistics and/or percentiles such as p99')
+    collection.add_argument('--incremental', action='store_true', default=None, help='Only retrieve datapoints newer than the last datapoints stored in the database')
+    collection.add_argument('--max-workers', type=int, metavar='N', help='Service/region combinations collected concurrently')
+    collection.add_argument('--no-metric-data', action='store_true', default=None, help='Retrieve each metric with get_metric_statistics instead of batched GetMetricData requests')
+    collection.add_argument('--no-metric-index', action='store_true', default=None, help='Call list_metrics for every instance instead of once per region and namespace')
+    collection.add_argument('--response-cache-dir', metavar='DIRECTORY', help='Cache the describe, list_metrics and metric data responses in this directory')
+    collection.add_argument('--offline', action='store_true', default=None, help='Only use the responses cached in --response-cache-dir, without calling AWS')
+    output = parser.add_argument_group('output')
+    output.add_argument('--database-file', metavar='FILE', help='SQLite database file')
+    output.add_argument('--no-database', action='store_true', default=None, help='Do not store the datapoints in the database')
+    output.add_argument('--json-file', metavar='FILE', help='JSON file of all collected instances')
+    output.add_argument('--no-json', action='store_true', default=None, help='Do not write the JSON file')
+    output.add_argument('--json-compact', action='store_true', default=None, help='Write the JSON file without indentation')
+    output.add_argument('--stream-to-ndjson', action='store_true', default=None, help='Stream the instances to --ndjson-file while collecting instead of writing the JSON file at the end')
+    output.add_argument('--ndjson-file', metavar='FILE', help='NDJSON file of --stream-to-ndjson')
+    output.add_argument('--columnar-file', metavar='FILE', help='Also write a Parquet file (requires pyarrow)')
+    output.add_argument('--summary-file', metavar='FILE', help='Also write a utilization summary CSV file (requires numpy)')
+    diagnostics = parser.add_argument_group('logging and profiling')
+    diagnostics.add_argument('--log-file', metavar='FILE', help='Log file (default: aws_metrics_collector.log in the current directory)')
+    diagnostics.add_argument('--log-console', action='store_true', help='Log to stderr instead of a file')
+    diagnostics.add_argument('--debug', action='store_true', help='Log debug messages')
+    diagnostics.add_argument('--run-report-file', metavar='FILE', help='Write the run report as JSON')
+    diagnostics.add_argument('--trace-file', metavar='FILE', help='Write every phase and API call as a Chrome trace')
+    diagnostics.add_argument('--profile-mode', choices=('cprofile', 'pyinstrument'), help='Profile the whole run')
+    diagnostics.add_argument('--profile-file', metavar='FILE', help='Output of --profile-mode')
+    daemon = parser.add_argument_group('daemon')
+    daemon.add_argument('--interval', type=int, metavar='SECONDS', help='Seconds between the start of two collection cycles')
+    daemon.add_argument('--prometheus-port', type=int, metavar='PORT', help='Serve the latest values and collector telemetry on http://<host>:<port>/metrics')
+    return parser
+
+
+def apply_arguments(arguments: argparse.Namespace, collector)->dict:
+    '''Set the variables of the collector module (aws_metrics_collector.aws_metrics_collector)
+    of every given option. Returns the {variable: value} that were set.'''
+    applied = dict()
+    for destination, variable in OPTION_VARIABLES:
+        value = getattr(arguments, destination)
+        if value is None:
+            continue
+        if destination in NEGATED_OPTIONS:
+            value = not value
+        elif destination == 'statistics':
+            value = tuple(value)
+        setattr(collector, variable, value)
+        applied[variable] = value
+    if arguments.regions is not None:
+        collector.all_regions = False
+        applied['all_regions'] = False
+    return applied
+
+
+def get_configuration(collector)->dict:
+    '''The configuration variables of the collector module.'''
+    from datetime import datetime
+    configuration = dict()
+    for name, value in sorted(vars(collector).items()):
+        if name.startswith('_') or name.isupper():
+            continue
+        if value is None or isinstance(value, (bool, int, float, str, list, tuple, dict)):
+            configuration[name] = value
+        elif isinstance(value, datetime):
+            configuration[name] = value.isoformat()
+    return configuration
+
+
+def main(argv: list=None, prog: str=None, daemon: bool=False)->int:
+    arguments = get_parser(prog=prog).parse_args(argv)
+    import logging
+    from aws_metrics_collector import configure_logging
+    if arguments.dry_run is False:
+        configure_logging(log_file_name=arguments.log_file, console=arguments.log_console, level=logging.DEBUG if arguments.debug is True else None)
+    from aws_metrics_collector import aws_metrics_collector as collector
+    apply_arguments(arguments=arguments, collector=collector)
+    if arguments.dry_run is True:
+        import json
+        configuration = get_configuration(collector=collector)
+        configuration['daemon'] = daemon or arguments.daemon
+        try:
+            print(json.dumps(configuration, indent=4, sort_keys=True))
+            sys.stdout.flush()
+        except BrokenPipeError:
+            # The reader (for example head) exited early; send what is left to devnull so that the flush at exit does not fail again
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 0
+    if arguments.debug is True:
+        collector.log_wrapper.enable_debug()
+    if daemon is True or arguments.daemon is True:
+        collector.run_daemon()
+    else:
+        collector.run()
+    return 0
+
+
+def main_daemon(argv: list=None)->int:
+    '''amcollectd: main() with --daemon.'''
+    return main(argv=argv, daemon=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# EOF
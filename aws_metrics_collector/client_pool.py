@@ -0,0 +1,238 @@
+import functools
+import threading
+import traceback
+from aws_metrics_collector import LogWrapper
+from aws_metrics_collector.profiling import RunProfiler, get_default_profiler
+from aws_metrics_collector.throttling import AdaptiveRateLimiter, get_default_rate_limiter, DEFAULT_MAX_ATTEMPTS
+
+
+DEFAULT_MAX_POOL_CONNECTIONS = 10   # Same as the botocore default
+DEFAULT_ROLE_SESSION_NAME = 'aws_metrics_collector'
+UNKNOWN_ACCOUNT_ID = 'unknown'
+
+
+def is_role_arn(target_profile: str)->bool:
+    return target_profile is not None and target_profile.startswith('arn:') and ':role/' in target_profile
+
+
+class AwsClientPool:
+    '''A thread safe cache of boto3 sessions and clients.
+
+    boto3 is only imported when the first session is created, so that
+    importing the collector (for example for --help) stays fast.
+
+    Sessions are cached per profile and clients per (profile, region, service),
+    so that each client is only constructed once per process. boto3 sessions
+    are not thread safe, so the session and clients of a profile are created
+    while holding the lock of that profile, and other profiles are not held
+    up; the resulting clients are thread safe and are shared by all threads. Every
+    client is created with max_pool_connections HTTP connections, which should
+    be at least the number of threads using the same client concurrently.
+
+    Every client is registered with the rate_limiter (by default the process
+    wide AdaptiveRateLimiter) under the account ID of its profile, which is
+    resolved when the client makes its first call, and retries throttled
+    calls up to max_attempts times with botocore's "standard" retry mode.
+    The API calls of every client are timed by the profiler (by default the
+    process wide RunProfiler).
+
+    A target_profile is either the name of a profile or the ARN of an IAM role.
+    Roles are assumed with the credentials of role_source_profile (the default
+    credentials when None) when the first request is signed, and the temporary
+    credentials are cached in the session and refreshed shortly before they
+    expire.
+    '''
+
+    def __init__(
+        self,
+        max_pool_connections: int=DEFAULT_MAX_POOL_CONNECTIONS,
+        max_attempts: int=DEFAULT_MAX_ATTEMPTS,
+        rate_limiter: AdaptiveRateLimiter=None,
+        role_source_profile: str=None,
+        role_session_name: str=DEFAULT_ROLE_SESSION_NAME,
+        profiler: RunProfiler=None,
+        log_wrapper: LogWrapper=LogWrapper()
+    ):
+        self.max_pool_connections = max_pool_connections
+        self.role_source_profile = role_source_profile
+        self.role_session_name = role_session_name
+        self.max_attempts = max_attempts
+        self.rate_limiter = rate_limiter if rate_limiter is not None else get_default_rate_limiter(log_wrapper=log_wrapper)
+        self.profiler = profiler if profiler is not None else get_default_profiler(log_wrapper=log_wrapper)
+        self.log_wrapper = log_wrapper
+        self._lock = threading.RLock()
+        self._sessions = dict()
+        self._clients = dict()
+        self._account_ids = dict()
+        self._session_locks = dict()
+        self._account_id_locks = dict()
+
+    def _get_profile_lock(self, locks: dict, target_profile: str)->threading.Lock:
+        with self._lock:
+            if target_profile not in locks:
+                locks[target_profile] = threading.Lock()
+            return locks[target_profile]
+
+    def _create_assumed_role_session(self, role_arn: str):
+        import boto3
+        import botocore.session
+        from botocore.credentials import DeferredRefreshableCredentials
+        sts_client = self.get_client(service='sts', region='us-east-1', target_profile=self.role_source_profile)
+
+        def refresh_credentials()->dict:
+            self.log_wrapper.info(message='Assuming role "{}"'.format(role_arn))
+            credentials = sts_client.assume_role(RoleArn=role_arn, RoleSessionName=self.role_session_name)['Credentials']
+            return {
+                'access_key': credentials['AccessKeyId'],
+                'secret_key': credentials['SecretAccessKey'],
+                'token': credentials['SessionToken'],
+                'expiry_time': credentials['Expiration'].isoformat(),
+            }
+
+        botocore_session = botocore.session.get_session()
+        botocore_session._credentials = DeferredRefreshableCredentials(refresh_using=refresh_credentials, method='sts-assume-role')
+        return boto3.session.Session(botocore_session=botocore_session)
+
+    def get_session(self, target_profile: str=None):
+        session = self._sessions.get(target_profile, None)
+        if session is not None:
+            return session
+        with self._get_profile_lock(locks=self._session_locks, target_profile=target_profile):
+            session = self._sessions.get(target_profile, None)
+            if session is None:
+                self.log_wrapper.info(message='Creating boto3 session for profile "{}"'.format(target_profile))
+                if is_role_arn(target_profile=target_profile):
+                    session = self._create_assumed_role_session(role_arn=target_profile)
+                else:
+                    import boto3
+                    session = boto3.session.Session(profile_name=target_profile)
+                with self._lock:
+                    self._sessions[target_profile] = session
+            return session
+
+    def get_account_id(self, target_profile: str=None)->str:
+        '''Return the AWS account ID of a profile or role ARN. It is only
+        looked up (with sts:GetCallerIdentity) once per profile, also when
+        several threads ask for it at the same time.'''
+        account_id = self._account_ids.get(target_profile, None)
+        if account_id is not None:
+            return account_id
+        with self._get_profile_lock(locks=self._account_id_locks, target_profile=target_profile):
+            account_id = self._account_ids.get(target_profile, None)
+            if account_id is not None:
+                return account_id
+            account_id = UNKNOWN_ACCOUNT_ID
+            try:
+                if is_role_arn(target_profile=target_profile):
+                    account_id = target_profile.split(':')[4]
+                else:
+                    account_id = self.get_client(service='sts', region='us-east-1', target_profile=target_profile).get_caller_identity()['Account']
+            except:
+                self.log_wrapper.error(message='EXCEPTION: {}'.format(traceback.format_exc()))
+            with self._lock:
+                self._account_ids[target_profile] = account_id
+            return account_id
+
+    def set_account_id(self, target_profile: str=None, account_id: str=None):
+        '''Remember the account ID of a profile that was found elsewhere (for
+        example in the response cache), so that it is not looked up again.'''
+        with self._lock:
+            self._account_ids[target_profile] = account_id
+
+    def _get_rate_limit_account(self, target_profile: str=None)->str:
+        account_id = self.get_account_id(target_profile=target_profile)
+        if account_id == UNKNOWN_ACCOUNT_ID:
+            return target_profile
+        return account_id
+
+    def has_client(self, service: str='ec2', region: str='us-east-1', target_profile: str=None)->bool:
+        with self._lock:
+            return (target_profile, region, service) in self._clients
+
+    def get_client(self, service: str='ec2', region: str='us-east-1', target_profile: str=None):
+        key = (target_profile, region, service)
+        client = self._clients.get(key, None)
+        if client is not None:
+            return client
+        session = self.get_session(target_profile=target_profile)
+        with self._get_profile_lock(locks=self._session_locks, target_profile=target_profile):
+            client = self._clients.get(key, None)
+            if client is None:
+                self.log_wrapper.info(message='Creating client for service "{}" in region "{}" for profile "{}"'.format(service, region, target_profile))
+                with self.profiler.phase(name='client_creation'):
+                    from botocore.config import Config
+                    client = session.client(
+                        service,
+                        region_name=region,
+                        config=Config(
+                            max_pool_connections=self.max_pool_connections,
+                            retries={'mode': 'standard', 'total_max_attempts': self.max_attempts}
+                        )
+                    )
+                if service == 'sts':
+                    # Used to look up the account ID itself
+                    self.rate_limiter.register_client(aws_client=client, account=target_profile)
+                else:
+                    self.rate_limiter.register_client(aws_client=client, account=functools.partial(self._get_rate_limit_account, target_profile))
+                self.profiler.register_client(aws_client=client)
+                with self._lock:
+                    self._clients[key] = client
+            return client
+
+    def shutdown(self):
+        '''Close the HTTP connections of all clients and forget all cached
+        sessions and clients. The pool can be used again afterwards.
+        '''
+        with self._lock:
+            for key, client in self._clients.items():
+                try:
+                    if hasattr(client, 'close'):
+                        client.close()
+                except:
+                    self.log_wrapper.error(message='EXCEPTION while closing client {}: {}'.format(key, traceback.format_exc()))
+            self.log_wrapper.info(message='Closed {} clients'.format(len(self._clients)))
+            self._clients = dict()
+            self._sessions = dict()
+            self._account_ids = dict()
+
+
+_default_client_pool = None
+_default_client_pool_lock = threading.Lock()
+
+
+def get_default_client_pool(log_wrapper: LogWrapper=LogWrapper())->AwsClientPool:
+    global _default_client_pool
+    with _default_client_pool_lock:
+        if _default_client_pool is None:
+            _default_client_pool = AwsClientPool(log_wrapper=log_wrapper)
+        return _default_client_pool
+
+
+def configure_default_client_pool(
+    max_pool_connections: int=DEFAULT_MAX_POOL_CONNECTIONS,
+    max_attempts: int=DEFAULT_MAX_ATTEMPTS,
+    role_source_profile: str=None,
+    log_wrapper: LogWrapper=LogWrapper()
+)->AwsClientPool:
+    '''Replace the default pool with one using the given connection pool size.
+    Clients of the previous default pool are closed.
+    '''
+    global _default_client_pool
+    with _default_client_pool_lock:
+        if _default_client_pool is not None:
+            _default_client_pool.shutdown()
+        _default_client_pool = AwsClientPool(
+            max_pool_connections=max_pool_connections,
+            max_attempts=max_attempts,
+            role_source_profile=role_source_profile,
+            log_wrapper=log_wrapper
+        )
+        return _default_client_pool
+
+
+def shutdown_default_client_pool():
+    with _default_client_pool_lock:
+        if _default_client_pool is not None:
+            _default_client_pool.shutdown()
+
+# EOF
@@ -0,0 +1,125 @@
+import math
+import traceback
+from array import array
+from aws_metrics_collector import LogWrapper
+from aws_metrics_collector.metric_series import MetricSeries, to_epoch
+
+
+COLUMNAR_FORMATS = (
+    'parquet',
+    'arrow',
+)
+
+
+def metric_statistics_to_arrays(datapoints: list, statistics: tuple=None)->tuple:
+    '''Convert the datapoints of a single metric to a (timestamps, values)
+    tuple, where timestamps is an int64 array of seconds since the epoch in
+    ascending order and values maps each statistic to a float64 array of the
+    same length (NaN where a datapoint has no value for the statistic).
+    The arrays of a MetricSeries are returned without copying.'''
+    if isinstance(datapoints, MetricSeries):
+        if statistics is None:
+            statistics = sorted(datapoints.values.keys())
+        values = dict()
+        for statistic in statistics:
+            values[statistic] = datapoints.values.get(statistic, array('d', [math.nan]) * len(datapoints))
+        return datapoints.timestamps, values
+    if statistics is None:
+        statistics = sorted({key for datapoint in datapoints for key in datapoint if key not in ('Timestamp', 'Unit')})
+    datapoints = sorted(datapoints, key=lambda datapoint: to_epoch(datapoint['Timestamp']))
+    timestamps = array('q', [to_epoch(datapoint['Timestamp']) for datapoint in datapoints])
+    values = dict()
+    for statistic in statistics:
+        values[statistic] = array('d', [datapoint.get(statistic, math.nan) for datapoint in datapoints])
+    return timestamps, values
+
+
+def instances_to_columns(instances: list, statistics: tuple=None)->dict:
+    '''Convert the metric statistics of the instances to one long table of
+    columns: account_id, instance_class, region, instance_id, metric_name
+    (lists of strings), timestamp (int64 array) and one float64 array per
+    statistic.
+    When statistics is not given, all statistics found in the data are used.
+    '''
+    if statistics is None:
+        found_statistics = set()
+        for instance in instances:
+            for datapoints in instance.metric_statistics.values():
+                if isinstance(datapoints, MetricSeries):
+                    found_statistics.update(datapoints.values.keys())
+                    continue
+                for datapoint in datapoints:
+                    found_statistics.update(key for key in datapoint if key not in ('Timestamp', 'Unit'))
+        statistics = sorted(found_statistics)
+    columns = {
+        'account_id': list(),
+        'instance_class': list(),
+        'region': list(),
+        'instance_id': list(),
+        'metric_name': list(),
+        'timestamp': array('q'),
+    }
+    for statistic in statistics:
+        columns[statistic] = array('d')
+    for instance in instances:
+        for metric_name, datapoints in instance.metric_statistics.items():
+            timestamps, values = metric_statistics_to_arrays(datapoints=datapoints, statistics=statistics)
+            row_count = len(timestamps)
+            columns['account_id'].extend([instance.account_id] * row_count)
+            columns['instance_class'].extend([instance.instance_class] * row_count)
+            columns['region'].extend([instance.region] * row_count)
+            columns['instance_id'].extend([instance.instance_id] * row_count)
+            columns['metric_name'].extend([metric_name] * row_count)
+            columns['timestamp'].extend(timestamps)
+            for statistic in statistics:
+                columns[statistic].extend(values[statistic])
+    return columns
+
+
+def instances_to_arrow_table(instances: list, statistics: tuple=None):
+    '''Convert the metric statistics of the instances to a pyarrow Table
+    (requires the optional pyarrow package). The string columns are
+    dictionary encoded and the timestamp column has second resolution.'''
+    try:
+        import pyarrow
+    except ImportError:
+        raise Exception('Columnar export requires the pyarrow package: pip3 install pyarrow')
+    columns = instances_to_columns(instances=instances, statistics=statistics)
+    arrow_columns = dict()
+    for name, values in columns.items():
+        if name == 'timestamp':
+            arrow_columns[name] = pyarrow.array(values, type=pyarrow.int64()).cast(pyarrow.timestamp('s', tz='UTC'))
+        elif isinstance(values, array):
+            arrow_columns[name] = pyarrow.array(values, type=pyarrow.float64())
+        else:
+            arrow_columns[name] = pyarrow.array(values, type=pyarrow.string()).dictionary_encode()
+    return pyarrow.table(arrow_columns)
+
+
+def write_columnar_file(
+    instances: list,
+    file_name: str,
+    file_format: str='parquet',
+    statistics: tuple=None,
+    log_wrapper: LogWrapper=LogWrapper()
+)->bool:
+    '''Write the metric statistics of the instances to a Parquet or Arrow IPC
+    file (requires the optional pyarrow package).'''
+    try:
+        if file_format not in COLUMNAR_FORMATS:
+            raise Exception('Format "{}" is not supported. Supported: {}'.format(file_format, COLUMNAR_FORMATS))
+        table = instances_to_arrow_table(instances=instances, statistics=statistics)
+        if file_format == 'parquet':
+            import pyarrow.parquet
+            pyarrow.parquet.write_table(table, file_name, compression='zstd')
+        else:
+            import pyarrow.ipc
+            with pyarrow.ipc.new_file(file_name, table.schema, options=pyarrow.ipc.IpcWriteOptions(compression='zstd')) as writer:
+                writer.write_table(table)
+        log_wrapper.info(message='Wrote {} datapoints to {} file "{}"'.format(table.num_rows, file_format, file_name))
+        return True
+    except:
+        log_wrapper.error(message='EXCEPTION: {}'.format(traceback.format_exc()))
+    return False
+
+# EOF
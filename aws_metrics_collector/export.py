@@ -0,0 +1,212 @@
+import json
+import multiprocessing
+import os
+import traceback
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from aws_metrics_collector import LogWrapper
+from aws_metrics_collector.metric_series import MetricSeries
+from aws_metrics_collector.profiling import get_default_profiler
+from aws_metrics_collector.utils import convert_unknown_obj
+from aws_metrics_collector.writers import COMPRESSION_FILE_EXTENSIONS, open_text_file_for_writing
+
+
+EXPORT_FORMATS = (
+    'json',
+    'ndjson',
+)
+DEFAULT_SHARD_SIZE = 500       # Instances serialized per task of the process pool
+
+
+def series_to_datapoints(series: MetricSeries)->list:
+    '''The datapoints of a series with float epoch timestamps, as written by
+    dict_to_json(). All timestamps are converted in one array operation.'''
+    timestamps = array('d', series.timestamps)
+    statistics = list(series.values.items())
+    datapoints = list()
+    for index, timestamp in enumerate(timestamps):
+        datapoint = {'Timestamp': timestamp}
+        for statistic, values in statistics:
+            value = values[index]
+            if value == value:  # Not NaN
+                datapoint[statistic] = value
+        if series.unit is not None:
+            datapoint['Unit'] = series.unit
+        datapoints.append(datapoint)
+    return datapoints
+
+
+def instance_to_export_record(instance)->tuple:
+    '''The picklable part of an instance that is sent to a worker process:
+    its to_dict() fields, with the metric statistics as MetricSeries (which
+    pickle as flat arrays) or datapoint lists with epoch timestamps.'''
+    metric_statistics = dict()
+    for metric_name, datapoints in instance.metric_statistics.items():
+        if isinstance(datapoints, MetricSeries):
+            metric_statistics[metric_name] = datapoints
+        else:
+            metric_statistics[metric_name] = [
+                dict(datapoint, Timestamp=datapoint['Timestamp'].timestamp() if hasattr(datapoint['Timestamp'], 'timestamp') else datapoint['Timestamp'])
+                for datapoint in datapoints
+            ]
+    return (
+        {
+            'AccountId': instance.account_id,
+            'InstanceClass': instance.instance_class,
+            'LastUpdate': instance.last_update,
+            'InstanceId': instance.instance_id,
+            'InstanceType': instance.instance_type,
+            'InstanceState': instance.state,
+            'InstanceRegion': instance.region,
+            'Tags': instance.tags,
+            'Metrics': instance.metrics,
+        },
+        metric_statistics,
+    )
+
+
+def _record_to_dict(record: tuple)->dict:
+    instance_dict, metric_statistics = record
+    instance_dict = dict(instance_dict)
+    instance_dict['MetricStatistics'] = dict()
+    for metric_name, datapoints in metric_statistics.items():
+        if isinstance(datapoints, MetricSeries):
+            datapoints = series_to_datapoints(series=datapoints)
+        instance_dict['MetricStatistics'][metric_name] = datapoints
+    return instance_dict
+
+
+def _dumps_instance(instance_dict: dict, output_format: str, compact: bool)->str:
+    if output_format == 'ndjson' or compact is True:
+        return json.dumps(instance_dict, default=convert_unknown_obj, separators=(',', ':'))
+    text = json.dumps(instance_dict, default=convert_unknown_obj, indent=4, sort_keys=True)
+    return '\n'.join('        {}'.format(line) for line in text.split('\n'))
+
+
+def _document_parts(output_format: str, compact: bool)->tuple:
+    '''The (header, separator, footer, empty document) of a file of
+    serialized instances, as written by dict_to_json(AWSInstanceCollection.to_dict()).'''
+    if output_format == 'ndjson':
+        return ('', '\n', '\n', '')
+    if compact is True:
+        return ('{"InstanceDefitions":[', ',', ']}', '{"InstanceDefitions":[]}')
+    return ('{\n    "InstanceDefitions": [\n', ',\n', '\n    ]\n}', '{\n    "InstanceDefitions": []\n}')
+
+
+def serialize_shard(records: list, output_format: str='json', compact: bool=False)->str:
+    '''Serialize a shard of export records to the instance part of a
+    document (the instances with their separators).'''
+    separator = _document_parts(output_format=output_format, compact=compact)[1]
+    return separator.join(_dumps_instance(instance_dict=_record_to_dict(record=record), output_format=output_format, compact=compact) for record in records)
+
+
+def write_document(file_name: str, shard_texts, output_format: str='json', compact: bool=False, compression: str=None)->int:
+    '''Write the serialized shards as one document, through a temporary file
+    so that readers never see a partially written file. Returns the number of
+    non-empty shards written.'''
+    header, separator, footer, empty_document = _document_parts(output_format=output_format, compact=compact)
+    temporary_file = '{}.tmp'.format(file_name)
+    shard_count = 0
+    with open_text_file_for_writing(file_name=temporary_file, compression=compression) as f:
+        for shard_text in shard_texts:
+            if shard_text == '':
+                continue
+            f.write(header if shard_count == 0 else separator)
+            f.write(shard_text)
+            shard_count += 1
+        f.write(footer if shard_count > 0 else empty_document)
+    os.replace(temporary_file, file_name)
+    return shard_count
+
+
+def get_partition_file_name(file_name: str, partition: int, compression: str=None)->str:
+    '''data.json -> data-00000.json (plus the compression extension).'''
+    base_name, extension = os.path.splitext(file_name)
+    return '{}-{:05d}{}{}'.format(base_name, partition, extension, COMPRESSION_FILE_EXTENSIONS[compression])
+
+
+def _write_partition(records: list, file_name: str, output_format: str, compact: bool, compression: str)->str:
+    write_document(
+        file_name=file_name,
+        shard_texts=[serialize_shard(records=records, output_format=output_format, compact=compact),],
+        output_format=output_format,
+        compact=compact,
+        compression=compression
+    )
+    return file_name
+
+
+def export_instances(
+    instances: list,
+    file_name: str,
+    output_format: str='json',
+    compact: bool=False,
+    compression: str=None,
+    partitioned: bool=False,
+    max_workers: int=None,
+    shard_size: int=DEFAULT_SHARD_SIZE,
+    log_wrapper: LogWrapper=LogWrapper()
+)->list:
+    '''Serialize the instances in parallel and write them to file_name.
+
+    The instances are split in shards of shard_size instances, which are
+    serialized by a pool of max_workers processes (by default one per CPU;
+    1 serializes in this process). The workers are started with the spawn
+    method, as forking a process with running threads (the collector and
+    daemon threads) is not safe. Only the fields of to_dict() are sent to
+    the workers, with MetricSeries as flat arrays, and the timestamps are
+    converted to epoch seconds per series instead of through the default hook
+    of json.dumps().
+
+    With output_format 'json' the result is identical to
+    dict_to_json(AWSInstanceCollection.to_dict()) (with the same compact
+    setting); 'ndjson' writes one instance per line. With partitioned set,
+    every shard is written by its worker to its own complete file
+    (data-00000.json, data-00001.json, ...); otherwise the shards are merged,
+    in order, into file_name. compression ('gzip' or 'zstd') adds the
+    compression extension to partition files; the name of a merged file is
+    used as given.
+
+    Returns the list of files written.
+    '''
+    files = list()
+    try:
+        profiler = get_default_profiler(log_wrapper=log_wrapper)
+        if output_format not in EXPORT_FORMATS:
+            raise Exception('Format "{}" is not supported. Supported: {}'.format(output_format, EXPORT_FORMATS))
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        shards = [
+            [instance_to_export_record(instance=instance) for instance in instances[shard_start:shard_start + shard_size]]
+            for shard_start in range(0, len(instances), shard_size)
+        ]
+        worker_count = max(1, min(max_workers, len(shards)))
+        log_wrapper.info(message='Exporting {} instances in {} shards with {} processes to "{}"'.format(len(instances), len(shards), worker_count, file_name))
+        profiler.count(name='export_shards', value=len(shards))
+        if partitioned is True:
+            partition_file_names = [get_partition_file_name(file_name=file_name, partition=partition, compression=compression) for partition in range(len(shards))]
+            arguments = (shards, partition_file_names, [output_format] * len(shards), [compact] * len(shards), [compression] * len(shards))
+            if worker_count == 1:
+                files = list(map(_write_partition, *arguments))
+            else:
+                with ProcessPoolExecutor(max_workers=worker_count, mp_context=multiprocessing.get_context('spawn')) as executor:
+                    files = list(executor.map(_write_partition, *arguments))
+        else:
+            arguments = (shards, [output_format] * len(shards), [compact] * len(shards))
+            if worker_count == 1:
+                write_document(file_name=file_name, shard_texts=map(serialize_shard, *arguments), output_format=output_format, compact=compact, compression=compression)
+            else:
+                with ProcessPoolExecutor(max_workers=worker_count, mp_context=multiprocessing.get_context('spawn')) as executor:
+                    write_document(file_name=file_name, shard_texts=executor.map(serialize_shard, *arguments), output_format=output_format, compact=compact, compression=compression)
+            files = [file_name,]
+        log_wrapper.info(message='Exported {} instances to {} files'.format(len(instances), len(files)))
+    except:
+        log_wrapper.error(message='EXCEPTION: {}'.format(traceback.format_exc()))
+    return files
+
+
+def export_collection(collection, file_name: str, **kwargs)->list:
+    '''export_instances() of the instances of an AWSInstanceCollection.'''
+    return export_instances(instances=collection.instances, file_name=file_name, **kwargs)
+
+# EOF
@@ -0,0 +1,114 @@
+EC2_RUNNING_STATES = (
+    'running',
+)
+RDS_NOT_RUNNING_STATES = (  # Any other DBInstanceStatus (available, backing-up, modifying, ...) is a running database
+    'creating',
+    'deleting',
+    'failed',
+    'inaccessible-encryption-credentials',
+    'incompatible-network',
+    'incompatible-restore',
+    'starting',
+    'stopped',
+    'stopping',
+)
+
+
+class InstanceFilter:
+    '''Select the instances to collect, as far as possible with the Filters
+    of the describe calls, so that unwanted instances are never returned.
+
+    ec2_states and rds_states are lists of instance states (for example
+    ['running'] and ['available']) and tags maps tag keys to a value, a list
+    of values or None (any value). For EC2 all of these are sent as Filters
+    of describe_instances. describe_db_instances can only filter on
+    identifiers and engines (rds_engines, rds_instance_ids), so the RDS states
+    and tags are checked on the returned instances. Additional raw Filters
+    can be given with ec2_filters and rds_filters.
+
+    With skip_metrics_when_not_running set, instances that are not running
+    (an EC2 state other than running, or a stopped, starting, creating,
+    deleting or failed database) are still returned, but without retrieving
+    their metrics. Note that this also skips the datapoints of an instance
+    that was stopped during the collected time range.
+    '''
+
+    def __init__(
+        self,
+        ec2_states: list=None,
+        rds_states: list=None,
+        tags: dict=None,
+        rds_engines: list=None,
+        rds_instance_ids: list=None,
+        ec2_filters: list=None,
+        rds_filters: list=None,
+        skip_metrics_when_not_running: bool=False
+    ):
+        self.ec2_states = ec2_states
+        self.rds_states = rds_states
+        self.tags = tags if tags is not None else dict()
+        self.rds_engines = rds_engines
+        self.rds_instance_ids = rds_instance_ids
+        self.ec2_filters = ec2_filters if ec2_filters is not None else list()
+        self.rds_filters = rds_filters if rds_filters is not None else list()
+        self.skip_metrics_when_not_running = skip_metrics_when_not_running
+
+    def get_describe_filters(self, service: str)->list:
+        '''The Filters parameter of the describe call of the service.'''
+        filters = list()
+        if service == 'ec2':
+            if self.ec2_states is not None:
+                filters.append({'Name': 'instance-state-name', 'Values': list(self.ec2_states)})
+            for key, value in self.tags.items():
+                if value is None:
+                    filters.append({'Name': 'tag-key', 'Values': [key,]})
+                elif isinstance(value, (list, tuple)):
+                    filters.append({'Name': 'tag:{}'.format(key), 'Values': list(value)})
+                else:
+                    filters.append({'Name': 'tag:{}'.format(key), 'Values': [value,]})
+            filters.extend(self.ec2_filters)
+        if service == 'rds':
+            if self.rds_engines is not None:
+                filters.append({'Name': 'engine', 'Values': list(self.rds_engines)})
+            if self.rds_instance_ids is not None:
+                filters.append({'Name': 'db-instance-id', 'Values': list(self.rds_instance_ids)})
+            filters.extend(self.rds_filters)
+        return filters
+
+    def matches_state(self, instance)->bool:
+        '''Check the state of an RDS instance (EC2 states are filtered by
+        describe_instances).'''
+        if instance.instance_class == 'rds' and self.rds_states is not None:
+            return instance.state in self.rds_states
+        return True
+
+    def matches_tags(self, instance)->bool:
+        '''Check the tags of an RDS instance (EC2 tags are filtered by
+        describe_instances).'''
+        if instance.instance_class != 'rds':
+            return True
+        for key, value in self.tags.items():
+            if key not in instance.tags:
+                return False
+            if value is None:
+                continue
+            values = value if isinstance(value, (list, tuple)) else [value,]
+            if instance.tags[key] not in values:
+                return False
+        return True
+
+    def matches(self, instance)->bool:
+        '''Check the conditions that could not be sent as describe Filters
+        (the RDS state and tags).'''
+        return self.matches_state(instance=instance) is True and self.matches_tags(instance=instance) is True
+
+    def collect_metrics(self, instance)->bool:
+        if self.skip_metrics_when_not_running is False:
+            return True
+        if instance.instance_class == 'ec2':
+            return instance.state in EC2_RUNNING_STATES
+        if instance.instance_class == 'rds':
+            return instance.state not in RDS_NOT_RUNNING_STATES
+        return True
+
+# EOF
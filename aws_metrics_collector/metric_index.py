@@ -0,0 +1,134 @@
+import threading
+import time
+import traceback
+from aws_metrics_collector import LogWrapper
+from aws_metrics_collector.response_cache import ResponseCache
+
+
+DEFAULT_METRIC_INDEX_TTL = 900  # Seconds before a metric index is rebuilt
+
+
+class MetricIndex:
+    '''Index of the metric names of every resource in a CloudWatch namespace
+    of one region, built with a single paged list_metrics sweep.
+
+    Only metrics whose only dimension is dimension_name are indexed, which
+    are the same metrics a list_metrics call filtered on a single resource
+    returns. Looking up the metrics of a resource is then a dictionary hit
+    instead of an API call.
+    '''
+
+    def __init__(self, namespace: str, dimension_name: str, log_wrapper: LogWrapper=LogWrapper()):
+        self.namespace = namespace
+        self.dimension_name = dimension_name
+        self.log_wrapper = log_wrapper
+        self.metrics_by_dimension_value = dict()
+        self.build_time = None
+
+    def _list_metrics(self, aws_client)->dict:
+        metrics_by_dimension_value = dict()
+        paginator = aws_client.get_paginator('list_metrics')
+        for response in paginator.paginate(Namespace=self.namespace, Dimensions=[{'Name': self.dimension_name},]):
+            for metric in response.get('Metrics', list()):
+                dimensions = metric.get('Dimensions', list())
+                if 'MetricName' not in metric or len(dimensions) != 1 or dimensions[0].get('Name') != self.dimension_name:
+                    continue
+                metric_names = metrics_by_dimension_value.setdefault(dimensions[0]['Value'], list())
+                if metric['MetricName'] not in metric_names:
+                    metric_names.append(metric['MetricName'])
+        return metrics_by_dimension_value
+
+    def build(self, aws_client, account_id: str=None, response_cache: ResponseCache=None)->bool:
+        '''Build the index with a list_metrics sweep. When response_cache is
+        enabled, the result of the sweep is looked up in the cache first and
+        reused for its recent_ttl; account_id is part of the cache key.'''
+        try:
+            if response_cache is not None and response_cache.is_enabled() is True:
+                request = {
+                    'Operation': 'ListMetrics',
+                    'AccountId': account_id,
+                    'Region': aws_client.meta.region_name,
+                    'Namespace': self.namespace,
+                    'Dimensions': [{'Name': self.dimension_name},],
+                }
+                metrics_by_dimension_value = response_cache.get_or_fetch(request=request, fetch_function=lambda: self._list_metrics(aws_client=aws_client))
+            else:
+                metrics_by_dimension_value = self._list_metrics(aws_client=aws_client)
+        except:
+            self.log_wrapper.error(message='EXCEPTION: {}'.format(traceback.format_exc()))
+            return False
+        self.metrics_by_dimension_value = metrics_by_dimension_value
+        self.build_time = time.monotonic()
+        metric_count = sum(len(metric_names) for metric_names in metrics_by_dimension_value.values())
+        self.log_wrapper.info(message='Indexed {} metrics of {} resources in namespace "{}"'.format(metric_count, len(metrics_by_dimension_value), self.namespace))
+        return True
+
+    def has_resource(self, dimension_value: str)->bool:
+        return dimension_value in self.metrics_by_dimension_value
+
+    def get_metrics(self, dimension_value: str)->list:
+        return list(self.metrics_by_dimension_value.get(dimension_value, list()))
+
+    def age(self)->float:
+        if self.build_time is None:
+            return None
+        return time.monotonic() - self.build_time
+
+
+class MetricIndexCache:
+    '''Thread safe cache of metric indexes per (account, region, namespace).
+    An index is built on first use (only once, even when several threads ask
+    for it at the same time) and rebuilt once it is older than ttl seconds.
+    '''
+
+    def __init__(self, ttl: int=DEFAULT_METRIC_INDEX_TTL, log_wrapper: LogWrapper=LogWrapper()):
+        self.ttl = ttl
+        self.log_wrapper = log_wrapper
+        self._lock = threading.Lock()
+        self._indexes = dict()
+        self._index_locks = dict()
+
+    def get_index(
+        self,
+        aws_client,
+        account: str,
+        region: str,
+        namespace: str,
+        dimension_name: str,
+        account_id: str=None,
+        response_cache: ResponseCache=None
+    )->MetricIndex:
+        '''Return the index, or None when it could not be built. When a
+        rebuild fails, the previous index is returned. account_id and
+        response_cache are passed to MetricIndex.build().'''
+        key = (account, region, namespace)
+        with self._lock:
+            if key not in self._index_locks:
+                self._index_locks[key] = threading.Lock()
+            index_lock = self._index_locks[key]
+        with index_lock:
+            index = self._indexes.get(key, None)
+            if index is None or (self.ttl is not None and index.age() > self.ttl):
+                new_index = MetricIndex(namespace=namespace, dimension_name=dimension_name, log_wrapper=self.log_wrapper)
+                if new_index.build(aws_client=aws_client, account_id=account_id, response_cache=response_cache) is True:
+                    self._indexes[key] = new_index
+                    index = new_index
+            return index
+
+    def clear(self):
+        with self._lock:
+            self._indexes = dict()
+
+
+_default_metric_index_cache = None
+_default_metric_index_cache_lock = threading.Lock()
+
+
+def get_default_metric_index_cache(log_wrapper: LogWrapper=LogWrapper())->MetricIndexCache:
+    global _default_metric_index_cache
+    with _default_metric_index_cache_lock:
+        if _default_metric_index_cache is None:
+            _default_metric_index_cache = MetricIndexCache(log_wrapper=log_wrapper)
+        return _default_metric_index_cache
+
+# EOF
@@ -0,0 +1,87 @@
+import math
+from array import array
+from datetime import datetime, timezone
+
+
+def to_epoch(timestamp)->int:
+    if hasattr(timestamp, 'timestamp'):
+        return int(timestamp.timestamp())
+    return int(timestamp)
+
+
+class MetricSeries:
+    '''Compact storage of the datapoints of one metric.
+
+    The timestamps (seconds since the epoch) are stored in an int64 array and
+    the values of every statistic in a float64 array of the same length, NaN
+    marking a missing value. This takes about 8 bytes per timestamp plus 8
+    bytes per statistic, instead of a dict with a datetime and float objects
+    per datapoint.
+
+    Iterating over a series yields the datapoints in the format returned by
+    boto3 get_metric_statistics (dicts with a Timestamp datetime, one key per
+    statistic and the Unit), so code written for lists of datapoints keeps
+    working.
+    '''
+
+    __slots__ = ('timestamps', 'values', 'unit')
+
+    def __init__(self, statistics: tuple=(), unit: str=None):
+        self.timestamps = array('q')
+        self.values = dict()
+        for statistic in statistics:
+            self.values[statistic] = array('d')
+        self.unit = unit
+
+    @classmethod
+    def from_datapoints(cls, datapoints: list):
+        '''Build a series, sorted by timestamp, from a list of datapoint dicts
+        (or return datapoints as is when it already is a MetricSeries).'''
+        if isinstance(datapoints, MetricSeries):
+            return datapoints
+        statistics = list()
+        unit = None
+        for datapoint in datapoints:
+            for key in datapoint:
+                if key == 'Unit':
+                    unit = datapoint[key]
+                elif key != 'Timestamp' and key not in statistics:
+                    statistics.append(key)
+        series = cls(statistics=tuple(statistics), unit=unit)
+        for datapoint in sorted(datapoints, key=lambda datapoint: to_epoch(datapoint['Timestamp'])):
+            series.timestamps.append(to_epoch(datapoint['Timestamp']))
+            for statistic, values in series.values.items():
+                values.append(datapoint.get(statistic, math.nan))
+        return series
+
+    def statistics(self)->list:
+        return list(self.values.keys())
+
+    def to_datapoints(self, epoch_timestamps: bool=False)->list:
+        '''Return the datapoints as a list of dicts. Timestamps are UTC
+        datetime objects, or seconds since the epoch with epoch_timestamps.'''
+        datapoints = list()
+        for index, timestamp in enumerate(self.timestamps):
+            if epoch_timestamps is True:
+                datapoint = {'Timestamp': timestamp}
+            else:
+                datapoint = {'Timestamp': datetime.fromtimestamp(timestamp, tz=timezone.utc)}
+            for statistic, values in self.values.items():
+                if not math.isnan(values[index]):
+                    datapoint[statistic] = values[index]
+            if self.unit is not None:
+                datapoint['Unit'] = self.unit
+            datapoints.append(datapoint)
+        return datapoints
+
+    def __len__(self)->int:
+        return len(self.timestamps)
+
+    def __iter__(self):
+        return iter(self.to_datapoints())
+
+    def memory_size(self)->int:
+        '''Bytes used by the timestamp and value arrays.'''
+        return self.timestamps.itemsize * len(self.timestamps) + sum(values.itemsize * len(values) for values in self.values.values())
+
+# EOF
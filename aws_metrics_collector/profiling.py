@@ -0,0 +1,326 @@
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+from aws_metrics_collector import LogWrapper
+
+
+MAX_TRACE_EVENTS = 200000      # Trace events kept in memory; later events are counted but dropped
+PROFILE_MODES = (
+    None,
+    'cprofile',
+    'pyinstrument',
+)
+
+
+class TimerStatistics:
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def add(self, duration: float):
+        self.count += 1
+        self.total_time += duration
+        if duration > self.max_time:
+            self.max_time = duration
+
+    def to_dict(self)->dict:
+        return {
+            'Count': self.count,
+            'TotalTime': round(self.total_time, 6),
+            'MeanTime': round(self.total_time / self.count, 6) if self.count > 0 else 0.0,
+            'MaxTime': round(self.max_time, 6),
+        }
+
+
+class ApiStatistics(TimerStatistics):
+
+    def __init__(self):
+        super().__init__()
+        self.attempts = 0
+        self.errors = 0
+        self.bytes_received = 0
+
+    def to_dict(self)->dict:
+        result = super().to_dict()
+        result['Attempts'] = self.attempts
+        result['Errors'] = self.errors
+        result['BytesReceived'] = self.bytes_received
+        return result
+
+
+class RunProfiler:
+    '''Timers of the phases of a run and of every AWS API, plus counters.
+
+    Phases are timed with the phase() context manager, which may be used from
+    any thread and nested; the time of a phase is the sum over all threads
+    that ran it. AWS API calls are timed through the botocore event system
+    (register_client(), done by the client pool for every client): calls,
+    attempts (including retries), errors, the time from sending the request
+    until the final response (excluding the wait for the rate limiter) and
+    the bytes of all response bodies received, per (service, API). Counters
+    are incremented with count().
+
+    With trace set, every phase and API call is also recorded as an event of
+    the Chrome trace event format, which can be written with write_trace()
+    and opened in chrome://tracing or https://ui.perfetto.dev.
+
+    A disabled profiler records nothing and phase() costs next to nothing.
+    '''
+
+    def __init__(self, enabled: bool=True, trace: bool=False, max_trace_events: int=MAX_TRACE_EVENTS, log_wrapper: LogWrapper=LogWrapper()):
+        self.enabled = enabled
+        self.trace = trace
+        self.max_trace_events = max_trace_events
+        self.log_wrapper = log_wrapper
+        self._lock = threading.Lock()
+        self._call_start = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.start_time = time.perf_counter()
+            self.phases = dict()
+            self.apis = dict()
+            self.counters = dict()
+            self.trace_events = list()
+            self.dropped_trace_events = 0
+
+    def _add_trace_event(self, name: str, category: str, start_time: float, duration: float, args: dict=None):
+        if len(self.trace_events) >= self.max_trace_events:
+            self.dropped_trace_events += 1
+            return
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': round((start_time - self.start_time) * 1000000.0, 1),
+            'dur': round(duration * 1000000.0, 1),
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+        }
+        if args is not None:
+            event['args'] = args
+        self.trace_events.append(event)
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        if self.enabled is False:
+            yield
+            return
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start_time
+            with self._lock:
+                if name not in self.phases:
+                    self.phases[name] = TimerStatistics()
+                self.phases[name].add(duration=duration)
+                if self.trace is True:
+                    self._add_trace_event(name=name, category='phase', start_time=start_time, duration=duration)
+
+    def count(self, name: str, value: int=1):
+        if self.enabled is False:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def _get_api_statistics(self, service: str, api: str)->ApiStatistics:
+        key = '{}/{}'.format(service, api)
+        if key not in self.apis:
+            self.apis[key] = ApiStatistics()
+        return self.apis[key]
+
+    def register_client(self, aws_client):
+        service = aws_client.meta.service_model.service_name
+        aws_client.meta.events.register('before-call', functools.partial(self._before_call, service), unique_id='profiler-before-call')
+        aws_client.meta.events.register('response-received', functools.partial(self._response_received, service), unique_id='profiler-response-received')
+        aws_client.meta.events.register('after-call', functools.partial(self._after_call, service), unique_id='profiler-after-call')
+
+    def _before_call(self, service, **kwargs):
+        self._call_start.time = time.perf_counter()
+
+    def _response_received(self, service, event_name: str='', response_dict=None, **kwargs):
+        if self.enabled is False:
+            return
+        api = event_name.split('.')[-1]     # response-received.<service id>.<API>
+        body = response_dict.get('body', None) if response_dict is not None else None
+        with self._lock:
+            api_statistics = self._get_api_statistics(service=service, api=api)
+            api_statistics.attempts += 1
+            if isinstance(body, (bytes, bytearray)):
+                api_statistics.bytes_received += len(body)
+
+    def _after_call(self, service, http_response=None, model=None, **kwargs):
+        if self.enabled is False:
+            return
+        end_time = time.perf_counter()
+        start_time = getattr(self._call_start, 'time', end_time)
+        duration = end_time - start_time
+        with self._lock:
+            api_statistics = self._get_api_statistics(service=service, api=model.name)
+            api_statistics.add(duration=duration)
+            status_code = http_response.status_code if http_response is not None else None
+            if status_code is None or status_code >= 300:
+                api_statistics.errors += 1
+            if self.trace is True:
+                self._add_trace_event(name='{}/{}'.format(service, model.name), category='api', start_time=start_time, duration=duration, args={'StatusCode': status_code})
+
+    def to_dict(self)->dict:
+        '''The run report.'''
+        with self._lock:
+            return {
+                'WallTime': round(time.perf_counter() - self.start_time, 6),
+                'Phases': {name: statistics.to_dict() for name, statistics in sorted(self.phases.items())},
+                'Apis': {name: statistics.to_dict() for name, statistics in sorted(self.apis.items())},
+                'Counters': dict(sorted(self.counters.items())),
+            }
+
+    def format_report(self)->str:
+        '''The run report as aligned text, the slowest phases and APIs first.'''
+        report = self.to_dict()
+        lines = ['Run report - wall time {:.3f} seconds'.format(report['WallTime']),]
+        lines.append('{:<40} {:>8} {:>12} {:>12}'.format('Phase', 'Count', 'Total (s)', 'Max (s)'))
+        for name, statistics in sorted(report['Phases'].items(), key=lambda item: -item[1]['TotalTime']):
+            lines.append('{:<40} {:>8} {:>12.3f} {:>12.3f}'.format(name, statistics['Count'], statistics['TotalTime'], statistics['MaxTime']))
+        lines.append('{:<40} {:>8} {:>12} {:>12} {:>8} {:>7} {:>12}'.format('API', 'Calls', 'Total (s)', 'Mean (ms)', 'Attempts', 'Errors', 'Bytes'))
+        for name, statistics in sorted(report['Apis'].items(), key=lambda item: -item[1]['TotalTime']):
+            lines.append('{:<40} {:>8} {:>12.3f} {:>12.1f} {:>8} {:>7} {:>12}'.format(name, statistics['Count'], statistics['TotalTime'], statistics['MeanTime'] * 1000.0, statistics['Attempts'], statistics['Errors'], statistics['BytesReceived']))
+        for name, value in report['Counters'].items():
+            lines.append('{:<40} {:>8}'.format(name, value))
+        return '\n'.join(lines)
+
+    def log_report(self):
+        for line in self.format_report().split('\n'):
+            self.log_wrapper.info(message=line)
+
+    def write_report(self, file_name: str):
+        '''Write the run report as JSON.'''
+        try:
+            with open(file_name, 'w') as f:
+                json.dump(self.to_dict(), f, indent=4)
+        except:
+            self.log_wrapper.error(message='EXCEPTION: {}'.format(traceback.format_exc()))
+
+    def write_trace(self, file_name: str):
+        '''Write the recorded events in the Chrome trace event format.'''
+        try:
+            with self._lock:
+                trace = {
+                    'traceEvents': list(self.trace_events),
+                    'displayTimeUnit': 'ms',
+                    'otherData': {'DroppedEvents': self.dropped_trace_events},
+                }
+            with open(file_name, 'w') as f:
+                json.dump(trace, f)
+            self.log_wrapper.info(message='Wrote {} trace events to "{}"'.format(len(trace['traceEvents']), file_name))
+        except:
+            self.log_wrapper.error(message='EXCEPTION: {}'.format(traceback.format_exc()))
+
+
+class _ThreadedCProfile:
+    '''cProfile of the calling thread and of every thread started while it
+    is enabled (cProfile itself only profiles the thread that enables it).'''
+
+    def __init__(self):
+        import cProfile
+        self._profile_class = cProfile.Profile
+        self._lock = threading.Lock()
+        self._profiles = list()
+
+    def _start_thread_profile(self, frame, event, arg):
+        sys.setprofile(None)
+        profile = self._profile_class()
+        try:
+            profile.enable()
+        except ValueError:
+            return  # Another profiler is active (on Python 3.12+ a single profiler sees all threads)
+        with self._lock:
+            self._profiles.append(profile)
+
+    def enable(self):
+        profile = self._profile_class()
+        self._profiles.append(profile)
+        threading.setprofile(self._start_thread_profile)
+        profile.enable()
+
+    def disable(self):
+        threading.setprofile(None)
+        self._profiles[0].disable()
+
+    def dump_stats(self, file_name: str):
+        import pstats
+        with self._lock:
+            profiles = list(self._profiles)
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(file_name)
+
+
+def run_with_profiler(function, mode: str=None, output_file: str=None, log_wrapper: LogWrapper=LogWrapper()):
+    '''Run function() under a profiler and write the profile to output_file:
+    a pstats file with 'cprofile' (all threads; view it with python3 -m pstats
+    or snakeviz) or an HTML report with 'pyinstrument' (requires the optional
+    pyinstrument package; samples the calling thread only). Without a mode,
+    function() is just called.'''
+    if mode not in PROFILE_MODES:
+        raise Exception('Profile mode "{}" is not supported. Supported: {}'.format(mode, PROFILE_MODES))
+    if mode is None:
+        return function()
+    if mode == 'cprofile':
+        profiler = _ThreadedCProfile()
+        profiler.enable()
+        try:
+            return function()
+        finally:
+            profiler.disable()
+            profiler.dump_stats(file_name=output_file)
+            log_wrapper.info(message='Wrote the cProfile statistics to "{}"'.format(output_file))
+    try:
+        import pyinstrument
+    except ImportError:
+        raise Exception('The pyinstrument profile mode requires the pyinstrument package: pip3 install pyinstrument')
+    profiler = pyinstrument.Profiler()
+    profiler.start()
+    try:
+        return function()
+    finally:
+        profiler.stop()
+        with open(output_file, 'w') as f:
+            f.write(profiler.output_html())
+        log_wrapper.info(message='Wrote the pyinstrument profile to "{}"'.format(output_file))
+
+
+_default_profiler = None
+_default_profiler_lock = threading.Lock()
+
+
+def get_default_profiler(log_wrapper: LogWrapper=LogWrapper())->RunProfiler:
+    global _default_profiler
+    with _default_profiler_lock:
+        if _default_profiler is None:
+            _default_profiler = RunProfiler(log_wrapper=log_wrapper)
+        return _default_profiler
+
+
+def configure_default_profiler(enabled: bool=True, trace: bool=False, max_trace_events: int=MAX_TRACE_EVENTS, log_wrapper: LogWrapper=LogWrapper())->RunProfiler:
+    '''Reconfigure and reset the process wide profiler. The profiler object
+    itself is kept, as the clients of the client pool are registered with
+    it.'''
+    profiler = get_default_profiler(log_wrapper=log_wrapper)
+    profiler.enabled = enabled
+    profiler.trace = trace
+    profiler.max_trace_events = max_trace_events
+    profiler.log_wrapper = log_wrapper
+    profiler.reset()
+    return profiler
+
+# EOF
@@ -0,0 +1,262 @@
+import math
+import re
+import threading
+import time
+import traceback
+from aws_metrics_collector import LogWrapper
+from aws_metrics_collector.metric_series import MetricSeries
+from aws_metrics_collector.throttling import get_default_rate_limiter
+
+
+DEFAULT_PORT = 9107
+DEFAULT_REFRESH_INTERVAL = 15   # Seconds between refreshes of the collector telemetry
+METRIC_PREFIX = 'aws_metrics_collector'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def to_metric_name(name: str)->str:
+    '''Convert a CloudWatch metric name (for example CPUUtilization) to a
+    Prometheus metric name part (cpu_utilization).'''
+    name = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', name)
+    name = re.sub('([a-z0-9])([A-Z])', r'\1_\2', name)
+    return re.sub('[^a-zA-Z0-9_]', '_', name).lower()
+
+
+def to_label_name(name: str)->str:
+    name = re.sub('[^a-zA-Z0-9_]', '_', name)
+    if re.match('[0-9]', name):
+        name = '_{}'.format(name)
+    return name
+
+
+def escape_label_value(value)->str:
+    return '{}'.format(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_sample(name: str, labels: dict, value)->str:
+    if len(labels) == 0:
+        return '{} {}'.format(name, float(value))
+    return '{}{{{}}} {}'.format(name, ','.join('{}="{}"'.format(label, escape_label_value(label_value)) for label, label_value in labels.items()), float(value))
+
+
+def render_families(families: dict)->str:
+    '''Render {name: (type, help, [sample lines])} in the Prometheus text
+    exposition format.'''
+    lines = list()
+    for name, family in families.items():
+        metric_type, metric_help, samples = family
+        lines.append('# HELP {} {}'.format(name, metric_help))
+        lines.append('# TYPE {} {}'.format(name, metric_type))
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n' if len(lines) > 0 else ''
+
+
+def get_latest_values(datapoints)->dict:
+    '''Return the value and timestamp of the newest datapoint of every
+    statistic, as {statistic: (value, epoch timestamp)}.'''
+    latest_values = dict()
+    series = MetricSeries.from_datapoints(datapoints=datapoints)
+    for statistic, values in series.values.items():
+        for index in range(len(values) - 1, -1, -1):
+            if not math.isnan(values[index]):
+                latest_values[statistic] = (values[index], series.timestamps[index])
+                break
+    return latest_values
+
+
+class PrometheusExporter:
+    '''Serve the latest collected CloudWatch values and the collector's own
+    telemetry on an HTTP /metrics endpoint in the Prometheus text format.
+
+    Collected values are gauges named aws_<class>_<metric> (for example
+    aws_ec2_cpu_utilization) with the statistic, account, region, instance ID,
+    instance type and the tags of the instance (as tag_<key>) as labels.
+    Instances are recorded with record_instance() during a collection cycle
+    and become visible with publish() at the end of the cycle. When a metric
+    has no new datapoint in a cycle, its previous value is kept.
+
+    Scrapes never wait for collection: both the collected values (rendered by
+    publish()) and the telemetry (rendered every refresh_interval seconds)
+    are precomputed snapshots, and a scrape only returns them.
+    '''
+
+    def __init__(
+        self,
+        port: int=DEFAULT_PORT,
+        address: str='',
+        rate_limiter=None,
+        scheduler=None,
+        collection_progress=None,
+        refresh_interval: float=DEFAULT_REFRESH_INTERVAL,
+        log_wrapper: LogWrapper=LogWrapper()
+    ):
+        self.port = port
+        self.address = address
+        self.rate_limiter = rate_limiter if rate_limiter is not None else get_default_rate_limiter(log_wrapper=log_wrapper)
+        self.scheduler = scheduler
+        self.collection_progress = collection_progress
+        self.refresh_interval = refresh_interval
+        self.log_wrapper = log_wrapper
+        self.scrape_count = 0
+        self._lock = threading.Lock()
+        self._pending_instances = dict()
+        self._published_instances = dict()
+        self._instance_snapshot = ''
+        self._telemetry_snapshot = ''
+        self._publish_time = None
+        self._stop_event = threading.Event()
+        self._server = None
+        self._threads = list()
+
+    def record_instance(self, instance):
+        '''Record the latest values of an instance for the next publish().
+        Thread safe, so it can be used as (part of) an instance_handler.'''
+        key = (instance.account_id, instance.instance_class, instance.region, instance.instance_id)
+        labels = {
+            'account_id': instance.account_id,
+            'region': instance.region,
+            'instance_id': instance.instance_id,
+            'instance_type': instance.instance_type,
+        }
+        for tag_key, tag_value in sorted(instance.tags.items()):
+            label_name = 'tag_{}'.format(to_label_name(tag_key))
+            if label_name not in labels:    # Tag keys that only differ in characters that are invalid in label names
+                labels[label_name] = tag_value
+        values = dict()
+        for metric_name, datapoints in instance.metric_statistics.items():
+            for statistic, latest_value in get_latest_values(datapoints=datapoints).items():
+                values[(metric_name, statistic)] = latest_value
+        with self._lock:
+            previous_values = self._published_instances.get(key, (None, None, dict()))[2]
+            merged_values = dict(previous_values)
+            merged_values.update(values)
+            self._pending_instances[key] = (instance.instance_class, labels, merged_values)
+
+    def record_instances(self, instances: list):
+        for instance in instances:
+            self.record_instance(instance=instance)
+
+    def publish(self):
+        '''Replace the published values with the instances recorded since the
+        previous publish() and render the snapshot served to scrapes.'''
+        with self._lock:
+            self._published_instances = self._pending_instances
+            self._pending_instances = dict()
+            published_instances = self._published_instances
+        families = dict()
+        for instance_class, labels, values in published_instances.values():
+            for (metric_name, statistic), (value, timestamp) in sorted(values.items()):
+                family_name = 'aws_{}_{}'.format(to_metric_name(instance_class), to_metric_name(metric_name))
+                if family_name not in families:
+                    families[family_name] = ('gauge', 'Latest value of the CloudWatch metric {} of {} instances'.format(metric_name, instance_class), list())
+                sample_labels = {'statistic': statistic}
+                sample_labels.update(labels)
+                families[family_name][2].append(format_sample(name=family_name, labels=sample_labels, value=value))
+        self._instance_snapshot = render_families(families=families)
+        self._publish_time = time.time()
+        self.refresh_telemetry()
+        self.log_wrapper.info(message='Published the latest values of {} instances'.format(len(published_instances)))
+
+    def refresh_telemetry(self):
+        '''Render the collector telemetry snapshot.'''
+        families = dict()
+
+        def add(name: str, metric_type: str, metric_help: str, labels: dict, value):
+            full_name = '{}_{}'.format(METRIC_PREFIX, name)
+            if full_name not in families:
+                families[full_name] = (metric_type, metric_help, list())
+            sample_name = full_name
+            if metric_type == 'summary':
+                sample_name = '{}_{}'.format(full_name, labels.pop('suffix'))
+            families[full_name][2].append(format_sample(name=sample_name, labels=labels, value=value))
+
+        try:
+            for (account, region, api), statistics in sorted(self.rate_limiter.get_statistics_by_key().items(), key=lambda item: ('{}'.format(item[0][0]), item[0][1], item[0][2])):
+                labels = {'profile': account if account is not None else 'default', 'region': region, 'api': api}
+                add('api_calls_total', 'counter', 'AWS API calls', dict(labels), statistics['Calls'])
+                add('api_errors_total', 'counter', 'AWS API calls that failed', dict(labels), statistics['Errors'])
+                add('api_throttles_total', 'counter', 'Throttled AWS API attempts', dict(labels), statistics['Throttles'])
+                add('api_throttled_failures_total', 'counter', 'AWS API calls that failed after being throttled on every attempt', dict(labels), statistics['ThrottledFailures'])
+                add('api_latency_seconds', 'summary', 'Latency of AWS API calls, including retries', dict(labels, suffix='sum'), statistics['Latency'])
+                add('api_latency_seconds', 'summary', 'Latency of AWS API calls, including retries', dict(labels, suffix='count'), statistics['Successes'] + statistics['Errors'])
+                add('api_rate_limit_wait_seconds_total', 'counter', 'Time spent waiting for the rate limiter', dict(labels), statistics['WaitTime'])
+                add('api_rate_limit', 'gauge', 'Current request rate limit per second', dict(labels), statistics['RateLimit'])
+            if self.scheduler is not None:
+                add('cycles_total', 'counter', 'Collection cycles started', dict(), self.scheduler.cycle_count)
+                add('cycles_skipped_total', 'counter', 'Collection cycles skipped because the previous cycle was still running', dict(), self.scheduler.skipped_cycle_count)
+                add('cycles_failed_total', 'counter', 'Collection cycles that failed', dict(), self.scheduler.failed_cycle_count)
+                if self.scheduler.last_cycle_duration is not None:
+                    add('cycle_duration_seconds', 'gauge', 'Duration of the last completed collection cycle', dict(), self.scheduler.last_cycle_duration)
+                add('cycle_running', 'gauge', '1 while a collection cycle is running', dict(), 1 if self.scheduler.is_cycle_running() is True else 0)
+            if self.collection_progress is not None:
+                progress = self.collection_progress.to_dict()
+                add('collection_tasks_queued', 'gauge', 'Account/service/region collection tasks waiting for a worker', dict(), progress['TasksQueued'])
+                add('collection_tasks_running', 'gauge', 'Account/service/region collection tasks running', dict(), progress['TasksRunning'])
+                add('collection_tasks_completed_total', 'counter', 'Account/service/region collection tasks completed', dict(), progress['TasksCompleted'])
+            with self._lock:
+                instance_count = len(self._published_instances)
+            add('instances', 'gauge', 'Instances in the published snapshot', dict(), instance_count)
+            if self._publish_time is not None:
+                add('last_publish_timestamp_seconds', 'gauge', 'Time the snapshot of collected values was published', dict(), self._publish_time)
+            add('scrapes_total', 'counter', 'Scrapes of the /metrics endpoint', dict(), self.scrape_count)
+            self._telemetry_snapshot = render_families(families=families)
+        except:
+            self.log_wrapper.error(message='EXCEPTION: {}'.format(traceback.format_exc()))
+
+    def render(self)->bytes:
+        '''The current snapshot, as served on /metrics.'''
+        self.scrape_count += 1
+        return (self._instance_snapshot + self._telemetry_snapshot).encode('utf-8')
+
+    def _refresh_telemetry_periodically(self):
+        while not self._stop_event.wait(timeout=self.refresh_interval):
+            self.refresh_telemetry()
+
+    def start(self):
+        '''Start serving /metrics (and refreshing the telemetry) in background
+        threads.'''
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+        exporter = self
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = exporter.render()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                exporter.log_wrapper.debug(message='{} - {}'.format(self.address_string(), format % args))
+
+        class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.refresh_telemetry()
+        self._stop_event.clear()
+        self._server = ThreadingHTTPServer((self.address, self.port), MetricsRequestHandler)
+        self._threads = [
+            threading.Thread(target=self._server.serve_forever, name='prometheus-exporter', daemon=True),
+            threading.Thread(target=self._refresh_telemetry_periodically, name='prometheus-telemetry', daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        self.log_wrapper.info(message='Serving Prometheus metrics on port {}'.format(self._server.server_address[1]))
+
+    def stop(self):
+        self._stop_event.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        for thread in self._threads:
+            thread.join()
+        self._threads = list()
+
+# EOF
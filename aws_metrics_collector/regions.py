@@ -0,0 +1,104 @@
+import json
+import os
+import threading
+import traceback
+from aws_metrics_collector import LogWrapper
+from aws_metrics_collector import get_utc_timestamp
+
+
+class RegionCatalog:
+    '''Cache of the regions in which each service is available.
+
+    The regions of a service are only looked up once (building a boto3 session
+    and loading the endpoint data) and are then reused until ttl seconds have
+    passed (never expiring when ttl is None). When cache_file is set, the
+    catalog is also persisted to that JSON file so that a following run can
+    start without loading the endpoint data.
+
+    When allowed_regions is set, that list is returned for every service as
+    is and the endpoint data is never loaded.
+    '''
+
+    def __init__(self, ttl: int=None, cache_file: str=None, allowed_regions: list=None, log_wrapper: LogWrapper=LogWrapper()):
+        self.ttl = ttl
+        self.cache_file = cache_file
+        self.allowed_regions = allowed_regions
+        self.log_wrapper = log_wrapper
+        self._lock = threading.Lock()
+        self._catalog = dict()
+        self._load_cache_file()
+
+    def _is_fresh(self, entry: dict)->bool:
+        if self.ttl is None:
+            return True
+        return (get_utc_timestamp(with_decimal=False) - entry['Timestamp']) < self.ttl
+
+    def _load_cache_file(self):
+        if self.cache_file is None or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r') as f:
+                catalog = json.load(f)
+            for service, entry in catalog.items():
+                if 'Timestamp' in entry and 'Regions' in entry:
+                    self._catalog[service] = entry
+            self.log_wrapper.info(message='Loaded region catalog for {} services from "{}"'.format(len(self._catalog), self.cache_file))
+        except:
+            self.log_wrapper.error(message='EXCEPTION: {}'.format(traceback.format_exc()))
+
+    def _save_cache_file(self):
+        if self.cache_file is None:
+            return
+        try:
+            tmp_file = '{}.tmp'.format(self.cache_file)
+            with open(tmp_file, 'w') as f:
+                json.dump(self._catalog, f)
+            os.replace(tmp_file, self.cache_file)
+        except:
+            self.log_wrapper.error(message='EXCEPTION: {}'.format(traceback.format_exc()))
+
+    def get_regions(self, service: str='ec2')->list:
+        if self.allowed_regions is not None:
+            return list(self.allowed_regions)
+        with self._lock:
+            entry = self._catalog.get(service, None)
+            if entry is None or self._is_fresh(entry) is False:
+                self.log_wrapper.info(message='Looking up the regions of service "{}"'.format(service))
+                import boto3
+                entry = {
+                    'Timestamp': get_utc_timestamp(with_decimal=False),
+                    'Regions': list(boto3.session.Session().get_available_regions(service)),
+                }
+                self._catalog[service] = entry
+                self._save_cache_file()
+            return list(entry['Regions'])
+
+    def clear(self):
+        with self._lock:
+            self._catalog = dict()
+
+
+_default_region_catalog = None
+_default_region_catalog_lock = threading.Lock()
+
+
+def get_default_region_catalog(log_wrapper: LogWrapper=LogWrapper())->RegionCatalog:
+    global _default_region_catalog
+    with _default_region_catalog_lock:
+        if _default_region_catalog is None:
+            _default_region_catalog = RegionCatalog(log_wrapper=log_wrapper)
+        return _default_region_catalog
+
+
+def configure_default_region_catalog(
+    ttl: int=None,
+    cache_file: str=None,
+    allowed_regions: list=None,
+    log_wrapper: LogWrapper=LogWrapper()
+)->RegionCatalog:
+    global _default_region_catalog
+    with _default_region_catalog_lock:
+        _default_region_catalog = RegionCatalog(ttl=ttl, cache_file=cache_file, allowed_regions=allowed_regions, log_wrapper=log_wrapper)
+        return _default_region_catalog
+
+# EOF
@@ -0,0 +1,227 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from aws_metrics_collector import LogWrapper
+
+
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024    # Bytes of compressed responses kept on disk
+DEFAULT_RECENT_TTL = 300        # Seconds a response of a window that is not yet closed (or of list_metrics) is reused
+DEFAULT_SETTLE_TIME = 3600      # Seconds after the end of a window before it is considered closed (CloudWatch datapoints can arrive late)
+ENTRY_FILE_EXTENSION = '.json.gz'
+
+
+def get_request_key(request: dict)->str:
+    '''The content address of a request: the SHA-256 of its canonical JSON.'''
+    return hashlib.sha256(json.dumps(request, sort_keys=True, separators=(',', ':'), default=str).encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    '''Persistent cache of AWS API responses, stored as gzip compressed JSON
+    files in cache_dir and addressed by the SHA-256 of the request.
+
+    A response of a closed window (a time range that ended more than
+    settle_time seconds ago) never changes and is kept forever; any other
+    response is reused for recent_ttl seconds. When the files take more than
+    max_size bytes, the least recently used are removed. The order of use is
+    kept in the modification time of the files, so it survives restarts.
+
+    With offline set, expired entries are still used and a request that is
+    not cached fails instead of calling AWS.
+
+    Without a cache_dir the cache is disabled: nothing is stored and every
+    request calls AWS.
+    '''
+
+    def __init__(
+        self,
+        cache_dir: str=None,
+        max_size: int=DEFAULT_MAX_SIZE,
+        recent_ttl: int=DEFAULT_RECENT_TTL,
+        settle_time: int=DEFAULT_SETTLE_TIME,
+        offline: bool=False,
+        log_wrapper: LogWrapper=LogWrapper()
+    ):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.recent_ttl = recent_ttl
+        self.settle_time = settle_time
+        self.offline = offline
+        self.log_wrapper = log_wrapper
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key: size in bytes, least recently used first
+        self._size = 0
+        self._scan_cache_dir()
+
+    def is_enabled(self)->bool:
+        return self.cache_dir is not None
+
+    def _get_entry_file(self, key: str)->str:
+        return os.path.join(self.cache_dir, key[:2], '{}{}'.format(key, ENTRY_FILE_EXTENSION))
+
+    def _scan_cache_dir(self):
+        if self.cache_dir is None:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            entries = list()
+            for directory in os.scandir(self.cache_dir):
+                if not directory.is_dir():
+                    continue
+                for entry in os.scandir(directory.path):
+                    if entry.name.endswith(ENTRY_FILE_EXTENSION):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, entry.name[:-len(ENTRY_FILE_EXTENSION)], stat.st_size))
+            for mtime, key, size in sorted(entries):
+                self._entries[key] = size
+                self._size += size
+            self.log_wrapper.info(message='Response cache "{}": {} entries, {} bytes'.format(self.cache_dir, len(self._entries), self._size))
+        except:
+            self.log_wrapper.error(message='EXCEPTION: {}'.format(traceback.format_exc()))
+
+    def get_expires(self, window_end: float=None)->float:
+        '''The expiry time of a response of a window that ends at window_end
+        (epoch seconds), or None when the window is closed.'''
+        now = time.time()
+        if window_end is not None and window_end + self.settle_time <= now:
+            return None
+        return now + self.recent_ttl
+
+    def get(self, request: dict):
+        '''Return the cached response of the request, or None.'''
+        if self.cache_dir is None:
+            return None
+        key = get_request_key(request=request)
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+        entry_file = self._get_entry_file(key=key)
+        try:
+            with gzip.open(entry_file, 'rt', encoding='utf-8') as f:
+                entry = json.load(f)
+            if self.offline is False and entry['Expires'] is not None and entry['Expires'] < time.time():
+                with self._lock:
+                    self.misses += 1
+                return None
+            os.utime(entry_file)
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                self.hits += 1
+            return entry['Response']
+        except:
+            self.log_wrapper.error(message='EXCEPTION reading "{}": {}'.format(entry_file, traceback.format_exc()))
+            self._remove(key=key)
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, request: dict, response, expires: float=None):
+        '''Store the response of the request, to be reused until expires
+        (epoch seconds, None = forever). The response must be JSON
+        serializable.'''
+        if self.cache_dir is None:
+            return
+        key = get_request_key(request=request)
+        entry_file = self._get_entry_file(key=key)
+        try:
+            os.makedirs(os.path.dirname(entry_file), exist_ok=True)
+            tmp_file = '{}.{}.tmp'.format(entry_file, threading.get_ident())
+            with gzip.open(tmp_file, 'wt', encoding='utf-8') as f:
+                json.dump({'Request': request, 'Expires': expires, 'Response': response}, f, separators=(',', ':'), default=str)
+            size = os.path.getsize(tmp_file)
+            os.replace(tmp_file, entry_file)
+            with self._lock:
+                self._size += size - self._entries.pop(key, 0)
+                self._entries[key] = size
+            self._evict()
+        except:
+            self.log_wrapper.error(message='EXCEPTION: {}'.format(traceback.format_exc()))
+
+    def _remove(self, key: str):
+        with self._lock:
+            self._size -= self._entries.pop(key, 0)
+        try:
+            os.remove(self._get_entry_file(key=key))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        while True:
+            with self._lock:
+                if self._size <= self.max_size or len(self._entries) <= 1:
+                    return
+                key = next(iter(self._entries))
+                self.evictions += 1
+            self._remove(key=key)
+
+    def get_or_fetch(self, request: dict, fetch_function, window_end: float=None):
+        '''Return the cached response of the request, or call fetch_function()
+        and cache its result (see get_expires() for how long).'''
+        response = self.get(request=request)
+        if response is not None:
+            return response
+        if self.offline is True:
+            raise Exception('The response of {} is not cached and the response cache is offline'.format(request))
+        response = fetch_function()
+        self.put(request=request, response=response, expires=self.get_expires(window_end=window_end))
+        return response
+
+    def clear(self):
+        with self._lock:
+            keys = list(self._entries)
+        for key in keys:
+            self._remove(key=key)
+
+    def to_dict(self)->dict:
+        with self._lock:
+            return {
+                'Entries': len(self._entries),
+                'Size': self._size,
+                'Hits': self.hits,
+                'Misses': self.misses,
+                'Evictions': self.evictions,
+            }
+
+
+_default_response_cache = None
+_default_response_cache_lock = threading.Lock()
+
+
+def get_default_response_cache(log_wrapper: LogWrapper=LogWrapper())->ResponseCache:
+    global _default_response_cache
+    with _default_response_cache_lock:
+        if _default_response_cache is None:
+            _default_response_cache = ResponseCache(log_wrapper=log_wrapper)
+        return _default_response_cache
+
+
+def configure_default_response_cache(
+    cache_dir: str=None,
+    max_size: int=DEFAULT_MAX_SIZE,
+    recent_ttl: int=DEFAULT_RECENT_TTL,
+    settle_time: int=DEFAULT_SETTLE_TIME,
+    offline: bool=False,
+    log_wrapper: LogWrapper=LogWrapper()
+)->ResponseCache:
+    global _default_response_cache
+    with _default_response_cache_lock:
+        _default_response_cache = ResponseCache(
+            cache_dir=cache_dir,
+            max_size=max_size,
+            recent_ttl=recent_ttl,
+            settle_time=settle_time,
+            offline=offline,
+            log_wrapper=log_wrapper
+        )
+        return _default_response_cache
+
+# EOF
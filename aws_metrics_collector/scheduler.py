@@ -0,0 +1,88 @@
+import random
+import threading
+import time
+import traceback
+from aws_metrics_collector import LogWrapper
+
+
+DEFAULT_INTERVAL = 300  # Seconds between the start of two collection cycles
+DEFAULT_JITTER = 30     # Maximum random delay, in seconds, added to the start of every cycle
+
+
+class CollectionScheduler:
+    '''Run cycle_function every interval seconds (plus a random delay of up
+    to jitter seconds) until stop() is called.
+
+    Every cycle runs in its own thread, so the schedule does not drift when a
+    cycle is slow. When a cycle is still running at the time the next one is
+    due, the next one is skipped instead of running both at the same time.
+    Exceptions of cycle_function are logged and do not stop the scheduler.
+    '''
+
+    def __init__(
+        self,
+        cycle_function,
+        interval: float=DEFAULT_INTERVAL,
+        jitter: float=DEFAULT_JITTER,
+        log_wrapper: LogWrapper=LogWrapper()
+    ):
+        self.cycle_function = cycle_function
+        self.interval = interval
+        self.jitter = jitter
+        self.log_wrapper = log_wrapper
+        self.cycle_count = 0
+        self.skipped_cycle_count = 0
+        self.failed_cycle_count = 0
+        self.last_cycle_duration = None
+        self._stop_event = threading.Event()
+        self._cycle_thread = None
+        self._lock = threading.Lock()
+
+    def _run_cycle(self, cycle_number: int):
+        self.log_wrapper.info(message='Starting collection cycle {}'.format(cycle_number))
+        start_time = time.monotonic()
+        failed = False
+        try:
+            self.cycle_function()
+        except:
+            failed = True
+            self.log_wrapper.error(message='EXCEPTION in collection cycle {}: {}'.format(cycle_number, traceback.format_exc()))
+        duration = time.monotonic() - start_time
+        with self._lock:
+            self.last_cycle_duration = duration
+            if failed is True:
+                self.failed_cycle_count += 1
+        self.log_wrapper.info(message='Collection cycle {} took {:.3f} seconds'.format(cycle_number, duration))
+
+    def is_cycle_running(self)->bool:
+        return self._cycle_thread is not None and self._cycle_thread.is_alive()
+
+    def run_forever(self):
+        '''Run cycles until stop() is called (from another thread or a signal
+        handler), then wait for the running cycle to finish.'''
+        self.log_wrapper.info(message='Scheduling a collection cycle every {} seconds (jitter {} seconds)'.format(self.interval, self.jitter))
+        schedule_start = time.monotonic()
+        tick = 0
+        while not self._stop_event.is_set():
+            due_time = schedule_start + tick * self.interval + random.uniform(0, self.jitter)
+            tick += 1
+            if self._stop_event.wait(timeout=max(0.0, due_time - time.monotonic())):
+                break
+            if self.is_cycle_running() is True:
+                with self._lock:
+                    self.skipped_cycle_count += 1
+                self.log_wrapper.warning(message='The previous collection cycle is still running - skipping this cycle')
+                continue
+            with self._lock:
+                self.cycle_count += 1
+                cycle_number = self.cycle_count
+            self._cycle_thread = threading.Thread(target=self._run_cycle, args=(cycle_number,), name='collection-cycle-{}'.format(cycle_number), daemon=True)
+            self._cycle_thread.start()
+        if self._cycle_thread is not None:
+            self._cycle_thread.join()
+        self.log_wrapper.info(message='Scheduler stopped after {} cycles ({} skipped, {} failed)'.format(self.cycle_count, self.skipped_cycle_count, self.failed_cycle_count))
+
+    def stop(self):
+        self._stop_event.set()
+
+# EOF
@@ -0,0 +1,195 @@
+import math
+import sqlite3
+import threading
+import traceback
+from aws_metrics_collector import LogWrapper
+from aws_metrics_collector.metric_series import MetricSeries, to_epoch
+
+
+DEFAULT_BATCH_SIZE = 5000
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS instances (
+        id INTEGER PRIMARY KEY,
+        account_id TEXT NOT NULL,
+        instance_class TEXT NOT NULL,
+        region TEXT NOT NULL,
+        instance_id TEXT NOT NULL,
+        instance_type TEXT,
+        state TEXT,
+        last_update INTEGER,
+        UNIQUE (account_id, instance_class, region, instance_id)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS tags (
+        instance_ref INTEGER NOT NULL REFERENCES instances (id),
+        key TEXT NOT NULL,
+        value TEXT,
+        PRIMARY KEY (instance_ref, key)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS metrics (
+        id INTEGER PRIMARY KEY,
+        instance_ref INTEGER NOT NULL REFERENCES instances (id),
+        metric_name TEXT NOT NULL,
+        UNIQUE (instance_ref, metric_name)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS datapoints (
+        metric_ref INTEGER NOT NULL REFERENCES metrics (id),
+        timestamp INTEGER NOT NULL,
+        statistic TEXT NOT NULL,
+        value REAL,
+        unit TEXT,
+        PRIMARY KEY (metric_ref, timestamp, statistic)
+    ) WITHOUT ROWID''',
+    'CREATE INDEX IF NOT EXISTS idx_instances_instance_id ON instances (instance_id)',
+    'CREATE INDEX IF NOT EXISTS idx_metrics_metric_name ON metrics (metric_name, instance_ref)',
+    '''CREATE VIEW IF NOT EXISTS datapoints_view AS
+        SELECT
+            i.account_id AS account_id,
+            i.instance_class AS instance_class,
+            i.region AS region,
+            i.instance_id AS instance_id,
+            i.instance_type AS instance_type,
+            m.metric_name AS metric_name,
+            d.timestamp AS timestamp,
+            d.statistic AS statistic,
+            d.value AS value,
+            d.unit AS unit
+        FROM datapoints d
+        JOIN metrics m ON m.id = d.metric_ref
+        JOIN instances i ON i.id = m.instance_ref''',
+)
+
+
+class SQLiteStore:
+    '''Store collected instances and their metric statistics in a normalized
+    SQLite database (instances, tags, metrics and datapoints tables).
+
+    The database is opened in WAL mode. Each stored batch of instances is
+    written in a single transaction and the datapoints are inserted with
+    executemany() in batches of batch_size rows. Datapoints are keyed by
+    (metric, timestamp, statistic), so storing the same datapoint again
+    replaces it. The datapoints_view view joins all tables for use in
+    spreadsheet and BI tools.
+    '''
+
+    def __init__(self, database_file: str, batch_size: int=DEFAULT_BATCH_SIZE, log_wrapper: LogWrapper=LogWrapper()):
+        self.database_file = database_file
+        self.batch_size = batch_size
+        self.log_wrapper = log_wrapper
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(database_file, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('PRAGMA foreign_keys=ON')
+        with self.connection:
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+        self.log_wrapper.info(message='Opened SQLite database "{}"'.format(database_file))
+
+    def _get_instance_ref(self, cursor, instance)->int:
+        instance_key = (instance.account_id, instance.instance_class, instance.region, instance.instance_id)
+        cursor.execute(
+            'INSERT OR IGNORE INTO instances (account_id, instance_class, region, instance_id) VALUES (?, ?, ?, ?)',
+            instance_key
+        )
+        cursor.execute(
+            'UPDATE instances SET instance_type = ?, state = ?, last_update = ? WHERE account_id = ? AND instance_class = ? AND region = ? AND instance_id = ?',
+            (instance.instance_type, instance.state, instance.last_update) + instance_key
+        )
+        cursor.execute(
+            'SELECT id FROM instances WHERE account_id = ? AND instance_class = ? AND region = ? AND instance_id = ?',
+            instance_key
+        )
+        return cursor.fetchone()[0]
+
+    def _get_metric_ref(self, cursor, instance_ref: int, metric_name: str)->int:
+        cursor.execute(
+            'INSERT OR IGNORE INTO metrics (instance_ref, metric_name) VALUES (?, ?)',
+            (instance_ref, metric_name)
+        )
+        cursor.execute(
+            'SELECT id FROM metrics WHERE instance_ref = ? AND metric_name = ?',
+            (instance_ref, metric_name)
+        )
+        return cursor.fetchone()[0]
+
+    def _flush_datapoints(self, cursor, rows: list):
+        if len(rows) > 0:
+            cursor.executemany(
+                'INSERT OR REPLACE INTO datapoints (metric_ref, timestamp, statistic, value, unit) VALUES (?, ?, ?, ?, ?)',
+                rows
+            )
+
+    def store_instances(self, instances: list)->int:
+        '''Store the instances, their tags, metrics and datapoints in one
+        transaction and return the number of datapoint values written.'''
+        datapoint_count = 0
+        with self._lock:
+            try:
+                with self.connection:
+                    cursor = self.connection.cursor()
+                    rows = list()
+                    for instance in instances:
+                        instance_ref = self._get_instance_ref(cursor=cursor, instance=instance)
+                        cursor.execute('DELETE FROM tags WHERE instance_ref = ?', (instance_ref,))
+                        cursor.executemany(
+                            'INSERT INTO tags (instance_ref, key, value) VALUES (?, ?, ?)',
+                            [(instance_ref, key, value) for key, value in instance.tags.items()]
+                        )
+                        for metric_name, datapoints in instance.metric_statistics.items():
+                            metric_ref = self._get_metric_ref(cursor=cursor, instance_ref=instance_ref, metric_name=metric_name)
+                            if isinstance(datapoints, MetricSeries):
+                                for statistic, values in datapoints.values.items():
+                                    for timestamp, value in zip(datapoints.timestamps, values):
+                                        if not math.isnan(value):
+                                            rows.append((metric_ref, timestamp, statistic, value, datapoints.unit))
+                            else:
+                                for datapoint in datapoints:
+                                    if 'Timestamp' not in datapoint:
+                                        continue
+                                    timestamp = to_epoch(datapoint['Timestamp'])
+                                    unit = datapoint.get('Unit', None)
+                                    for statistic, value in datapoint.items():
+                                        if statistic in ('Timestamp', 'Unit'):
+                                            continue
+                                        rows.append((metric_ref, timestamp, statistic, value, unit))
+                            if len(rows) >= self.batch_size:
+                                self._flush_datapoints(cursor=cursor, rows=rows)
+                                datapoint_count += len(rows)
+                                rows = list()
+                    self._flush_datapoints(cursor=cursor, rows=rows)
+                    datapoint_count += len(rows)
+            except:
+                datapoint_count = 0
+                self.log_wrapper.error(message='EXCEPTION: {}'.format(traceback.format_exc()))
+        self.log_wrapper.info(message='Stored {} instances with {} datapoint values'.format(len(instances), datapoint_count))
+        return datapoint_count
+
+    def get_high_water_marks(self)->dict:
+        '''Return the epoch timestamp of the newest stored datapoint of every
+        metric, keyed by (account_id, instance_class, region, instance_id,
+        metric_name).'''
+        high_water_marks = dict()
+        with self._lock:
+            try:
+                cursor = self.connection.execute(
+                    '''SELECT i.account_id, i.instance_class, i.region, i.instance_id, m.metric_name, MAX(d.timestamp)
+                    FROM datapoints d
+                    JOIN metrics m ON m.id = d.metric_ref
+                    JOIN instances i ON i.id = m.instance_ref
+                    GROUP BY d.metric_ref'''
+                )
+                for account_id, instance_class, region, instance_id, metric_name, timestamp in cursor:
+                    high_water_marks[(account_id, instance_class, region, instance_id, metric_name)] = timestamp
+            except:
+                self.log_wrapper.error(message='EXCEPTION: {}'.format(traceback.format_exc()))
+        self.log_wrapper.info(message='Retrieved high water marks of {} metrics'.format(len(high_water_marks)))
+        return high_water_marks
+
+    def store_collection(self, collection)->int:
+        return self.store_instances(instances=collection.instances)
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+# EOF
@@ -0,0 +1,113 @@
+import json
+import os
+import threading
+import traceback
+from aws_metrics_collector import LogWrapper
+from aws_metrics_collector import get_utc_timestamp
+
+
+DEFAULT_TAG_CACHE_TTL = 3600    # Seconds before the tags of a resource are looked up again
+
+
+class TagCache:
+    '''Cache of the tags of AWS resources, keyed by ARN.
+
+    Tags are reused until ttl seconds have passed (never expiring when ttl is
+    None). When cache_file is set, the cache is loaded from that JSON file
+    and save() writes it back (collect_aws_instance_data() saves the default
+    cache once at the end of a collection), so that a following run does not
+    have to look up the tags again.
+    '''
+
+    def __init__(self, ttl: int=DEFAULT_TAG_CACHE_TTL, cache_file: str=None, log_wrapper: LogWrapper=LogWrapper()):
+        self.ttl = ttl
+        self.cache_file = cache_file
+        self.log_wrapper = log_wrapper
+        self._lock = threading.Lock()
+        self._cache = dict()
+        self._changed = False
+        self._load_cache_file()
+
+    def _is_fresh(self, entry: dict)->bool:
+        if self.ttl is None:
+            return True
+        return (get_utc_timestamp(with_decimal=False) - entry['Timestamp']) < self.ttl
+
+    def _load_cache_file(self):
+        if self.cache_file is None or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r') as f:
+                cache = json.load(f)
+            for arn, entry in cache.items():
+                if 'Timestamp' in entry and 'Tags' in entry:
+                    self._cache[arn] = entry
+            self.log_wrapper.info(message='Loaded the tags of {} resources from "{}"'.format(len(self._cache), self.cache_file))
+        except:
+            self.log_wrapper.error(message='EXCEPTION: {}'.format(traceback.format_exc()))
+
+    def _save_cache_file(self):
+        if self.cache_file is None:
+            return
+        try:
+            tmp_file = '{}.{}.tmp'.format(self.cache_file, threading.get_ident())
+            with open(tmp_file, 'w') as f:
+                json.dump(self._cache, f)
+            os.replace(tmp_file, self.cache_file)
+        except:
+            self.log_wrapper.error(message='EXCEPTION: {}'.format(traceback.format_exc()))
+
+    def get(self, arn: str)->dict:
+        '''Return the cached tags of the resource, or None when they are not
+        cached or have expired.'''
+        with self._lock:
+            entry = self._cache.get(arn, None)
+            if entry is None or self._is_fresh(entry) is False:
+                return None
+            return dict(entry['Tags'])
+
+    def put_many(self, tags_by_arn: dict):
+        if len(tags_by_arn) == 0:
+            return
+        timestamp = get_utc_timestamp(with_decimal=False)
+        with self._lock:
+            for arn, tags in tags_by_arn.items():
+                self._cache[arn] = {'Timestamp': timestamp, 'Tags': dict(tags)}
+            self._changed = True
+
+    def save(self):
+        '''Write the cache to cache_file, when set and anything changed since
+        it was loaded or last saved.'''
+        with self._lock:
+            if self._changed is True:
+                self._save_cache_file()
+                self._changed = False
+
+    def clear(self):
+        with self._lock:
+            self._cache = dict()
+
+
+_default_tag_cache = None
+_default_tag_cache_lock = threading.Lock()
+
+
+def get_default_tag_cache(log_wrapper: LogWrapper=LogWrapper())->TagCache:
+    global _default_tag_cache
+    with _default_tag_cache_lock:
+        if _default_tag_cache is None:
+            _default_tag_cache = TagCache(log_wrapper=log_wrapper)
+        return _default_tag_cache
+
+
+def configure_default_tag_cache(
+    ttl: int=DEFAULT_TAG_CACHE_TTL,
+    cache_file: str=None,
+    log_wrapper: LogWrapper=LogWrapper()
+)->TagCache:
+    global _default_tag_cache
+    with _default_tag_cache_lock:
+        _default_tag_cache = TagCache(ttl=ttl, cache_file=cache_file, log_wrapper=log_wrapper)
+        return _default_tag_cache
+
+# EOF
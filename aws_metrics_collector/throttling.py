@@ -0,0 +1,250 @@
+import functools
+import threading
+import time
+from aws_metrics_collector import LogWrapper
+
+
+THROTTLING_ERROR_CODES = (
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottledException',
+    'RequestThrottled',
+    'TooManyRequestsException',
+    'RequestLimitExceeded',
+    'SlowDown',
+)
+DEFAULT_RATE_LIMIT = 10.0   # Requests per second for APIs not listed below
+DEFAULT_API_RATE_LIMITS = {     # Published or observed sustained request rates, in requests per second
+    'GetMetricData': 50.0,
+    'GetMetricStatistics': 400.0,
+    'ListMetrics': 25.0,
+    'DescribeInstances': 20.0,
+    'DescribeDBInstances': 10.0,
+    'ListTagsForResource': 10.0,
+}
+DEFAULT_MAX_ATTEMPTS = 8    # Attempts (including the first) of a throttled call before giving up
+MAX_RATE_MULTIPLIER = 4.0   # The rate of an API may grow up to this multiple of its default
+MIN_RATE = 0.5
+
+
+class TokenBucket:
+    '''A token bucket with an adjustable rate.
+
+    The rate is adapted with additive increase (by increase_step on every
+    success) and multiplicative decrease (halved on every throttle), staying
+    between min_rate and max_rate. The bucket holds at most one second worth
+    of tokens.
+    '''
+
+    def __init__(self, rate: float, min_rate: float=MIN_RATE, max_rate: float=None, increase_step: float=None):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate if max_rate is not None else rate * MAX_RATE_MULTIPLIER
+        self.increase_step = increase_step if increase_step is not None else max(rate / 100.0, 0.01)
+        self.tokens = max(1.0, rate)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(max(1.0, self.rate), self.tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def acquire(self)->float:
+        '''Take a token, blocking until one is available. Returns the number
+        of seconds waited.'''
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return waited
+                wait_time = (1.0 - self.tokens) / self.rate
+            time.sleep(wait_time)
+            waited += wait_time
+
+    def increase(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+    def decrease(self):
+        with self._lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate / 2.0)
+            self.tokens = min(self.tokens, max(1.0, self.rate))
+
+
+class ApiCallCounters:
+
+    def __init__(self):
+        self.calls = 0
+        self.successes = 0
+        self.errors = 0
+        self.throttles = 0
+        self.throttled_failures = 0
+        self.wait_time = 0.0
+        self.latency = 0.0
+        self.first_call = None
+
+    def to_dict(self, rate: float)->dict:
+        elapsed = time.monotonic() - self.first_call if self.first_call is not None else 0.0
+        return {
+            'Calls': self.calls,
+            'Successes': self.successes,
+            'Errors': self.errors,
+            'Throttles': self.throttles,
+            'ThrottledFailures': self.throttled_failures,
+            'WaitTime': round(self.wait_time, 3),
+            'Latency': round(self.latency, 3),
+            'Throughput': round(self.calls / elapsed, 3) if elapsed > 0 else 0.0,
+            'RateLimit': round(rate, 3),
+        }
+
+
+class _AccountResolver:
+    '''Calls get_account once and keeps the result.'''
+
+    def __init__(self, get_account):
+        self.get_account = get_account
+        self.account = None
+        self._lock = threading.Lock()
+
+    def resolve(self)->str:
+        if self.account is None:
+            with self._lock:
+                if self.account is None:
+                    self.account = self.get_account()
+        return self.account
+
+
+def _resolve_account(account)->str:
+    if isinstance(account, _AccountResolver):
+        return account.resolve()
+    return account
+
+
+class AdaptiveRateLimiter:
+    '''Shared rate limiting and throttle accounting of AWS API calls.
+
+    Every registered client takes a token from the bucket of its
+    (account, region, API) before each call, so that all threads using any
+    client for the same account, region and API share one request rate. A
+    throttled attempt halves that rate and every successful call raises it
+    slightly, so the rate settles just below the service limit. The retries
+    themselves (exponential backoff with full jitter) are done by botocore
+    using the "standard" retry mode, which the client pool configures with
+    max_attempts.
+
+    The limiter is attached through the botocore event system, so it also
+    applies to calls made by paginators. The latency of every call (from after
+    the token was taken until the final response, including retries) is added
+    up per (account, region, API).
+
+    The account of a client is either a string or a function returning it,
+    which is only called when the client makes its first call (the client
+    pool passes one that resolves the account ID of the profile, so that
+    several profiles or roles for the same account share one bucket).
+    '''
+
+    def __init__(self, api_rate_limits: dict=None, default_rate_limit: float=DEFAULT_RATE_LIMIT, log_wrapper: LogWrapper=LogWrapper()):
+        self.api_rate_limits = api_rate_limits if api_rate_limits is not None else dict(DEFAULT_API_RATE_LIMITS)
+        self.default_rate_limit = default_rate_limit
+        self.log_wrapper = log_wrapper
+        self._lock = threading.Lock()
+        self._buckets = dict()
+        self._counters = dict()
+        self._call_start = threading.local()
+
+    def _get_bucket_and_counters(self, key: tuple)->tuple:
+        with self._lock:
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(rate=self.api_rate_limits.get(key[2], self.default_rate_limit))
+                self._counters[key] = ApiCallCounters()
+            return self._buckets[key], self._counters[key]
+
+    def register_client(self, aws_client, account=None):
+        region = aws_client.meta.region_name
+        if callable(account) is True:
+            account = _AccountResolver(get_account=account)
+        # Registered first, so that the token is also taken when another handler (for example a botocore Stubber) provides the response
+        aws_client.meta.events.register_first('before-call.*.*', functools.partial(self._before_call, account, region), unique_id='rate-limiter-before-call')
+        aws_client.meta.events.register('needs-retry', functools.partial(self._needs_retry, account, region), unique_id='rate-limiter-needs-retry')
+        aws_client.meta.events.register('after-call', functools.partial(self._after_call, account, region), unique_id='rate-limiter-after-call')
+
+    def _before_call(self, account, region, model=None, **kwargs):
+        account = _resolve_account(account=account)
+        bucket, counters = self._get_bucket_and_counters(key=(account, region, model.name))
+        waited = bucket.acquire()
+        with self._lock:
+            if counters.first_call is None:
+                counters.first_call = time.monotonic()
+            counters.calls += 1
+            counters.wait_time += waited
+        self._call_start.time = time.monotonic()
+
+    def _needs_retry(self, account, region, response=None, operation=None, **kwargs):
+        if response is None or operation is None:
+            return None
+        error_code = response[1].get('Error', dict()).get('Code', None)
+        if error_code in THROTTLING_ERROR_CODES:
+            account = _resolve_account(account=account)
+            bucket, counters = self._get_bucket_and_counters(key=(account, region, operation.name))
+            bucket.decrease()
+            with self._lock:
+                counters.throttles += 1
+            self.log_wrapper.warning(message='Throttled on "{}" in region "{}" for account "{}" - rate reduced to {:.2f}/s'.format(operation.name, region, account, bucket.rate))
+        return None     # Never changes the retry decision of botocore
+
+    def _after_call(self, account, region, http_response=None, parsed=None, model=None, **kwargs):
+        account = _resolve_account(account=account)
+        bucket, counters = self._get_bucket_and_counters(key=(account, region, model.name))
+        latency = time.monotonic() - getattr(self._call_start, 'time', time.monotonic())
+        with self._lock:
+            counters.latency += latency
+        if http_response is not None and http_response.status_code < 300:
+            bucket.increase()
+            with self._lock:
+                counters.successes += 1
+        else:
+            error_code = None
+            if parsed is not None:
+                error_code = parsed.get('Error', dict()).get('Code', None)
+            with self._lock:
+                counters.errors += 1
+                if error_code in THROTTLING_ERROR_CODES:
+                    counters.throttled_failures += 1
+
+    def get_statistics_by_key(self)->dict:
+        '''Snapshot of the counters, keyed by (account, region, API).'''
+        statistics = dict()
+        with self._lock:
+            for key, counters in self._counters.items():
+                statistics[key] = counters.to_dict(rate=self._buckets[key].rate)
+        return statistics
+
+    def get_statistics(self)->dict:
+        '''Snapshot of the counters, keyed by "account/region/API".'''
+        statistics = dict()
+        for key, key_statistics in self.get_statistics_by_key().items():
+            statistics['{}/{}/{}'.format(key[0] if key[0] is not None else 'default', key[1], key[2])] = key_statistics
+        return statistics
+
+    def log_statistics(self):
+        for key, statistics in sorted(self.get_statistics().items()):
+            self.log_wrapper.info(message='API statistics for "{}": {}'.format(key, statistics))
+
+
+_default_rate_limiter = None
+_default_rate_limiter_lock = threading.Lock()
+
+
+def get_default_rate_limiter(log_wrapper: LogWrapper=LogWrapper())->AdaptiveRateLimiter:
+    global _default_rate_limiter
+    with _default_rate_limiter_lock:
+        if _default_rate_limiter is None:
+            _default_rate_limiter = AdaptiveRateLimiter(log_wrapper=log_wrapper)
+        return _default_rate_limiter
+
+# EOF
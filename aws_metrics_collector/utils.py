@@ -1,5 +1,4 @@
 import datetime
-from dateutil.tz import tzutc
 import json
 import traceback
 from aws_metrics_collector import LogWrapper
@@ -13,11 +12,14 @@ def convert_unknown_obj(unknown_obj):
         return '{}'.format(unknown_obj)
 
 
-def dict_to_json(dict_obj: dict, log_wrapper: LogWrapper=LogWrapper())->str:
+def dict_to_json(dict_obj: dict, compact: bool=False, log_wrapper: LogWrapper=LogWrapper())->str:
     final_str = ''
     try:
         if isinstance(dict_obj, dict):
-            final_str = json.dumps(dict_obj, default=convert_unknown_obj, indent=4, sort_keys=True)
+            if compact is True:
+                final_str = json.dumps(dict_obj, default=convert_unknown_obj, separators=(',', ':'))
+            else:
+                final_str = json.dumps(dict_obj, default=convert_unknown_obj, indent=4, sort_keys=True)
         else:
             log_wrapper.error(message='dict_obj incorrect type: {}'.format(type(dict_obj)))
     except:
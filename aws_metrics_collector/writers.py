@@ -0,0 +1,106 @@
+import gzip
+import io
+import json
+import threading
+from aws_metrics_collector import LogWrapper
+from aws_metrics_collector.utils import convert_unknown_obj
+
+
+COMPRESSION_TYPES = (
+    None,
+    'gzip',
+    'zstd',
+)
+COMPRESSION_FILE_EXTENSIONS = {
+    None: '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+
+def open_text_file_for_writing(file_name: str, compression: str=None):
+    '''Open a text file for writing, compressed with gzip or zstd (the latter
+    requires the optional zstandard package).'''
+    if compression not in COMPRESSION_TYPES:
+        raise Exception('Compression "{}" is not supported. Supported: {}'.format(compression, COMPRESSION_TYPES))
+    if compression == 'gzip':
+        return gzip.open(file_name, 'wt', encoding='utf-8')
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception('zstd compression requires the zstandard package: pip3 install zstandard')
+        binary_file = open(file_name, 'wb')
+        return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(binary_file), encoding='utf-8')
+    return open(file_name, 'w', encoding='utf-8')
+
+
+class NdjsonWriter:
+    '''Write collected instances as newline delimited JSON while they are
+    being collected, so that memory use does not depend on the fleet size.
+
+    With per_datapoint set, every datapoint is written as its own line,
+    together with the instance and metric it belongs to; otherwise every
+    instance (as returned by AwsInstance.to_dict()) is written as one line.
+    The write_instance() method is thread safe and can be passed directly as
+    the instance_handler of collect_aws_instance_data().
+    '''
+
+    def __init__(
+        self,
+        file_name: str,
+        compression: str=None,
+        compact: bool=True,
+        per_datapoint: bool=False,
+        log_wrapper: LogWrapper=LogWrapper()
+    ):
+        self.file_name = file_name
+        self.per_datapoint = per_datapoint
+        self.log_wrapper = log_wrapper
+        self.line_count = 0
+        self._separators = (',', ':') if compact is True else (', ', ': ')
+        self._lock = threading.Lock()
+        self._file = open_text_file_for_writing(file_name=file_name, compression=compression)
+        self.log_wrapper.info(message='Streaming NDJSON to "{}"'.format(file_name))
+
+    def _dumps(self, obj: dict)->str:
+        return json.dumps(obj, default=convert_unknown_obj, separators=self._separators)
+
+    def _datapoint_lines(self, instance)->list:
+        lines = list()
+        for metric_name, datapoints in instance.metric_statistics.items():
+            for datapoint in datapoints:
+                line = {
+                    'AccountId': instance.account_id,
+                    'InstanceClass': instance.instance_class,
+                    'InstanceRegion': instance.region,
+                    'InstanceId': instance.instance_id,
+                    'MetricName': metric_name,
+                }
+                line.update(datapoint)
+                lines.append(self._dumps(line))
+        return lines
+
+    def write_instance(self, instance):
+        if self.per_datapoint is True:
+            lines = self._datapoint_lines(instance=instance)
+        else:
+            lines = [self._dumps(instance.to_dict()),]
+        with self._lock:
+            for line in lines:
+                self._file.write(line)
+                self._file.write('\n')
+            self.line_count += len(lines)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+        self.log_wrapper.info(message='Wrote {} lines to "{}"'.format(self.line_count, self.file_name))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+# EOF
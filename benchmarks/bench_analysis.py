@@ -0,0 +1,58 @@
+'''Benchmark of the utilization summary of aws_metrics_collector.analysis.
+
+Builds a synthetic collection of instances with MetricSeries of random
+utilization values (a few percent of them missing) and measures the time of
+summarize_instances() over all instance metrics.
+
+Usage: python3 benchmarks/bench_analysis.py [instances] [metrics] [datapoints]
+'''
+import os
+import sys
+import time
+from array import array
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import numpy
+from aws_metrics_collector.analysis import summarize_instances
+from aws_metrics_collector.aws import AwsEC2Instance
+from aws_metrics_collector.metric_series import MetricSeries
+
+
+def build_instances(instance_count: int, metric_count: int, datapoint_count: int)->list:
+    random_generator = numpy.random.default_rng(seed=1)
+    timestamps = array('q', range(0, datapoint_count * 300, 300))
+    instances = list()
+    for instance_index in range(instance_count):
+        instance = AwsEC2Instance()
+        instance.instance_id = 'i-{:017x}'.format(instance_index)
+        instance.instance_type = 't3.medium'
+        for metric_index in range(metric_count):
+            metric_name = 'CPUUtilization' if metric_index == 0 else 'Metric{}'.format(metric_index)
+            values = random_generator.gamma(shape=2.0, scale=random_generator.uniform(1, 30), size=datapoint_count)
+            values[random_generator.random(datapoint_count) < 0.02] = numpy.nan
+            series = MetricSeries(statistics=('Average',), unit='Percent')
+            series.timestamps = timestamps
+            series.values['Average'] = array('d', values.tobytes())
+            instance.metric_statistics[metric_name] = series
+        instances.append(instance)
+    return instances
+
+
+def main():
+    instance_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    metric_count = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    datapoint_count = int(sys.argv[3]) if len(sys.argv) > 3 else 288
+    print('Building {} instances with {} metrics of {} datapoints...'.format(instance_count, metric_count, datapoint_count))
+    instances = build_instances(instance_count=instance_count, metric_count=metric_count, datapoint_count=datapoint_count)
+    start_time = time.perf_counter()
+    summary = summarize_instances(instances=instances)
+    duration = time.perf_counter() - start_time
+    print('Instance metrics:     {}'.format(len(summary['instance_id'])))
+    print('Datapoints:           {}'.format(int(summary['datapoints'].sum())))
+    print('Flagged:              {}'.format(sum(1 for flag in summary['flag'] if flag != '')))
+    print('Summary time:         {:.3f} seconds'.format(duration))
+
+
+if __name__ == '__main__':
+    main()
+
+# EOF
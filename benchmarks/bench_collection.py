@@ -0,0 +1,179 @@
+'''Benchmark of collect_aws_instance_data() against a synthetic fleet.
+
+The fleet is served by the local stand-in of tests/fleet_stub.py, so the whole
+collection path (clients, paging, rate limiting, retries, metric discovery,
+GetMetricData batching and the data model) is measured without AWS access.
+Latency and throttling can be injected to reproduce the behaviour of a real
+account.
+
+Reports the wall time, API calls, throttles, peak RSS and datapoints per
+second. With --save-baseline the results are written to a JSON file; with
+--baseline the run is compared to such a file and the script exits with
+status 1 when it is slower, uses more memory or makes more API calls than
+the baseline (beyond --tolerance), which makes it usable as a regression
+gate.
+
+Usage: python3 benchmarks/bench_collection.py --instances 500 --metrics 8 --regions 2 --latency 0.02
+'''
+import argparse
+import json
+import logging
+import os
+import resource
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from aws_metrics_collector import LogWrapper
+from aws_metrics_collector.aws import collect_aws_instance_data
+from aws_metrics_collector.metric_index import get_default_metric_index_cache
+from aws_metrics_collector.regions import configure_default_region_catalog
+from aws_metrics_collector.throttling import AdaptiveRateLimiter
+from tests.fleet_stub import SyntheticFleet, SyntheticFleetClientPool
+
+
+REGIONS = (
+    'us-east-1',
+    'us-east-2',
+    'us-west-1',
+    'us-west-2',
+    'eu-west-1',
+    'eu-central-1',
+    'ap-southeast-1',
+    'ap-northeast-1',
+)
+GATED_RESULTS = {   # Result: True when higher is better
+    'DatapointsPerSecond': True,
+    'PeakRssKiB': False,
+    'ApiCalls': False,
+}
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark collect_aws_instance_data() against a synthetic fleet')
+    parser.add_argument('--instances', type=int, default=200, help='Instances per service and region')
+    parser.add_argument('--metrics', type=int, default=8, help='Metrics per instance')
+    parser.add_argument('--regions', type=int, default=2, help='Number of regions (at most {})'.format(len(REGIONS)))
+    parser.add_argument('--services', default='ec2,rds', help='Comma separated services')
+    parser.add_argument('--hours', type=int, default=24, help='Hours of datapoints to collect')
+    parser.add_argument('--period', type=int, default=300)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every API call')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of API calls that are throttled')
+    parser.add_argument('--rate-limit', type=float, default=1000.0, help='Requests per second per API of the rate limiter')
+    parser.add_argument('--max-workers', type=int, default=8)
+    parser.add_argument('--max-workers-per-region', type=int, default=2)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--no-metric-data', action='store_true', help='Use get_metric_statistics instead of GetMetricData')
+    parser.add_argument('--no-metric-index', action='store_true', help='Call list_metrics per instance')
+    parser.add_argument('--log-level', default='INFO')
+    parser.add_argument('--baseline', default=None, help='JSON file of a previous run to compare with')
+    parser.add_argument('--save-baseline', default=None, help='Write the results to this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative regression compared to the baseline')
+    return parser.parse_args()
+
+
+def get_peak_rss_kib()->int:
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak_rss // 1024     # Bytes on macOS, KiB elsewhere
+    return peak_rss
+
+
+def run_benchmark(arguments)->dict:
+    regions = list(REGIONS[:arguments.regions])
+    services = arguments.services.split(',')
+    log_wrapper = LogWrapper()
+    configure_default_region_catalog(cache_file=None, allowed_regions=regions, log_wrapper=log_wrapper)
+    get_default_metric_index_cache(log_wrapper=log_wrapper).clear()
+    fleet = SyntheticFleet(
+        instance_count=arguments.instances,
+        metrics_per_instance=arguments.metrics,
+        latency=arguments.latency,
+        throttle_rate=arguments.throttle_rate
+    )
+    client_pool = SyntheticFleetClientPool(
+        fleet=fleet,
+        max_pool_connections=max(10, arguments.max_workers),
+        rate_limiter=AdaptiveRateLimiter(api_rate_limits=dict(), default_rate_limit=arguments.rate_limit, log_wrapper=log_wrapper),
+        log_wrapper=log_wrapper
+    )
+    end_timestamp = datetime(2020, 1, 2, tzinfo=timezone.utc)
+    start_timestamp = end_timestamp - timedelta(hours=arguments.hours)
+    start_time = time.perf_counter()
+    collection = collect_aws_instance_data(
+        services=services,
+        all_regions=False,
+        regions=regions,
+        use_metric_data=not arguments.no_metric_data,
+        max_workers=arguments.max_workers,
+        max_workers_per_region=arguments.max_workers_per_region,
+        client_pool=client_pool,
+        start_timestamp=start_timestamp,
+        end_timestamp=end_timestamp,
+        period=arguments.period,
+        use_metric_index=not arguments.no_metric_index,
+        page_size=arguments.page_size,
+        log_wrapper=log_wrapper
+    )
+    wall_time = time.perf_counter() - start_time
+    client_pool.shutdown()
+    datapoint_count = 0
+    for instance in collection.instances:
+        for datapoints in instance.metric_statistics.values():
+            datapoint_count += len(datapoints)
+    expected_datapoints = len(services) * len(regions) * arguments.instances * arguments.metrics * (arguments.hours * 3600 // arguments.period)
+    return {
+        'Parameters': vars(arguments),
+        'Instances': len(collection.instances),
+        'Datapoints': datapoint_count,
+        'ExpectedDatapoints': expected_datapoints,
+        'WallTime': round(wall_time, 3),
+        'ApiCalls': fleet.get_call_count() - fleet.throttles,
+        'ApiCallsByOperation': dict(sorted(fleet.calls.items())),
+        'Throttles': fleet.throttles,
+        'PeakRssKiB': get_peak_rss_kib(),
+        'DatapointsPerSecond': round(datapoint_count / wall_time, 1) if wall_time > 0 else 0.0,
+    }
+
+
+def compare_with_baseline(results: dict, baseline: dict, tolerance: float)->list:
+    regressions = list()
+    for name, higher_is_better in GATED_RESULTS.items():
+        if name not in baseline or baseline[name] == 0:
+            continue
+        change = (results[name] - baseline[name]) / baseline[name]
+        if (higher_is_better is True and change < -tolerance) or (higher_is_better is False and change > tolerance):
+            regressions.append('{}: {} (baseline {}, {:+.1%})'.format(name, results[name], baseline[name], change))
+    return regressions
+
+
+def main():
+    arguments = get_arguments()
+    logging.getLogger('aws_metrics_collector').setLevel(arguments.log_level)
+    results = run_benchmark(arguments=arguments)
+    for name in ('Instances', 'Datapoints', 'ExpectedDatapoints', 'WallTime', 'ApiCalls', 'Throttles', 'PeakRssKiB', 'DatapointsPerSecond'):
+        print('{:<22} {}'.format(name, results[name]))
+    for operation, calls in results['ApiCallsByOperation'].items():
+        print('  {:<20} {}'.format(operation, calls))
+    if results['Datapoints'] != results['ExpectedDatapoints']:
+        print('WARNING: {} datapoints collected, {} expected'.format(results['Datapoints'], results['ExpectedDatapoints']))
+    if arguments.save_baseline is not None:
+        with open(arguments.save_baseline, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+    if arguments.baseline is not None:
+        with open(arguments.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get('Parameters', dict()).get('instances') != arguments.instances or baseline.get('Parameters', dict()).get('metrics') != arguments.metrics:
+            print('WARNING: the baseline was run with different parameters')
+        regressions = compare_with_baseline(results=results, baseline=baseline, tolerance=arguments.tolerance)
+        for regression in regressions:
+            print('REGRESSION {}'.format(regression))
+        if len(regressions) > 0:
+            sys.exit(1)
+        print('No regressions compared to "{}"'.format(arguments.baseline))
+
+
+if __name__ == '__main__':
+    main()
+
+# EOF
@@ -0,0 +1,43 @@
+'''Benchmark of the JSON export of a collection.
+
+Builds a synthetic collection (MetricSeries of 288 five minute datapoints of
+two statistics per metric) and compares the time of
+dict_to_json(AWSInstanceCollection.to_dict()) with
+export.export_collection() for an increasing number of worker processes.
+
+Usage: python3 benchmarks/bench_export.py [instances] [metrics] [max workers]
+'''
+import os
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from aws_metrics_collector.export import export_collection
+from aws_metrics_collector.utils import dict_to_json
+from tests.fleet_stub import build_collection
+
+
+def main():
+    instance_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    metric_count = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    max_workers = int(sys.argv[3]) if len(sys.argv) > 3 else (os.cpu_count() or 1)
+    collection = build_collection(instance_count=instance_count, metric_count=metric_count)
+    print('{} instances with {} metrics, {} CPUs'.format(instance_count, metric_count, os.cpu_count()))
+    with tempfile.TemporaryDirectory() as directory:
+        for compact in (False, True):
+            start_time = time.perf_counter()
+            with open(os.path.join(directory, 'reference.json'), 'w') as f:
+                f.write(dict_to_json(collection.to_dict(), compact=compact))
+            print('compact={:<5} dict_to_json               {:.3f} seconds'.format(compact, time.perf_counter() - start_time))
+            worker_count = 1
+            while worker_count <= max_workers:
+                start_time = time.perf_counter()
+                export_collection(collection=collection, file_name=os.path.join(directory, 'data.json'), compact=compact, max_workers=worker_count)
+                print('compact={:<5} export_collection {:>2} proc  {:.3f} seconds'.format(compact, worker_count, time.perf_counter() - start_time))
+                worker_count *= 2
+
+
+if __name__ == '__main__':
+    main()
+
+# EOF
@@ -0,0 +1,58 @@
+'''Micro-benchmark of the LogWrapper hot path.
+
+Compares the previous caller identification (inspect.stack()) with the
+current one (sys._getframe()), and shows the cost of a disabled debug
+message. Messages go to a logger with a NullHandler, so only the overhead of
+the wrapper is measured.
+
+Usage: python3 benchmarks/bench_logging.py [iterations]
+'''
+import inspect
+import logging
+import os
+import sys
+import timeit
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from aws_metrics_collector import LogWrapper
+
+
+def id_caller_inspect_stack()->list:
+    result = list()
+    caller_stack = inspect.stack()[2]
+    result.append(caller_stack[1].split(os.sep)[-1])
+    result.append(caller_stack[2])
+    result.append(caller_stack[3])
+    return result
+
+
+class InspectStackLogWrapper(LogWrapper):
+
+    def info(self, message: str, **kwargs):
+        message = self._format_msg(stack_data=id_caller_inspect_stack(), message=message)
+        self.logger.info(message)
+
+
+def main():
+    iterations = 10000
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+    benchmark_logger = logging.getLogger('bench_logging')
+    benchmark_logger.propagate = False
+    benchmark_logger.addHandler(logging.NullHandler())
+    benchmark_logger.setLevel(logging.INFO)
+    fast_log_wrapper = LogWrapper(logger_impl=benchmark_logger)
+    slow_log_wrapper = InspectStackLogWrapper(logger_impl=benchmark_logger)
+    results = (
+        ('info() with inspect.stack()', timeit.timeit(lambda: slow_log_wrapper.info(message='benchmark message'), number=iterations)),
+        ('info() with sys._getframe()', timeit.timeit(lambda: fast_log_wrapper.info(message='benchmark message'), number=iterations)),
+        ('debug() while disabled', timeit.timeit(lambda: fast_log_wrapper.debug(message='benchmark message'), number=iterations)),
+    )
+    for name, seconds in results:
+        print('{:<30} {:>10.2f} us/call'.format(name, seconds / iterations * 1000000))
+    print('Speed-up of info(): {:.1f}x'.format(results[0][1] / results[1][1]))
+
+
+if __name__ == '__main__':
+    main()
+
+# EOF
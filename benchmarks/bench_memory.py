@@ -0,0 +1,108 @@
+'''Memory benchmark of the collected data model.
+
+Builds a synthetic fleet the way the collector does (describe result per
+instance, a few metrics with 288 five minute datapoints of two statistics
+each) and measures the memory held per datapoint with tracemalloc, for:
+
+- the previous model: plain instance objects keeping the describe result and
+  a list of datapoint dicts per metric
+- the current model: AwsInstance with __slots__, the describe result dropped
+  and a MetricSeries per metric
+
+Usage: python3 benchmarks/bench_memory.py [instances] [metrics] [datapoints]
+'''
+import os
+import sys
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from aws_metrics_collector.aws import AwsEC2Instance
+from aws_metrics_collector.metric_series import MetricSeries
+
+
+class DictInstance:
+
+    def __init__(self):
+        self.raw_instance_data = None
+        self.instance_id = 'unknown'
+        self.instance_type = 'unknown'
+        self.state = 'unknown'
+        self.tags = dict()
+        self.metrics = list()
+        self.metric_statistics = dict()
+
+
+def describe_result(index: int)->dict:
+    return {
+        'InstanceId': 'i-{:017x}'.format(index),
+        'InstanceType': 't3.medium',
+        'State': {'Code': 16, 'Name': 'running'},
+        'ImageId': 'ami-0123456789abcdef0',
+        'PrivateIpAddress': '10.0.{}.{}'.format(index // 256 % 256, index % 256),
+        'SubnetId': 'subnet-0123456789abcdef0',
+        'VpcId': 'vpc-0123456789abcdef0',
+        'SecurityGroups': [{'GroupName': 'default', 'GroupId': 'sg-0123456789abcdef0'},],
+        'BlockDeviceMappings': [{'DeviceName': '/dev/xvda', 'Ebs': {'VolumeId': 'vol-0123456789abcdef0', 'Status': 'attached'}},],
+        'Tags': [{'Key': 'Name', 'Value': 'instance-{}'.format(index)}, {'Key': 'Environment', 'Value': 'production'},],
+    }
+
+
+def datapoints(count: int)->list:
+    # Datapoints as returned by get_metric_statistics
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    return [{'Timestamp': start + timedelta(seconds=300 * index), 'Average': index * 0.5, 'Maximum': index * 1.0, 'Unit': 'Percent'} for index in range(count)]
+
+
+def build_fleet(compact: bool, instance_count: int, metric_count: int, datapoint_count: int)->list:
+    fleet = list()
+    for index in range(instance_count):
+        if compact is True:
+            instance = AwsEC2Instance()
+            instance.store_raw_instance_data(instance_data=describe_result(index=index), keep_raw_instance_data=False)
+        else:
+            instance = DictInstance()
+            instance.raw_instance_data = describe_result(index=index)
+            instance.instance_id = instance.raw_instance_data['InstanceId']
+        for metric_index in range(metric_count):
+            metric_name = 'Metric{}'.format(metric_index)
+            instance.metrics.append(metric_name)
+            if compact is True:
+                instance.metric_statistics[metric_name] = MetricSeries.from_datapoints(datapoints=datapoints(count=datapoint_count))
+            else:
+                instance.metric_statistics[metric_name] = datapoints(count=datapoint_count)
+        fleet.append(instance)
+    return fleet
+
+
+def measure(compact: bool, instance_count: int, metric_count: int, datapoint_count: int)->int:
+    tracemalloc.start()
+    fleet = build_fleet(compact=compact, instance_count=instance_count, metric_count=metric_count, datapoint_count=datapoint_count)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del fleet
+    return size
+
+
+def main():
+    instance_count = 100
+    metric_count = 8
+    datapoint_count = 288
+    if len(sys.argv) > 1:
+        instance_count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        metric_count = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        datapoint_count = int(sys.argv[3])
+    total_datapoints = instance_count * metric_count * datapoint_count
+    print('{} instances, {} metrics per instance, {} datapoints per metric: {} datapoints'.format(instance_count, metric_count, datapoint_count, total_datapoints))
+    before = measure(compact=False, instance_count=instance_count, metric_count=metric_count, datapoint_count=datapoint_count)
+    after = measure(compact=True, instance_count=instance_count, metric_count=metric_count, datapoint_count=datapoint_count)
+    print('{:<40} {:>12} bytes {:>8.1f} bytes/datapoint'.format('dict datapoints, raw describe data', before, before / total_datapoints))
+    print('{:<40} {:>12} bytes {:>8.1f} bytes/datapoint'.format('__slots__ and MetricSeries', after, after / total_datapoints))
+    print('Reduction: {:.1f}x'.format(before / after))
+
+
+if __name__ == '__main__':
+    main()
+
+# EOF
@@ -0,0 +1,76 @@
+'''Benchmark of the startup time of the collector.
+
+Starts fresh Python processes (in a temporary directory, without AWS calls)
+and reports the median wall time of:
+
+* importing the aws_metrics_collector package
+* importing the collector module (aws_metrics_collector.aws_metrics_collector)
+* python3 -m aws_metrics_collector --help
+* python3 -m aws_metrics_collector --dry-run
+* importing boto3, for comparison
+
+Every path except the last one must neither import boto3 nor create a log
+file; the script exits with status 1 when one does.
+
+Usage: python3 benchmarks/bench_startup.py [runs]
+'''
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+PACKAGE_DIRECTORY = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+# Each case prints whether boto3 was imported; --help and --dry-run exit through SystemExit
+CHECK_BOTO3 = "import sys, atexit; atexit.register(lambda: print('BOTO3', 'boto3' in sys.modules))\n"
+CASES = (
+    ('import aws_metrics_collector', CHECK_BOTO3 + 'import aws_metrics_collector', False),
+    ('import the collector module', CHECK_BOTO3 + 'import aws_metrics_collector.aws_metrics_collector', False),
+    ('--help', CHECK_BOTO3 + "from aws_metrics_collector.cli import main\nmain(['--help'])", False),
+    ('--dry-run', CHECK_BOTO3 + "from aws_metrics_collector.cli import main\nmain(['--dry-run'])", False),
+    ('import boto3', CHECK_BOTO3 + 'import boto3', True),
+)
+
+
+def time_case(code: str, directory: str)->tuple:
+    '''Run code in a new interpreter; returns (seconds, boto3 imported).'''
+    environment = dict(os.environ, PYTHONPATH=PACKAGE_DIRECTORY)
+    start_time = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', code], cwd=directory, env=environment, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    duration = time.perf_counter() - start_time
+    if 'BOTO3' not in result.stdout:
+        raise Exception('The case failed: {}'.format(result.stderr))
+    return duration, 'BOTO3 True' in result.stdout
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        baseline = statistics.median(time_case(code=CHECK_BOTO3 + 'pass', directory=directory)[0] for run in range(runs))
+        print('{:<32} {:>10} {:>14}  {}'.format('Case', 'Median (s)', 'Above python', 'boto3'))
+        print('{:<32} {:>10.3f} {:>14}  {}'.format('python3 -c pass', baseline, '-', '-'))
+        for name, code, boto3_expected in CASES:
+            durations = list()
+            boto3_imported = False
+            for run in range(runs):
+                duration, imported = time_case(code=code, directory=directory)
+                durations.append(duration)
+                boto3_imported = boto3_imported or imported
+            median = statistics.median(durations)
+            print('{:<32} {:>10.3f} {:>14.3f}  {}'.format(name, median, median - baseline, 'imported' if boto3_imported else 'not imported'))
+            if boto3_imported is True and boto3_expected is False:
+                failed = True
+        if os.path.exists(os.path.join(directory, 'aws_metrics_collector.log')):
+            print('A log file was created')
+            failed = True
+    if failed is True:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
+
+# EOF
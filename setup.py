@@ -35,10 +35,14 @@ setup(
     extras_require={
         'dev': ['check-manifest'],
         'test': ['coverage'],
+        'zstd': ['zstandard'],
+        'columnar': ['pyarrow'],
+        'analysis': ['numpy'],
     },
     entry_points={
         'console_scripts': [
-            'amcollect=aws_metrics_collector.aws_metrics_collector:run',
+            'amcollect=aws_metrics_collector.cli:main',
+            'amcollectd=aws_metrics_collector.cli:main_daemon',
         ],
     },
     project_urls={
@@ -0,0 +1,10 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from aws_metrics_collector import configure_logging
+
+
+# Keep the log of the tests out of the working directory
+configure_logging(log_file_name=os.devnull)
+
+# EOF
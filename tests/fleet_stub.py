@@ -0,0 +1,325 @@
+'''A local stand-in for the EC2, RDS, CloudWatch and STS APIs, serving a
+synthetic fleet to the real boto3 clients of the collector.
+
+The stand-in hooks into the botocore event system of every client created by
+a SyntheticFleetClientPool: the request is built, signed, rate limited and
+retried exactly as against AWS, only the HTTP round trip is replaced by a
+generated response (after an optional injected latency, and an optional
+random Throttling error). No network access or AWS credentials are needed.
+
+Every region of every service holds instance_count instances, each with
+metrics_per_instance metrics, and every metric has a datapoint per period
+for any requested time range.
+
+build_collection() builds a synthetic AWSInstanceCollection directly, for
+the code that only needs collected data (such as the export).
+
+Shared by the tests and the benchmarks (as tests.fleet_stub).
+'''
+import functools
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from botocore.awsrequest import AWSResponse
+from aws_metrics_collector import LogWrapper
+from aws_metrics_collector.aws import AwsEC2Instance, AWSInstanceCollection
+from aws_metrics_collector.client_pool import AwsClientPool
+from aws_metrics_collector.metric_series import MetricSeries, to_epoch
+
+
+MAX_METRIC_DATA_DATAPOINTS = 100800     # Datapoints returned by one GetMetricData request
+MAX_METRIC_STATISTICS_DATAPOINTS = 1440
+LIST_METRICS_PAGE_SIZE = 500
+METRIC_NAMES = (
+    'CPUUtilization',
+    'NetworkIn',
+    'NetworkOut',
+    'NetworkPacketsIn',
+    'NetworkPacketsOut',
+    'DiskReadOps',
+    'DiskWriteOps',
+    'DiskReadBytes',
+    'DiskWriteBytes',
+    'StatusCheckFailed',
+    'StatusCheckFailed_Instance',
+    'StatusCheckFailed_System',
+    'CPUCreditUsage',
+    'CPUCreditBalance',
+    'EBSReadOps',
+    'EBSWriteOps',
+)
+NAMESPACES = {
+    'AWS/EC2': ('ec2', 'InstanceId'),
+    'AWS/RDS': ('rds', 'DBInstanceIdentifier'),
+}
+
+
+class _ResponseBody:
+
+    def __init__(self, body: bytes):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+class SyntheticFleet:
+    '''The synthetic fleet and the generated API responses. Thread safe.'''
+
+    def __init__(
+        self,
+        instance_count: int=100,
+        metrics_per_instance: int=8,
+        account_id: str='123456789012',
+        latency: float=0.0,
+        throttle_rate: float=0.0,
+        seed: int=1
+    ):
+        self.instance_count = instance_count
+        self.metric_names = [METRIC_NAMES[index] if index < len(METRIC_NAMES) else 'Metric{}'.format(index) for index in range(metrics_per_instance)]
+        self.account_id = account_id
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.calls = dict()
+        self.throttles = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def get_instance_ids(self, service: str, region: str)->list:
+        if service == 'ec2':
+            return ['i-{:08x}{:09x}'.format(sum(map(ord, region)), index) for index in range(self.instance_count)]
+        return ['db-{}-{}'.format(region, index) for index in range(self.instance_count)]
+
+    def attach(self, aws_client):
+        region = aws_client.meta.region_name
+        protocol = aws_client.meta.service_model.resolved_protocol
+        aws_client.meta.events.register('before-parameter-build', self._before_parameter_build, unique_id='fleet-stub-parameters')
+        aws_client.meta.events.register('before-send', functools.partial(self._before_send, region, protocol), unique_id='fleet-stub-send')
+        aws_client.meta.events.register('before-parse', self._before_parse, unique_id='fleet-stub-parse')
+        aws_client.meta.events.register('after-call', self._after_call, unique_id='fleet-stub-after-call')
+        aws_client.meta.events.register('after-call-error', self._after_call, unique_id='fleet-stub-after-call-error')
+
+    def get_call_count(self)->int:
+        with self._lock:
+            return sum(self.calls.values())
+
+    def _get_params_stack(self)->list:
+        # A stack, as a handler of another client (such as the rate limiter resolving the account ID) may call an API in between
+        if hasattr(self._local, 'params_stack') is False:
+            self._local.params_stack = list()
+        return self._local.params_stack
+
+    def _before_parameter_build(self, params=None, model=None, **kwargs):
+        self._get_params_stack().append(dict(params) if params is not None else dict())
+
+    def _after_call(self, **kwargs):
+        params_stack = self._get_params_stack()
+        if len(params_stack) > 0:
+            params_stack.pop()
+
+    def _before_send(self, region, protocol, request=None, event_name=None, **kwargs):
+        operation = event_name.split('.')[-1]
+        if self.latency > 0:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            throttled = self.throttle_rate > 0 and self._random.random() < self.throttle_rate
+            if throttled is True:
+                self.throttles += 1
+        status_code = 200
+        if throttled is True:
+            status_code = 400
+            self._local.parsed = {'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'}}
+        else:
+            try:
+                self._local.parsed = self._respond(region=region, operation=operation, params=self._get_params_stack()[-1])
+            except ValueError as error:
+                status_code = 400
+                self._local.parsed = {'Error': {'Code': 'InvalidParameterCombination', 'Message': str(error)}}
+        # The generated response is injected by _before_parse, the body only has to be valid for the protocol parser
+        if protocol == 'json':
+            body = b'{}'
+        else:
+            body = '<{0}Response><{0}Result></{0}Result></{0}Response>'.format(operation).encode('utf-8')
+        return AWSResponse(request.url, status_code, {}, _ResponseBody(body))
+
+    def _before_parse(self, customized_response_dict=None, **kwargs):
+        customized_response_dict.update(self._local.parsed)
+
+    def _respond(self, region: str, operation: str, params: dict)->dict:
+        if operation == 'GetCallerIdentity':
+            return {'Account': self.account_id, 'Arn': 'arn:aws:iam::{}:user/benchmark'.format(self.account_id), 'UserId': 'BENCHMARK'}
+        if operation == 'DescribeInstances':
+            return self._describe_instances(region=region, params=params)
+        if operation == 'DescribeDBInstances':
+            return self._describe_db_instances(region=region, params=params)
+        if operation == 'ListTagsForResource':
+            return {'TagList': [{'Key': 'Name', 'Value': params['ResourceName'].split(':')[-1]},]}
+        if operation == 'ListMetrics':
+            return self._list_metrics(region=region, params=params)
+        if operation == 'GetMetricData':
+            return self._get_metric_data(params=params)
+        if operation == 'GetMetricStatistics':
+            return self._get_metric_statistics(params=params)
+        return dict()
+
+    def _get_page(self, items: list, params: dict, token_name: str, page_size_name: str, default_page_size: int)->tuple:
+        start = int(params.get(token_name, 0) or 0)
+        end = start + int(params.get(page_size_name, default_page_size) or default_page_size)
+        next_token = str(end) if end < len(items) else None
+        return items[start:end], next_token
+
+    def _describe_instances(self, region: str, params: dict)->dict:
+        instance_ids, next_token = self._get_page(items=self.get_instance_ids(service='ec2', region=region), params=params, token_name='NextToken', page_size_name='MaxResults', default_page_size=1000)
+        response = {'Reservations': list()}
+        for instance_id in instance_ids:
+            response['Reservations'].append(
+                {
+                    'ReservationId': 'r-{}'.format(instance_id[2:]),
+                    'Instances': [
+                        {
+                            'InstanceId': instance_id,
+                            'InstanceType': 't3.medium',
+                            'State': {'Code': 16, 'Name': 'running'},
+                            'Placement': {'AvailabilityZone': '{}a'.format(region)},
+                            'Tags': [{'Key': 'Name', 'Value': instance_id}, {'Key': 'Environment', 'Value': 'benchmark'},],
+                        },
+                    ],
+                }
+            )
+        if next_token is not None:
+            response['NextToken'] = next_token
+        return response
+
+    def _describe_db_instances(self, region: str, params: dict)->dict:
+        instance_ids, next_token = self._get_page(items=self.get_instance_ids(service='rds', region=region), params=params, token_name='Marker', page_size_name='MaxRecords', default_page_size=100)
+        response = {'DBInstances': list()}
+        for instance_id in instance_ids:
+            response['DBInstances'].append(
+                {
+                    'DBInstanceIdentifier': instance_id,
+                    'DBInstanceClass': 'db.t3.medium',
+                    'DBInstanceStatus': 'available',
+                    'Engine': 'postgres',
+                    'DBInstanceArn': 'arn:aws:rds:{}:{}:db:{}'.format(region, self.account_id, instance_id),
+                    'TagList': [{'Key': 'Name', 'Value': instance_id},],
+                }
+            )
+        if next_token is not None:
+            response['Marker'] = next_token
+        return response
+
+    def _list_metrics(self, region: str, params: dict)->dict:
+        service, dimension_name = NAMESPACES[params['Namespace']]
+        dimension_value = None
+        for dimension in params.get('Dimensions', list()):
+            if dimension.get('Name') == dimension_name:
+                dimension_value = dimension.get('Value', None)
+        instance_ids = self.get_instance_ids(service=service, region=region) if dimension_value is None else [dimension_value,]
+        metrics = list()
+        for instance_id in instance_ids:
+            for metric_name in self.metric_names:
+                metrics.append({'Namespace': params['Namespace'], 'MetricName': metric_name, 'Dimensions': [{'Name': dimension_name, 'Value': instance_id},]})
+        page, next_token = self._get_page(items=metrics, params=params, token_name='NextToken', page_size_name='PageSize', default_page_size=LIST_METRICS_PAGE_SIZE)
+        response = {'Metrics': page}
+        if next_token is not None:
+            response['NextToken'] = next_token
+        return response
+
+    def _get_timestamps(self, params: dict, period: int)->list:
+        start = to_epoch(params['StartTime'])
+        end = to_epoch(params['EndTime'])
+        start = start - start % period
+        return list(range(start, end, period))
+
+    def _get_value(self, timestamp: int, statistic: str)->float:
+        return float((timestamp // 60 + len(statistic)) % 100)
+
+    def _get_metric_data(self, params: dict)->dict:
+        queries = params['MetricDataQueries']
+        if len(queries) == 0:
+            return {'MetricDataResults': list()}
+        timestamps = self._get_timestamps(params=params, period=queries[0]['MetricStat']['Period'])
+        queries_per_page = max(1, MAX_METRIC_DATA_DATAPOINTS // max(1, len(timestamps)))
+        page, next_token = self._get_page(items=queries, params={'NextToken': params.get('NextToken', None), 'PageSize': queries_per_page}, token_name='NextToken', page_size_name='PageSize', default_page_size=queries_per_page)
+        if params.get('ScanBy', 'TimestampDescending') != 'TimestampAscending':
+            timestamps = list(reversed(timestamps))
+        response = {'MetricDataResults': list()}
+        for query in page:
+            statistic = query['MetricStat']['Stat']
+            response['MetricDataResults'].append(
+                {
+                    'Id': query['Id'],
+                    'Label': query['MetricStat']['Metric']['MetricName'],
+                    'Timestamps': [datetime.fromtimestamp(timestamp, tz=timezone.utc) for timestamp in timestamps],
+                    'Values': [self._get_value(timestamp=timestamp, statistic=statistic) for timestamp in timestamps],
+                    'StatusCode': 'Complete',
+                }
+            )
+        if next_token is not None:
+            response['NextToken'] = next_token
+        return response
+
+    def _get_metric_statistics(self, params: dict)->dict:
+        timestamps = self._get_timestamps(params=params, period=params['Period'])
+        if len(timestamps) > MAX_METRIC_STATISTICS_DATAPOINTS:
+            raise ValueError('You have requested up to {} datapoints, which exceeds the limit of {}.'.format(len(timestamps), MAX_METRIC_STATISTICS_DATAPOINTS))
+        datapoints = list()
+        for timestamp in timestamps:
+            datapoint = {'Timestamp': datetime.fromtimestamp(timestamp, tz=timezone.utc), 'Unit': 'Percent'}
+            for statistic in params.get('Statistics', list()):
+                datapoint[statistic] = self._get_value(timestamp=timestamp, statistic=statistic)
+            if len(params.get('ExtendedStatistics', list())) > 0:
+                datapoint['ExtendedStatistics'] = {statistic: self._get_value(timestamp=timestamp, statistic=statistic) for statistic in params['ExtendedStatistics']}
+            datapoints.append(datapoint)
+        return {'Label': params['MetricName'], 'Datapoints': datapoints}
+
+
+class SyntheticFleetClientPool(AwsClientPool):
+    '''An AwsClientPool of which every client is served by a SyntheticFleet.
+    Placeholder credentials are used when none are configured.'''
+
+    def __init__(self, fleet: SyntheticFleet, log_wrapper: LogWrapper=LogWrapper(), **kwargs):
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+        super().__init__(log_wrapper=log_wrapper, **kwargs)
+        self.fleet = fleet
+        self._attached_clients = set()
+
+    def get_client(self, service: str='ec2', region: str='us-east-1', target_profile: str=None):
+        client = super().get_client(service=service, region=region, target_profile=target_profile)
+        with self._lock:
+            if id(client) not in self._attached_clients:
+                self.fleet.attach(aws_client=client)
+                self._attached_clients.add(id(client))
+        return client
+
+    def shutdown(self):
+        with self._lock:
+            super().shutdown()
+            self._attached_clients = set()
+
+
+def build_collection(instance_count: int, metric_count: int, datapoint_count: int=288)->AWSInstanceCollection:
+    collection = AWSInstanceCollection()
+    for instance_index in range(instance_count):
+        instance = AwsEC2Instance()
+        instance.instance_id = 'i-{:017x}'.format(instance_index)
+        instance.instance_type = 't3.medium'
+        instance.last_update = 1577836800
+        for metric_index in range(metric_count):
+            series = MetricSeries(statistics=('Average', 'Maximum'), unit='Percent')
+            for datapoint_index in range(datapoint_count):
+                series.timestamps.append(1577836800 + datapoint_index * 300)
+                series.values['Average'].append(random.uniform(0, 100))
+                series.values['Maximum'].append(random.uniform(0, 100))
+            instance.metric_statistics['Metric{}'.format(metric_index)] = series
+            instance.metrics.append('Metric{}'.format(metric_index))
+        collection.instances.append(instance)
+    return collection
+
+
+# EOF
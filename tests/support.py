@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta, timezone
+from tests.fleet_stub import SyntheticFleet, SyntheticFleetClientPool
+from aws_metrics_collector.aws import collect_aws_instance_data
+from aws_metrics_collector.metric_index import get_default_metric_index_cache
+from aws_metrics_collector.throttling import AdaptiveRateLimiter
+
+
+END_TIMESTAMP = datetime(2020, 1, 2, tzinfo=timezone.utc)
+START_TIMESTAMP = END_TIMESTAMP - timedelta(days=1)
+REGION = 'us-east-1'
+
+
+def get_fleet_client_pool(fleet: SyntheticFleet, **kwargs)->SyntheticFleetClientPool:
+    '''A client pool served by the fleet, with its own rate limiter (without
+    limits worth mentioning) unless one is given.'''
+    if 'rate_limiter' not in kwargs:
+        kwargs['rate_limiter'] = AdaptiveRateLimiter(api_rate_limits=dict(), default_rate_limit=10000.0)
+    return SyntheticFleetClientPool(fleet=fleet, **kwargs)
+
+
+def collect_from_fleet(fleet: SyntheticFleet, client_pool: SyntheticFleetClientPool=None, clear_metric_indexes: bool=True, **kwargs):
+    '''collect_aws_instance_data() of one region of the fleet, by default of
+    the whole of START_TIMESTAMP to END_TIMESTAMP. Unless clear_metric_indexes
+    is False, the process wide metric indexes are cleared first, as they are
+    keyed by account and region and would otherwise be shared by the fleets
+    of several tests.'''
+    if clear_metric_indexes is True:
+        get_default_metric_index_cache().clear()
+    if client_pool is None:
+        client_pool = get_fleet_client_pool(fleet=fleet)
+    arguments = {
+        'services': ['ec2', 'rds'],
+        'all_regions': False,
+        'regions': [REGION,],
+        'client_pool': client_pool,
+        'start_timestamp': START_TIMESTAMP,
+        'end_timestamp': END_TIMESTAMP,
+    }
+    arguments.update(kwargs)
+    return collect_aws_instance_data(**arguments)
+
+
+def get_datapoint_counts(collection)->dict:
+    '''{(instance_id, metric_name): number of datapoints}'''
+    return {
+        (instance.instance_id, metric_name): len(datapoints)
+        for instance in collection.instances
+        for metric_name, datapoints in instance.metric_statistics.items()
+    }
+
+# EOF
@@ -0,0 +1,66 @@
+import math
+import unittest
+from array import array
+from aws_metrics_collector.aws import AwsEC2Instance
+from aws_metrics_collector.metric_series import MetricSeries
+
+try:
+    import numpy
+except ImportError:     # pragma: no cover
+    numpy = None
+
+
+def build_instance(instance_id: str, metrics: dict)->AwsEC2Instance:
+    instance = AwsEC2Instance()
+    instance.instance_id = instance_id
+    instance.instance_type = 't3.medium'
+    for metric_name, values in metrics.items():
+        series = MetricSeries(statistics=('Average',), unit='Percent')
+        series.timestamps = array('q', range(0, len(values) * 300, 300))
+        series.values['Average'] = array('d', values)
+        instance.metric_statistics[metric_name] = series
+    return instance
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class TestSummarizeInstances(unittest.TestCase):
+
+    def test_statistics_match_numpy(self):
+        from aws_metrics_collector.analysis import summarize_instances
+        random_generator = numpy.random.default_rng(seed=1)
+        instances = list()
+        expected = list()
+        for index in range(20):
+            values = random_generator.uniform(0, 100, size=288 if index % 3 else 100)
+            values[random_generator.random(len(values)) < 0.1] = numpy.nan
+            instances.append(build_instance(instance_id='i-{}'.format(index), metrics={'Metric': values.tolist()}))
+            expected.append(values[~numpy.isnan(values)])
+        summary = summarize_instances(instances=instances)
+        for row, values in enumerate(expected):
+            self.assertEqual(summary['datapoints'][row], len(values))
+            self.assertAlmostEqual(summary['mean'][row], values.mean())
+            self.assertAlmostEqual(summary['max'][row], values.max())
+            for name, quantile in (('p50', 50), ('p95', 95), ('p99', 99)):
+                self.assertAlmostEqual(summary[name][row], numpy.percentile(values, quantile))
+
+    def test_flags(self):
+        from aws_metrics_collector.analysis import summarize_instances, summary_to_rows
+        instances = [
+            build_instance(instance_id='i-idle', metrics={'CPUUtilization': [1.0] * 288}),
+            build_instance(instance_id='i-under', metrics={'CPUUtilization': [10.0] * 288}),
+            build_instance(instance_id='i-over', metrics={'CPUUtilization': [90.0] * 288}),
+            build_instance(instance_id='i-normal', metrics={'CPUUtilization': [50.0] * 288, 'NetworkIn': [1.0] * 288}),
+            build_instance(instance_id='i-empty', metrics={'CPUUtilization': []}),
+        ]
+        summary = summarize_instances(instances=instances)
+        self.assertEqual(summary['flag'], ['idle', 'under', 'over', '', '', ''])
+        self.assertEqual(summary['idle_hours'][0], 24.0)
+        self.assertTrue(math.isnan(summary['idle_hours'][4]))     # No thresholds for NetworkIn
+        self.assertTrue(math.isnan(summary['p50'][5]))
+        self.assertEqual([row['instance_id'] for row in summary_to_rows(summary=summary, flagged_only=True)], ['i-idle', 'i-under', 'i-over'])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# EOF
@@ -0,0 +1,157 @@
+import unittest
+from datetime import datetime, timedelta, timezone
+from tests.fleet_stub import SyntheticFleet
+from aws_metrics_collector.metric_series import to_epoch
+from aws_metrics_collector.aws import _get_end_timestamp, _get_start_timestamp, group_start_timestamps, split_statistics, split_time_range
+from tests.support import END_TIMESTAMP, START_TIMESTAMP, collect_from_fleet, get_datapoint_counts
+
+
+class TestSplitTimeRange(unittest.TestCase):
+
+    def test_single_range(self):
+        self.assertEqual(split_time_range(start_timestamp=START_TIMESTAMP, end_timestamp=END_TIMESTAMP, period=300), [(START_TIMESTAMP, END_TIMESTAMP),])
+
+    def test_ranges_are_consecutive_and_limited(self):
+        start_timestamp = END_TIMESTAMP - timedelta(days=3)
+        time_ranges = split_time_range(start_timestamp=start_timestamp, end_timestamp=END_TIMESTAMP, period=60, max_datapoints=1440)
+        self.assertEqual(len(time_ranges), 3)
+        self.assertEqual(time_ranges[0][0], start_timestamp)
+        self.assertEqual(time_ranges[-1][1], END_TIMESTAMP)
+        for (range_start, range_end), (next_start, next_end) in zip(time_ranges, time_ranges[1:]):
+            self.assertEqual(range_end, next_start)
+        for range_start, range_end in time_ranges:
+            self.assertLessEqual((range_end - range_start).total_seconds(), 60 * 1440)
+
+    def test_empty_range(self):
+        self.assertEqual(split_time_range(start_timestamp=END_TIMESTAMP, end_timestamp=END_TIMESTAMP), [])
+
+    def test_naive_and_aware_timestamps(self):
+        naive_start_timestamp = START_TIMESTAMP.replace(tzinfo=None)
+        self.assertEqual(split_time_range(start_timestamp=naive_start_timestamp, end_timestamp=END_TIMESTAMP), [(START_TIMESTAMP, END_TIMESTAMP),])
+        self.assertEqual(split_time_range(start_timestamp=START_TIMESTAMP, end_timestamp=END_TIMESTAMP.replace(tzinfo=None)), [(START_TIMESTAMP, END_TIMESTAMP),])
+
+
+class TestDefaultTimestamps(unittest.TestCase):
+
+    def test_defaults_are_yesterday_utc(self):
+        start_timestamp = _get_start_timestamp()
+        end_timestamp = _get_end_timestamp()
+        self.assertEqual(start_timestamp.utcoffset(), timedelta(0))
+        self.assertEqual(end_timestamp.utcoffset(), timedelta(0))
+        self.assertEqual(start_timestamp.date(), (datetime.now(tz=timezone.utc) - timedelta(days=1)).date())
+        self.assertEqual(end_timestamp - start_timestamp, timedelta(hours=23, minutes=59, seconds=59))
+
+
+class TestSplitStatistics(unittest.TestCase):
+
+    def test_split(self):
+        self.assertEqual(split_statistics(statistics=('Average', 'p99', 'Maximum', 'tm90')), (['Average', 'Maximum'], ['p99', 'tm90']))
+
+
+class TestCollection(unittest.TestCase):
+
+    def setUp(self):
+        self.fleet = SyntheticFleet(instance_count=25, metrics_per_instance=3)
+
+    def test_collect_with_metric_data(self):
+        collection = collect_from_fleet(fleet=self.fleet, page_size=10)
+        self.assertEqual(len(collection.instances), 50)
+        datapoint_counts = get_datapoint_counts(collection=collection)
+        self.assertEqual(len(datapoint_counts), 50 * 3)
+        self.assertEqual(set(datapoint_counts.values()), {288,})
+        self.assertEqual(self.fleet.calls.get('GetMetricStatistics', 0), 0)
+        self.assertEqual(self.fleet.calls['ListMetrics'], 2)   # One sweep per namespace
+        for instance in collection.instances:
+            self.assertEqual(instance.metric_statistics['CPUUtilization'].unit, 'Percent')
+            self.assertEqual(instance.metric_statistics['NetworkIn'].unit, 'Bytes' if instance.instance_class == 'ec2' else None)   # Not an RDS metric
+
+    def test_collect_with_metric_statistics(self):
+        collection = collect_from_fleet(fleet=self.fleet, use_metric_data=False, use_metric_index=False)
+        datapoint_counts = get_datapoint_counts(collection=collection)
+        self.assertEqual(len(datapoint_counts), 50 * 3)
+        self.assertEqual(set(datapoint_counts.values()), {288,})
+        self.assertEqual(self.fleet.calls['GetMetricStatistics'], 50 * 3)
+        self.assertEqual(self.fleet.calls.get('GetMetricData', 0), 0)
+
+    def test_both_paths_return_the_same_values(self):
+        statistics = ('Average', 'Maximum', 'p99')
+        by_metric_data = collect_from_fleet(fleet=self.fleet, services=['ec2',], statistics=statistics)
+        by_metric_statistics = collect_from_fleet(fleet=self.fleet, services=['ec2',], statistics=statistics, use_metric_data=False)
+        expected = {(instance.instance_id, metric_name): series for instance in by_metric_data.instances for metric_name, series in instance.metric_statistics.items()}
+        for instance in by_metric_statistics.instances:
+            for metric_name, series in instance.metric_statistics.items():
+                other_series = expected[(instance.instance_id, metric_name)]
+                self.assertEqual(list(series.timestamps), list(other_series.timestamps))
+                for statistic in statistics:
+                    self.assertEqual(list(series.values[statistic]), list(other_series.values[statistic]))
+
+    def test_default_window(self):
+        for use_metric_data in (True, False):
+            collection = collect_from_fleet(fleet=self.fleet, services=['ec2',], start_timestamp=None, end_timestamp=None, use_metric_data=use_metric_data)
+            self.assertEqual(set(get_datapoint_counts(collection=collection).values()), {288,})
+
+    def test_aware_start_with_default_end(self):
+        # A UTC aware start_timestamp (as set by --start) with the default end_timestamp
+        start_timestamp = datetime.now(tz=timezone.utc) - timedelta(days=2)
+        by_metric_data = get_datapoint_counts(collection=collect_from_fleet(fleet=self.fleet, services=['ec2',], start_timestamp=start_timestamp, end_timestamp=None))
+        by_metric_statistics = get_datapoint_counts(collection=collect_from_fleet(fleet=self.fleet, services=['ec2',], start_timestamp=start_timestamp, end_timestamp=None, use_metric_data=False))
+        self.assertGreater(min(by_metric_statistics.values()), 0)
+        self.assertEqual(by_metric_statistics, by_metric_data)
+
+    def test_high_water_marks_with_default_end(self):
+        # High water marks (UTC aware) without an end_timestamp, as passed by library callers
+        collection = collect_from_fleet(fleet=self.fleet, services=['ec2',], start_timestamp=None, end_timestamp=None)
+        instance = collection.instances[0]
+        high_water_mark = to_epoch(_get_start_timestamp()) + 12 * 3600
+        high_water_marks = {(instance.account_id, instance.instance_class, instance.region, instance.instance_id, metric_name): high_water_mark for metric_name in instance.metrics}
+        for use_metric_data in (True, False):
+            datapoint_counts = get_datapoint_counts(collection=collect_from_fleet(fleet=self.fleet, services=['ec2',], start_timestamp=None, end_timestamp=None, high_water_marks=high_water_marks, use_metric_data=use_metric_data))
+            for (instance_id, metric_name), datapoint_count in datapoint_counts.items():
+                self.assertEqual(datapoint_count, 144 if instance_id == instance.instance_id else 288)
+
+    def test_mixed_high_water_marks_share_requests(self):
+        fleet = SyntheticFleet(instance_count=100, metrics_per_instance=3)
+        collection = collect_from_fleet(fleet=fleet, services=['ec2',], page_size=100, start_timestamp=None, end_timestamp=None)
+        high_water_mark = to_epoch(_get_start_timestamp()) + 12 * 3600
+        high_water_marks = dict()
+        for index, instance in enumerate(collection.instances):
+            for metric_name in instance.metrics:
+                high_water_marks[(instance.account_id, instance.instance_class, instance.region, instance.instance_id, metric_name)] = high_water_mark + (index % 7) * 300
+        fleet.calls = dict()
+        datapoint_counts = get_datapoint_counts(collection=collect_from_fleet(fleet=fleet, services=['ec2',], page_size=100, start_timestamp=None, end_timestamp=None, high_water_marks=high_water_marks))
+        self.assertEqual(fleet.calls['GetMetricData'], 2)   # 300 metrics of 2 statistics, at most 500 queries per request
+        self.assertEqual(set(datapoint_counts.values()), {144,})
+        self.assertEqual(group_start_timestamps(start_timestamps=[END_TIMESTAMP, START_TIMESTAMP, START_TIMESTAMP + timedelta(minutes=30)], max_spread=3600), {START_TIMESTAMP: START_TIMESTAMP, START_TIMESTAMP + timedelta(minutes=30): START_TIMESTAMP, END_TIMESTAMP: END_TIMESTAMP})
+
+    def test_instances_launched_after_the_metric_index_was_built(self):
+        collect_from_fleet(fleet=self.fleet, services=['ec2',])
+        self.fleet.instance_count = 30
+        collection = collect_from_fleet(fleet=self.fleet, services=['ec2',], clear_metric_indexes=False)
+        datapoint_counts = get_datapoint_counts(collection=collection)
+        self.assertEqual(len(datapoint_counts), 30 * 3)
+        self.assertEqual(set(datapoint_counts.values()), {288,})
+        self.assertEqual(self.fleet.calls['ListMetrics'], 1 + 5)     # The sweep, then one call per new instance
+
+    def test_rds_tags_from_describe(self):
+        collection = collect_from_fleet(fleet=self.fleet, services=['rds',])
+        for instance in collection.instances:
+            self.assertEqual(instance.tags, {'Name': instance.instance_id})
+        self.assertEqual(self.fleet.calls.get('ListTagsForResource', 0), 0)
+
+    def test_concurrent_collection(self):
+        regions = ['us-east-1', 'eu-west-1', 'ap-southeast-1']
+        collection = collect_from_fleet(fleet=self.fleet, regions=regions, max_workers=4, max_workers_per_region=1)
+        self.assertEqual(len(collection.instances), 2 * len(regions) * 25)
+        self.assertEqual(set(get_datapoint_counts(collection=collection).values()), {288,})
+
+    def test_instance_handler_without_keeping_instances(self):
+        handled = list()
+        collection = collect_from_fleet(fleet=self.fleet, instance_handler=handled.append, keep_instances=False)
+        self.assertEqual(len(collection.instances), 0)
+        self.assertEqual(len(handled), 50)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# EOF
@@ -0,0 +1,51 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+
+PACKAGE_DIRECTORY = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+class TestCommandLine(unittest.TestCase):
+    '''Runs python3 -m aws_metrics_collector in a new process, as the options
+    set the variables of the collector module.'''
+
+    def start(self, arguments: list)->subprocess.Popen:
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        return subprocess.Popen(
+            [sys.executable, '-m', 'aws_metrics_collector'] + arguments,
+            cwd=self.directory.name,
+            env=dict(os.environ, PYTHONPATH=PACKAGE_DIRECTORY),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True
+        )
+
+    def test_dry_run(self):
+        process = self.start(arguments=['--dry-run', '--no-metric-data', '--no-metric-index', '--regions', 'eu-west-1'])
+        stdout, stderr = process.communicate()
+        self.assertEqual(process.returncode, 0, stderr)
+        configuration = json.loads(stdout)
+        self.assertIs(configuration['use_get_metric_data'], False)
+        self.assertIs(configuration['use_metric_index'], False)
+        self.assertEqual(configuration['regions'], ['eu-west-1',])
+        self.assertEqual(os.listdir(self.directory.name), list())     # No log file
+
+    def test_dry_run_to_a_closed_pipe(self):
+        # As with amcollect --dry-run | head -1
+        process = self.start(arguments=['--dry-run',])
+        process.stdout.close()
+        stderr = process.stderr.read()
+        process.stderr.close()
+        self.assertEqual(process.wait(), 0, stderr)
+        self.assertEqual(stderr, '')
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# EOF
@@ -0,0 +1,52 @@
+import threading
+import unittest
+from tests.fleet_stub import SyntheticFleet
+from tests.support import get_fleet_client_pool
+
+
+ROLE_ARN = 'arn:aws:iam::210987654321:role/MetricsReader'
+
+
+class TestAwsClientPool(unittest.TestCase):
+
+    def setUp(self):
+        self.fleet = SyntheticFleet(instance_count=1, latency=0.05)
+        self.client_pool = get_fleet_client_pool(fleet=self.fleet)
+
+    def tearDown(self):
+        self.client_pool.shutdown()
+
+    def run_concurrently(self, function, thread_count: int=8)->list:
+        results = list()
+        barrier = threading.Barrier(thread_count)
+
+        def worker():
+            barrier.wait()
+            results.append(function())
+
+        threads = [threading.Thread(target=worker) for index in range(thread_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_account_id_is_looked_up_once(self):
+        results = self.run_concurrently(function=self.client_pool.get_account_id)
+        self.assertEqual(results, [self.fleet.account_id,] * 8)
+        self.assertEqual(self.fleet.calls, {'GetCallerIdentity': 1})
+
+    def test_client_is_created_once(self):
+        clients = self.run_concurrently(function=lambda: self.client_pool.get_client(service='ec2', region='eu-west-1'))
+        self.assertEqual(len(set(id(client) for client in clients)), 1)
+
+    def test_role_is_assumed_on_first_request(self):
+        self.assertEqual(self.client_pool.get_account_id(target_profile=ROLE_ARN), '210987654321')
+        self.client_pool.get_client(service='cloudwatch', region='us-east-1', target_profile=ROLE_ARN)
+        self.assertEqual(self.fleet.calls, dict())
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# EOF
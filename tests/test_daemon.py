@@ -0,0 +1,59 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+from tests.fleet_stub import SyntheticFleet
+from aws_metrics_collector import aws_metrics_collector as collector
+from aws_metrics_collector import client_pool
+from aws_metrics_collector.metric_index import get_default_metric_index_cache
+from tests.support import END_TIMESTAMP, REGION, START_TIMESTAMP, get_fleet_client_pool
+
+
+class TestDaemonCycle(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.fleet = SyntheticFleet(instance_count=5, metrics_per_instance=2)
+        self.report_file = os.path.join(self.directory.name, 'run_report.json')
+        settings = {
+            'services': ['ec2',],
+            'all_regions': False,
+            'regions': [REGION,],
+            'collection_start_timestamp': START_TIMESTAMP,
+            'collection_end_timestamp': END_TIMESTAMP,
+            'store_in_database': False,
+            'dump_raw_json_to_file': False,
+            'run_report': False,
+            'run_report_file': self.report_file,
+        }
+        for name, value in settings.items():
+            patcher = mock.patch.object(collector, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(client_pool, '_default_client_pool', get_fleet_client_pool(fleet=self.fleet))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        get_default_metric_index_cache().clear()
+
+    def read_report(self)->dict:
+        with open(self.report_file) as f:
+            return json.load(f)
+
+    def test_report_of_every_cycle(self):
+        collector.run_daemon_cycle()
+        first_report = self.read_report()
+        self.assertEqual(first_report['Apis']['ec2/DescribeInstances']['Count'], 1)
+        self.assertEqual(first_report['Counters']['ec2_instances'], 5)
+        collector.run_daemon_cycle()
+        second_report = self.read_report()
+        self.assertEqual(second_report['Apis']['ec2/DescribeInstances']['Count'], 1)
+        self.assertEqual(second_report['Counters']['ec2_instances'], 5)
+        self.assertNotIn('cloudwatch/ListMetrics', second_report['Apis'])    # The metric index stays warm
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# EOF
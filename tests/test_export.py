@@ -0,0 +1,51 @@
+import os
+import tempfile
+import unittest
+from tests.fleet_stub import build_collection
+from aws_metrics_collector.export import export_collection, get_partition_file_name
+from aws_metrics_collector.utils import dict_to_json
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.collection = build_collection(instance_count=12, metric_count=3, datapoint_count=20)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read(self, file_name: str)->str:
+        with open(file_name, 'r') as f:
+            return f.read()
+
+    def test_identical_to_dict_to_json(self):
+        file_name = os.path.join(self.directory.name, 'data.json')
+        for compact in (False, True):
+            expected = dict_to_json(self.collection.to_dict(), compact=compact)
+            for max_workers in (1, 2):
+                files = export_collection(collection=self.collection, file_name=file_name, compact=compact, max_workers=max_workers, shard_size=5)
+                self.assertEqual(files, [file_name,])
+                self.assertEqual(self.read(file_name=file_name), expected)
+
+    def test_empty_collection(self):
+        file_name = os.path.join(self.directory.name, 'data.json')
+        self.collection.instances = list()
+        export_collection(collection=self.collection, file_name=file_name, max_workers=1)
+        self.assertEqual(self.read(file_name=file_name), dict_to_json(self.collection.to_dict()))
+
+    def test_partitioned(self):
+        file_name = os.path.join(self.directory.name, 'data.json')
+        files = export_collection(collection=self.collection, file_name=file_name, partitioned=True, max_workers=1, shard_size=5)
+        self.assertEqual(files, [get_partition_file_name(file_name=file_name, partition=partition) for partition in range(3)])
+        self.assertTrue(files[0].endswith('data-00000.json'))
+        instances = self.collection.instances
+        for partition, shard_start in enumerate(range(0, 12, 5)):
+            self.collection.instances = instances[shard_start:shard_start + 5]
+            self.assertEqual(self.read(file_name=files[partition]), dict_to_json(self.collection.to_dict()))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# EOF
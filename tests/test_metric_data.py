@@ -0,0 +1,162 @@
+import os
+import unittest
+from datetime import timedelta
+from botocore.stub import ANY, Stubber
+from aws_metrics_collector.aws import AwsEC2Instance, collect_instance_metric_statistics, get_metric_data_batched
+from aws_metrics_collector.client_pool import AwsClientPool
+from aws_metrics_collector.metric_index import get_default_metric_index_cache
+from aws_metrics_collector.throttling import AdaptiveRateLimiter
+from tests.support import END_TIMESTAMP, START_TIMESTAMP
+
+
+TIMESTAMPS = [START_TIMESTAMP + timedelta(minutes=5 * index) for index in range(3)]
+
+
+def get_metric_data_result(query_id: str, timestamps: list, value: float)->dict:
+    return {
+        'Id': query_id,
+        'Label': query_id,
+        'Timestamps': timestamps,
+        'Values': [value + index for index in range(len(timestamps))],
+        'StatusCode': 'Complete',
+    }
+
+
+class TestGetMetricDataBatched(unittest.TestCase):
+
+    def setUp(self):
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'test')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'test')
+        self.client_pool = AwsClientPool(rate_limiter=AdaptiveRateLimiter(api_rate_limits=dict(), default_rate_limit=10000.0))
+        self.client_pool.set_account_id(account_id='123456789012')     # The stubbed client can not look it up
+        self.client = self.client_pool.get_client(service='cloudwatch', region='us-east-1')
+        self.requests = list()
+        self.client.meta.events.register('before-parameter-build.cloudwatch.GetMetricData', self._record_request)
+        self.stubber = Stubber(self.client)
+        self.stubber.activate()
+
+    def tearDown(self):
+        self.stubber.deactivate()
+        self.client_pool.shutdown()
+
+    def _record_request(self, params=None, **kwargs):
+        self.requests.append(dict(params))
+
+    def get_metric_queries(self, count: int)->list:
+        return [('ec2', 'i-{}'.format(index), 'CPUUtilization') for index in range(count)]
+
+    def test_chunks_of_500_queries_and_fan_out(self):
+        metric_queries = self.get_metric_queries(count=300)
+        for metric_count in (250, 50):     # 500 queries of 2 statistics, then the remaining 50 metrics
+            self.stubber.add_response(
+                'get_metric_data',
+                {
+                    'MetricDataResults': [
+                        get_metric_data_result(query_id='q{}s{}'.format(metric_index, statistic_index), timestamps=TIMESTAMPS, value=metric_index * 10.0 + statistic_index)
+                        for metric_index in range(metric_count)
+                        for statistic_index in range(2)
+                    ],
+                }
+            )
+        result = get_metric_data_batched(aws_client=self.client, metric_queries=metric_queries, start_timestamp=START_TIMESTAMP, end_timestamp=END_TIMESTAMP, statistics=('Average', 'Maximum'))
+        self.stubber.assert_no_pending_responses()
+        self.assertEqual([len(request['MetricDataQueries']) for request in self.requests], [500, 100])
+        self.assertEqual(self.requests[1]['MetricDataQueries'][0]['MetricStat']['Metric']['Dimensions'], [{'Name': 'InstanceId', 'Value': 'i-250'},])
+        self.assertEqual(set(result), set(metric_queries))
+        datapoints = result[('ec2', 'i-251', 'CPUUtilization')]     # The second metric of the second request
+        self.assertEqual([datapoint['Timestamp'] for datapoint in datapoints], TIMESTAMPS)
+        self.assertEqual(datapoints[0], {'Timestamp': TIMESTAMPS[0], 'Average': 10.0, 'Maximum': 11.0, 'Unit': 'Percent'})
+        self.assertEqual(datapoints[2]['Maximum'], 13.0)
+
+    def test_next_token_paging(self):
+        metric_queries = self.get_metric_queries(count=2)
+        self.stubber.add_response(
+            'get_metric_data',
+            {
+                'MetricDataResults': [
+                    get_metric_data_result(query_id='q0s0', timestamps=TIMESTAMPS[:2], value=1.0),
+                    get_metric_data_result(query_id='q1s0', timestamps=TIMESTAMPS[:2], value=2.0),
+                ],
+                'NextToken': 'page-2',
+            },
+            {'MetricDataQueries': ANY, 'StartTime': START_TIMESTAMP, 'EndTime': END_TIMESTAMP, 'ScanBy': 'TimestampAscending'}
+        )
+        self.stubber.add_response(
+            'get_metric_data',
+            {
+                'MetricDataResults': [
+                    get_metric_data_result(query_id='q0s0', timestamps=TIMESTAMPS[2:], value=5.0),
+                    get_metric_data_result(query_id='q1s0', timestamps=TIMESTAMPS[2:], value=6.0),
+                ],
+            },
+            {'MetricDataQueries': ANY, 'StartTime': START_TIMESTAMP, 'EndTime': END_TIMESTAMP, 'ScanBy': 'TimestampAscending', 'NextToken': 'page-2'}
+        )
+        result = get_metric_data_batched(aws_client=self.client, metric_queries=metric_queries, start_timestamp=START_TIMESTAMP, end_timestamp=END_TIMESTAMP, statistics=('Average',))
+        self.stubber.assert_no_pending_responses()
+        self.assertEqual([datapoint['Average'] for datapoint in result[metric_queries[0]]], [1.0, 2.0, 5.0])
+        self.assertEqual([datapoint['Average'] for datapoint in result[metric_queries[1]]], [2.0, 3.0, 6.0])
+        self.assertEqual([datapoint['Timestamp'] for datapoint in result[metric_queries[1]]], TIMESTAMPS)
+
+    def test_failed_chunk_is_left_out(self):
+        metric_queries = self.get_metric_queries(count=5)
+        self.stubber.add_response('get_metric_data', {'MetricDataResults': [get_metric_data_result(query_id='q{}s0'.format(index), timestamps=TIMESTAMPS, value=1.0) for index in range(2)]})
+        self.stubber.add_client_error('get_metric_data', service_error_code='InternalServiceError', http_status_code=500)
+        self.stubber.add_response('get_metric_data', {'MetricDataResults': [get_metric_data_result(query_id='q0s0', timestamps=TIMESTAMPS, value=1.0),]})
+        result = get_metric_data_batched(aws_client=self.client, metric_queries=metric_queries, start_timestamp=START_TIMESTAMP, end_timestamp=END_TIMESTAMP, statistics=('Average',), max_queries_per_request=2)
+        self.stubber.assert_no_pending_responses()
+        self.assertEqual(set(result), {metric_queries[0], metric_queries[1], metric_queries[4]})
+
+    def test_metric_without_datapoints(self):
+        metric_queries = self.get_metric_queries(count=1)
+        self.stubber.add_response('get_metric_data', {'MetricDataResults': [get_metric_data_result(query_id='q0s0', timestamps=[], value=1.0),]})
+        result = get_metric_data_batched(aws_client=self.client, metric_queries=metric_queries, start_timestamp=START_TIMESTAMP, end_timestamp=END_TIMESTAMP, statistics=('Average',))
+        self.assertEqual(result, {metric_queries[0]: []})
+
+    def test_fallback_to_metric_statistics(self):
+        get_default_metric_index_cache().clear()
+        instances = list()
+        for index in range(2):
+            instance = AwsEC2Instance()
+            instance.instance_id = 'i-{}'.format(index)
+            instances.append(instance)
+        self.stubber.add_response(
+            'list_metrics',
+            {'Metrics': [{'Namespace': 'AWS/EC2', 'MetricName': 'CPUUtilization', 'Dimensions': [{'Name': 'InstanceId', 'Value': instance.instance_id},]} for instance in instances]}
+        )
+        self.stubber.add_client_error('get_metric_data', service_error_code='InternalServiceError', http_status_code=500)
+        for index, instance in enumerate(instances):
+            self.stubber.add_response(
+                'get_metric_statistics',
+                {'Label': 'CPUUtilization', 'Datapoints': [{'Timestamp': timestamp, 'Average': float(index), 'Unit': 'Percent'} for timestamp in TIMESTAMPS]},
+                {
+                    'Namespace': 'AWS/EC2',
+                    'MetricName': 'CPUUtilization',
+                    'Dimensions': [{'Name': 'InstanceId', 'Value': instance.instance_id},],
+                    'Period': 300,
+                    'Statistics': ['Average',],
+                    'StartTime': START_TIMESTAMP,
+                    'EndTime': END_TIMESTAMP,
+                }
+            )
+        collect_instance_metric_statistics(
+            instances=instances,
+            service_name='ec2',
+            region='us-east-1',
+            client_pool=self.client_pool,
+            start_timestamp=START_TIMESTAMP,
+            end_timestamp=END_TIMESTAMP,
+            statistics=('Average',)
+        )
+        self.stubber.assert_no_pending_responses()
+        for index, instance in enumerate(instances):
+            self.assertEqual(instance.metrics, ['CPUUtilization',])
+            series = instance.metric_statistics['CPUUtilization']
+            self.assertEqual(len(series), 3)
+            self.assertEqual(set(series.values['Average']), {float(index),})
+            self.assertEqual(series.unit, 'Percent')
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# EOF
@@ -0,0 +1,158 @@
+import os
+import tempfile
+import time
+import unittest
+from tests.fleet_stub import SyntheticFleet
+from aws_metrics_collector.aws import iter_cached_pages
+from aws_metrics_collector.response_cache import ResponseCache, configure_default_response_cache, get_request_key
+from tests.support import REGION, collect_from_fleet, get_datapoint_counts, get_fleet_client_pool
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.directory.name, 'cache')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_request_key_is_canonical(self):
+        self.assertEqual(get_request_key(request={'a': 1, 'b': [1, 2]}), get_request_key(request={'b': [1, 2], 'a': 1}))
+        self.assertNotEqual(get_request_key(request={'a': 1}), get_request_key(request={'a': 2}))
+
+    def test_disabled(self):
+        cache = ResponseCache()
+        cache.put(request={'a': 1}, response=[1,])
+        self.assertIsNone(cache.get(request={'a': 1}))
+        self.assertEqual(cache.get_or_fetch(request={'a': 1}, fetch_function=lambda: [2,]), [2,])
+
+    def test_put_and_get_survive_a_restart(self):
+        cache = ResponseCache(cache_dir=self.cache_dir)
+        cache.put(request={'a': 1}, response={'Datapoints': [1, 2]})
+        self.assertEqual(cache.get(request={'a': 1}), {'Datapoints': [1, 2]})
+        cache = ResponseCache(cache_dir=self.cache_dir)
+        self.assertEqual(cache.get(request={'a': 1}), {'Datapoints': [1, 2]})
+        self.assertIsNone(cache.get(request={'a': 2}))
+
+    def test_expiry(self):
+        cache = ResponseCache(cache_dir=self.cache_dir, settle_time=3600, recent_ttl=300)
+        self.assertIsNone(cache.get_expires(window_end=time.time() - 7200))     # Closed window
+        self.assertAlmostEqual(cache.get_expires(window_end=time.time()), time.time() + 300, delta=5)
+        cache.put(request={'a': 1}, response=[1,], expires=time.time() - 1)
+        self.assertIsNone(cache.get(request={'a': 1}))
+        cache.offline = True
+        self.assertEqual(cache.get(request={'a': 1}), [1,])     # Offline, expired entries are still used
+
+    def test_get_or_fetch(self):
+        cache = ResponseCache(cache_dir=self.cache_dir)
+        calls = list()
+
+        def fetch_function():
+            calls.append(1)
+            return [len(calls),]
+
+        self.assertEqual(cache.get_or_fetch(request={'a': 1}, fetch_function=fetch_function, window_end=0), [1,])
+        self.assertEqual(cache.get_or_fetch(request={'a': 1}, fetch_function=fetch_function, window_end=0), [1,])
+        self.assertEqual(len(calls), 1)
+        cache.offline = True
+        with self.assertRaises(Exception):
+            cache.get_or_fetch(request={'a': 2}, fetch_function=fetch_function)
+        self.assertEqual(len(calls), 1)
+
+    def test_least_recently_used_are_evicted(self):
+        cache = ResponseCache(cache_dir=self.cache_dir)
+        for index in range(3):
+            cache.put(request={'index': index}, response=list(range(100)))
+        entry_size = cache.to_dict()['Size'] // 3
+        cache.max_size = entry_size * 3 + entry_size // 2
+        self.assertEqual(cache.get(request={'index': 0}), list(range(100)))  # 0 is now the most recently used
+        cache.put(request={'index': 3}, response=list(range(100)))
+        self.assertIsNone(cache.get(request={'index': 1}))
+        for index in (0, 2, 3):
+            self.assertIsNotNone(cache.get(request={'index': index}))
+        self.assertEqual(cache.to_dict()['Evictions'], 1)
+        self.assertEqual(cache.to_dict()['Entries'], 3)
+        cache.clear()
+        self.assertEqual(cache.to_dict()['Size'], 0)
+
+
+class TestCollectionWithResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.directory.name, 'cache')
+
+    def tearDown(self):
+        configure_default_response_cache()
+        self.directory.cleanup()
+
+    def collect(self, offline: bool=False, **kwargs)->tuple:
+        '''Collect from a new fleet through the default response cache;
+        returns the datapoint counts and the fleet.'''
+        configure_default_response_cache(cache_dir=self.cache_dir, offline=offline)
+        fleet = SyntheticFleet(instance_count=15, metrics_per_instance=2)
+        return get_datapoint_counts(collection=collect_from_fleet(fleet=fleet, page_size=10, **kwargs)), fleet
+
+    def test_default_paths_are_cached(self):
+        datapoint_counts, fleet = self.collect()
+        self.assertEqual(len(datapoint_counts), 2 * 15 * 2)
+        self.assertEqual(set(datapoint_counts.values()), {288,})
+        self.assertGreater(fleet.calls['GetMetricData'], 0)
+        cached_datapoint_counts, fleet = self.collect()
+        self.assertEqual(cached_datapoint_counts, datapoint_counts)
+        self.assertEqual(fleet.calls, dict())
+
+    def test_offline_makes_no_calls(self):
+        for use_metric_data, use_metric_index in ((True, True), (False, False)):
+            datapoint_counts, fleet = self.collect(use_metric_data=use_metric_data, use_metric_index=use_metric_index)
+            self.assertGreater(fleet.get_call_count(), 0)
+            offline_datapoint_counts, fleet = self.collect(offline=True, use_metric_data=use_metric_data, use_metric_index=use_metric_index)
+            self.assertEqual(offline_datapoint_counts, datapoint_counts)
+            self.assertEqual(fleet.calls, dict())
+
+    def test_offline_without_cached_responses(self):
+        datapoint_counts, fleet = self.collect(offline=True)
+        self.assertEqual(datapoint_counts, dict())
+        self.assertEqual(fleet.calls, dict())
+
+
+class TestCachedPages(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.fleet = SyntheticFleet(instance_count=25)
+        self.client_pool = get_fleet_client_pool(fleet=self.fleet)
+        self.addCleanup(self.client_pool.shutdown)
+        self.client = self.client_pool.get_client(service='ec2', region=REGION)
+        self.paginate_kwargs = {'PaginationConfig': {'PageSize': 10}}
+
+    def get_instance_ids(self, response_cache: ResponseCache)->list:
+        pages = iter_cached_pages(aws_client=self.client, operation='describe_instances', paginate_kwargs=self.paginate_kwargs, account_id='123456789012', response_cache=response_cache)
+        return [instance['InstanceId'] for page in pages for reservation in page['Reservations'] for instance in reservation['Instances']]
+
+    def test_pages_are_cached(self):
+        cache = ResponseCache(cache_dir=os.path.join(self.directory.name, 'cache'))
+        instance_ids = self.get_instance_ids(response_cache=cache)
+        self.assertEqual(instance_ids, self.fleet.get_instance_ids(service='ec2', region=REGION))
+        self.assertEqual(self.fleet.calls['DescribeInstances'], 3)
+        self.assertEqual(self.get_instance_ids(response_cache=cache), instance_ids)
+        self.assertEqual(self.fleet.calls['DescribeInstances'], 3)
+        # A page that is no longer cached: the paginator starts again and skips the first page
+        request = {'Operation': 'DescribeInstances', 'AccountId': '123456789012', 'Region': REGION, 'Page': 1}
+        request.update(self.paginate_kwargs)
+        cache._remove(key=get_request_key(request=request))
+        self.assertEqual(self.get_instance_ids(response_cache=cache), instance_ids)
+        self.assertEqual(self.fleet.calls['DescribeInstances'], 6)
+        cache.clear()
+        cache.offline = True
+        with self.assertRaises(Exception):
+            self.get_instance_ids(response_cache=cache)
+        self.assertEqual(self.get_instance_ids(response_cache=ResponseCache()), instance_ids)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# EOF
@@ -0,0 +1,40 @@
+import os
+import tempfile
+import unittest
+from aws_metrics_collector.tag_cache import TagCache
+
+
+ARN = 'arn:aws:rds:us-east-1:123456789012:db:db-1'
+
+
+class TestTagCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.cache_file = os.path.join(self.directory.name, 'rds_tag_cache.json')
+
+    def test_saved_once_and_loaded(self):
+        cache = TagCache(cache_file=self.cache_file)
+        cache.put_many(tags_by_arn={ARN: {'Name': 'db-1'}})
+        cache.put_many(tags_by_arn={ARN + '2': dict()})
+        self.assertFalse(os.path.exists(self.cache_file))   # Only save() writes the file
+        cache.save()
+        self.assertEqual(TagCache(cache_file=self.cache_file).get(arn=ARN), {'Name': 'db-1'})
+        os.utime(self.cache_file, ns=(0, 0))
+        cache.save()     # Nothing changed
+        self.assertEqual(os.stat(self.cache_file).st_mtime_ns, 0)
+
+    def test_expiry_and_no_file(self):
+        cache = TagCache(ttl=None)
+        cache.put_many(tags_by_arn={ARN: {'Name': 'db-1'}})
+        cache.save()
+        self.assertEqual(cache.get(arn=ARN), {'Name': 'db-1'})
+        cache.ttl = -1
+        self.assertIsNone(cache.get(arn=ARN))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# EOF
@@ -0,0 +1,62 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+from tests.fleet_stub import SyntheticFleet
+from aws_metrics_collector.throttling import AdaptiveRateLimiter, TokenBucket
+from tests.support import collect_from_fleet, get_fleet_client_pool
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_increase_and_decrease(self):
+        bucket = TokenBucket(rate=10.0)
+        bucket.decrease()
+        self.assertEqual(bucket.rate, 5.0)
+        bucket.increase()
+        self.assertAlmostEqual(bucket.rate, 5.1)
+        for index in range(20):
+            bucket.decrease()
+        self.assertEqual(bucket.rate, bucket.min_rate)
+        bucket.rate = bucket.max_rate
+        bucket.increase()
+        self.assertEqual(bucket.rate, 40.0)
+
+
+class TestAdaptiveRateLimiter(unittest.TestCase):
+
+    def test_accounting_of_throttled_calls(self):
+        fleet = SyntheticFleet(instance_count=4, metrics_per_instance=2, throttle_rate=0.15, seed=3)
+        rate_limiter = AdaptiveRateLimiter(api_rate_limits=dict(), default_rate_limit=10000.0)
+        collection = collect_from_fleet(fleet=fleet, client_pool=get_fleet_client_pool(fleet=fleet, rate_limiter=rate_limiter), services=['ec2',], use_metric_data=False)
+        self.assertGreater(fleet.throttles, 0)
+        statistics = rate_limiter.get_statistics_by_key()
+        self.assertEqual(sum(api_statistics['Throttles'] for api_statistics in statistics.values()), fleet.throttles)
+        self.assertEqual(sum(api_statistics['Calls'] for api_statistics in statistics.values()), fleet.get_call_count() - fleet.throttles)
+        self.assertEqual(sum(api_statistics['Errors'] for api_statistics in statistics.values()), 0)
+        self.assertEqual(statistics[(fleet.account_id, 'us-east-1', 'GetMetricStatistics')]['Calls'], 4 * 2)
+        self.assertEqual(len(collection.instances), 4)
+
+    def test_profiles_of_the_same_account_share_a_bucket(self):
+        fleet = SyntheticFleet(instance_count=2)
+        rate_limiter = AdaptiveRateLimiter(api_rate_limits=dict(), default_rate_limit=10000.0)
+        with tempfile.TemporaryDirectory() as directory:
+            credentials_file = os.path.join(directory, 'credentials')
+            with open(credentials_file, 'w') as f:
+                for profile in ('reader', 'admin'):
+                    f.write('[{}]\naws_access_key_id = {}\naws_secret_access_key = {}\n'.format(profile, profile, profile))
+            with mock.patch.dict(os.environ, {'AWS_SHARED_CREDENTIALS_FILE': credentials_file}):
+                client_pool = get_fleet_client_pool(fleet=fleet, rate_limiter=rate_limiter)
+                for profile in ('reader', 'admin'):
+                    client_pool.get_client(service='ec2', region='us-east-1', target_profile=profile).describe_instances()
+                client_pool.shutdown()
+        statistics = rate_limiter.get_statistics_by_key()
+        self.assertEqual([key for key in statistics if key[2] == 'DescribeInstances'], [(fleet.account_id, 'us-east-1', 'DescribeInstances'),])
+        self.assertEqual(statistics[(fleet.account_id, 'us-east-1', 'DescribeInstances')]['Calls'], 2)
+        self.assertEqual(fleet.calls['GetCallerIdentity'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# EOF